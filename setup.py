@@ -16,6 +16,8 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     entry_points={
-        'console_scripts': ['siswrap-ws = siswrap.app:start']
+        'console_scripts': ['siswrap-ws = siswrap.app:start',
+                            'siswrap-worker = siswrap.worker:start',
+                            'siswrap-fake-sisyphus = siswrap.fake_sisyphus:start']
     }
 )
@@ -0,0 +1,158 @@
+import time
+import logging
+import multiprocessing
+from collections import deque
+from siswrap.usage import read_proc, proc_fields
+
+""" Admission of queued jobs depending on how loaded the node is.
+"""
+
+
+class ResourceAdmission(object):
+    """ Decides if the node has room for another job, on top of the fixed
+        concurrency limits. A job is held in the queue while:
+
+         - the 1-minute load average per CPU is above
+           `admission_max_load_per_cpu`. The jobs started during the last
+           minute count as one each, as the load average is slow to show them.
+         - the available memory (MemAvailable in /proc/meminfo), less what the
+           running jobs are expected to grow by, would drop below
+           `admission_min_free_mb` if the job was started.
+
+        The memory that a job of a type needs is learned from the peak RSS
+        (VmHWM) of the main process of the finished jobs of that type. Until
+        a job of the type has finished, it is taken from
+        `admission_footprint_mb` in the app config, or else assumed to be
+        nothing. The peaks come from the usage samples that ProcessService
+        takes of the running jobs every `admission_interval` seconds.
+
+        Args:
+            configuration_svc: the ConfigurationService serving conf lookups
+            logger: the Logger object in charge of printouts
+            proc_root: where the proc file system is mounted
+    """
+
+    DEFAULT_INTERVAL = 5
+    LOAD_LAG = 60
+
+    # How much a new peak counts in the footprint of a type, when it isn't
+    # higher than the footprint; a higher peak replaces the footprint
+    FOOTPRINT_WEIGHT = 0.3
+
+    def __init__(self, configuration_svc, logger=None, proc_root="/proc"):
+        self.logger = logger or logging.getLogger(__name__)
+        self.proc_root = proc_root
+
+        conf = configuration_svc.get_app_config()
+        self.max_load_per_cpu = conf.get("admission_max_load_per_cpu")
+        min_free_mb = conf.get("admission_min_free_mb")
+        self.min_free_kb = min_free_mb * 1024 if min_free_mb is not None else None
+        self.interval = conf.get("admission_interval", self.DEFAULT_INTERVAL)
+        self.footprints = dict((wrapper_type, mb * 1024) for wrapper_type, mb in
+                               (conf.get("admission_footprint_mb") or {}).items())
+
+        self.cpus = multiprocessing.cpu_count()
+        self._peaks = {}
+        self._current = {}
+        self._starts = deque()
+
+    @staticmethod
+    def create(configuration_svc, logger=None):
+        """ Helper method for returning the admission control asked for in the
+            config, or None if no thresholds are set.
+        """
+        conf = configuration_svc.get_app_config()
+        if (conf.get("admission_max_load_per_cpu") is None and
+                conf.get("admission_min_free_mb") is None):
+            return None
+        return ResourceAdmission(configuration_svc, logger)
+
+    def load(self):
+        """ The 1-minute load average, or None if it can't be read.
+        """
+        text = read_proc(self.proc_root, "loadavg")
+        return float(text.split()[0]) if text else None
+
+    def available_memory(self):
+        """ The memory available for new processes in kB, or None if it
+            can't be read.
+        """
+        text = read_proc(self.proc_root, "meminfo")
+        if not text:
+            return None
+
+        fields = proc_fields(text)
+        if "MemAvailable" in fields:
+            return fields["MemAvailable"]
+
+        # Kernels older than 3.14 don't tell, so make an estimate
+        return (fields.get("MemFree", 0) + fields.get("Buffers", 0) +
+                fields.get("Cached", 0))
+
+    def sample(self, wrapper, usage):
+        """ Take note of the memory use of the process of a running job.
+
+            Args:
+                wrapper: the wrapper object of the job
+                usage: a sample of the process, from ProcessUsage.sample
+        """
+        if not usage:
+            return
+
+        pid = wrapper.info.pid
+        self._current[pid] = usage.get("rss_kb", 0)
+        self._peaks[pid] = max(self._peaks.get(pid, 0),
+                               usage.get("max_rss_kb", 0))
+
+    def started(self, wrapper):
+        self._starts.append(time.time())
+
+    def finished(self, wrapper):
+        """ Learn the footprint of the type of a job that has finished.
+        """
+        pid = wrapper.info.pid
+        self._current.pop(pid, None)
+        peak = self._peaks.pop(pid, None)
+        if not peak:
+            return
+
+        old = self.footprints.get(wrapper.type_txt)
+        if old is None or peak > old:
+            self.footprints[wrapper.type_txt] = peak
+        else:
+            self.footprints[wrapper.type_txt] = int(
+                old * (1 - self.FOOTPRINT_WEIGHT) + peak * self.FOOTPRINT_WEIGHT)
+
+    def refusal(self, wrapper_type, running):
+        """ Tell why a job of a type can't be started right now.
+
+            Args:
+                wrapper_type: the type of the job
+                running: the wrapper objects of the running jobs
+
+            Returns:
+                the reason, or None if the job can be started
+        """
+        if self.max_load_per_cpu is not None:
+            load = self.load()
+            if load is not None:
+                now = time.time()
+                while self._starts and now - self._starts[0] > self.LOAD_LAG:
+                    self._starts.popleft()
+
+                per_cpu = (load + len(self._starts)) / self.cpus
+                if per_cpu > self.max_load_per_cpu:
+                    return "the load is too high ({0:.2f} per CPU)".format(per_cpu)
+
+        if self.min_free_kb is not None:
+            available = self.available_memory()
+            if available is not None:
+                growth = sum(max(0, self.footprints.get(w.type_txt, 0) -
+                                 self._current.get(w.info.pid, 0))
+                             for w in running)
+                left = available - growth - self.footprints.get(wrapper_type, 0)
+                if left < self.min_free_kb:
+                    return "there is too little free memory ({0} MB would " \
+                           "be left)".format(left // 1024)
+
+        return None
@@ -1,21 +1,65 @@
 from tornado.web import URLSpec as url
+from tornado.ioloop import PeriodicCallback
 
 from arteria.web.app import AppService
-from siswrap.handlers import RunHandler, StatusHandler
-from siswrap.wrapper_services import ProcessService
+from siswrap.handlers import RunHandler, BatchRunHandler, StatusHandler, \
+    LogsHandler, VersionHandler, PipelineRunHandler, PipelineStatusHandler, \
+    StopHandler, MetricsHandler
+from siswrap.wrapper_services import ProcessService, SisyphusVersionService
+from siswrap.job_store import JobStore
+from siswrap.result_cache import ResultCache
 
 
 def routes(**kwargs):
     return [
         url(r"/api/1.0/(?:qc|report|aeacusstats|aeacusreports|checkindices)/run/([\w_-]+)",
             RunHandler, name="run", kwargs=kwargs),
+        url(r"/api/1.0/batch/run", BatchRunHandler, name="batch_run", kwargs=kwargs),
+        url(r"/api/1.0/pipeline/run/([\w_-]+)", PipelineRunHandler,
+            name="pipeline_run", kwargs=kwargs),
+        url(r"/api/1.0/pipeline/status/(\d+)", PipelineStatusHandler,
+            name="pipeline_status", kwargs=kwargs),
         url(r"/api/1.0/(?:qc|report|aeacusstats|aeacusreports|checkindices)/status/(\d*)",
-            StatusHandler, name="status", kwargs=kwargs)]
+            StatusHandler, name="status", kwargs=kwargs),
+        url(r"/api/1.0/(?:qc|report|aeacusstats|aeacusreports|checkindices)/logs/(\d+)",
+            LogsHandler, name="logs", kwargs=kwargs),
+        url(r"/api/1.0/(?:qc|report|aeacusstats|aeacusreports|checkindices)/stop/(\d+)",
+            StopHandler, name="stop", kwargs=kwargs),
+        url(r"/api/1.0/version", VersionHandler, name="version", kwargs=kwargs),
+        url(r"/metrics", MetricsHandler, name="metrics", kwargs=kwargs)]
+
+def create_routes(config_svc):
+    """ Set up the services of the app from its config, and return its routes.
+        The job store is recovered, and in worker mode the jobs are refreshed
+        from it periodically, once the IOLoop runs.
+
+        Args:
+            config_svc: the ConfigurationService of the app
+
+        Returns:
+            the routes of the app, with the services passed to the handlers
+    """
+    version_svc = SisyphusVersionService(config_svc)
+    version_svc.resolve()
+
+    job_store = JobStore.create(config_svc)
+    result_cache = ResultCache(config_svc, version_svc)
+    process_svc = ProcessService(config_svc, job_store=job_store,
+                                 result_cache=result_cache)
+    process_svc.recover()
+
+    # The workers report the progress of the jobs in the job store
+    if not process_svc.local_dispatch:
+        PeriodicCallback(process_svc.refresh,
+                         process_svc.worker_poll_interval * 1000).start()
+
+    return routes(process_svc=process_svc, config_svc=config_svc,
+                  version_svc=version_svc)
+
 
 def start():
     app_svc = AppService.create(__package__)
-    process_svc = ProcessService(app_svc.config_svc)
 
     # Setup the routing. Help will be automatically available at /api, and will
     # be based on the doc strings of the get/post/put/delete methods
-    app_svc.start(routes(process_svc=process_svc, config_svc=app_svc.config_svc))
+    app_svc.start(create_routes(app_svc.config_svc))
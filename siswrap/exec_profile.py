@@ -0,0 +1,163 @@
+import os
+import ctypes
+import ctypes.util
+import platform
+import resource
+
+""" Execution profiles for the Sisyphus processes: CPU and I/O priority,
+    CPU affinity and resource limits.
+"""
+
+
+class ExecutionProfile(object):
+    """ How the process of a job of a wrapper type is run, as set in the
+        `execution_profiles` of the app config, per wrapper type:
+
+            nice: the niceness to add, 0-19
+            ionice_class: idle, best-effort or realtime
+            ionice_level: the priority within the I/O class, 0-7
+            cpu_affinity: the list of the CPUs the process may run on
+            rlimit_as_mb: the limit on the address space, in MB
+            rlimit_nofile: the limit on the number of open files
+
+        All the settings are optional. They are applied in the child process
+        before the Sisyphus script is executed, so they are inherited by
+        whatever processes the script starts.
+
+        Args:
+            settings: the dict with the settings of the profile
+
+        Raises:
+            RuntimeError: if a setting isn't valid
+    """
+
+    IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+    IOPRIO_CLASS_SHIFT = 13
+    IOPRIO_WHO_PROCESS = 1
+
+    # The number of the ioprio_set system call, which glibc has no wrapper for
+    IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289,
+                           "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+
+    MAX_CPUS = 1024
+
+    SETTINGS = ("nice", "ionice_class", "ionice_level", "cpu_affinity",
+                "rlimit_as_mb", "rlimit_nofile")
+
+    _libc = None
+
+    def __init__(self, settings):
+        unknown = set(settings) - set(self.SETTINGS)
+        if unknown:
+            raise RuntimeError("Unknown execution profile settings: {0}".
+                               format(", ".join(sorted(unknown))))
+
+        self.nice = self._int(settings, "nice", 0, 19)
+        self.ionice_class = settings.get("ionice_class")
+        self.ionice_level = self._int(settings, "ionice_level", 0, 7)
+        self.cpu_affinity = settings.get("cpu_affinity")
+        self.rlimit_as_mb = self._int(settings, "rlimit_as_mb", 1, None)
+        self.rlimit_nofile = self._int(settings, "rlimit_nofile", 1, None)
+
+        if (self.ionice_class is not None and
+                self.ionice_class not in self.IONICE_CLASSES):
+            raise RuntimeError("ionice_class must be one of {0}".
+                               format(", ".join(sorted(self.IONICE_CLASSES))))
+
+        if self.cpu_affinity is not None:
+            if (not isinstance(self.cpu_affinity, list) or not self.cpu_affinity
+                    or not all(isinstance(cpu, int) and cpu >= 0
+                               and cpu < self.MAX_CPUS
+                               for cpu in self.cpu_affinity)):
+                raise RuntimeError("cpu_affinity must be a list of CPU numbers")
+
+        if self._wants_ionice() and self._ioprio_set_syscall() is None:
+            raise RuntimeError("ionice isn't supported on {0}".
+                               format(platform.machine()))
+
+        # Look up libc here, as it can't be done safely in the child
+        if self._wants_ionice() or self.cpu_affinity:
+            self.libc()
+
+    @staticmethod
+    def _int(settings, name, low, high):
+        value = settings.get(name)
+        if value is None:
+            return None
+        if (not isinstance(value, int) or value < low or
+                (high is not None and value > high)):
+            raise RuntimeError("{0} must be an integer from {1}{2}".
+                               format(name, low,
+                                      " to {0}".format(high) if high else ""))
+        return value
+
+    @staticmethod
+    def for_type(configuration_svc, wrapper_type):
+        """ Helper method for returning the profile of a wrapper type, or None
+            if there is none in the config.
+        """
+        conf = configuration_svc.get_app_config()
+        settings = (conf.get("execution_profiles") or {}).get(wrapper_type)
+        return ExecutionProfile(settings) if settings else None
+
+    def _wants_ionice(self):
+        return self.ionice_class is not None or self.ionice_level is not None
+
+    @classmethod
+    def _ioprio_set_syscall(cls):
+        return cls.IOPRIO_SET_SYSCALLS.get(platform.machine())
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                    use_errno=True)
+        return cls._libc
+
+    def _check(self, result, what):
+        if result != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "Could not set {0}: {1}".
+                          format(what, os.strerror(err)))
+
+    def apply(self):
+        """ Apply the profile to the current process. Meant to be run in the
+            child, between fork and exec.
+        """
+        if self.nice:
+            os.nice(self.nice)
+
+        if self._wants_ionice():
+            ioprio_class = self.IONICE_CLASSES[self.ionice_class or "best-effort"]
+            # The idle class has no levels
+            if ioprio_class == 3:
+                level = 0
+            else:
+                level = 4 if self.ionice_level is None else self.ionice_level
+            ioprio = (ioprio_class << self.IOPRIO_CLASS_SHIFT) | level
+            self._check(self.libc().syscall(self._ioprio_set_syscall(),
+                                            self.IOPRIO_WHO_PROCESS, 0, ioprio),
+                        "I/O priority")
+
+        if self.cpu_affinity:
+            bits = ctypes.sizeof(ctypes.c_ulong) * 8
+            mask = (ctypes.c_ulong * (self.MAX_CPUS // bits))()
+            for cpu in self.cpu_affinity:
+                mask[cpu // bits] |= 1 << (cpu % bits)
+            self._check(self.libc().sched_setaffinity(0, ctypes.sizeof(mask),
+                                                      ctypes.byref(mask)),
+                        "CPU affinity")
+
+        if self.rlimit_as_mb is not None:
+            limit = self.rlimit_as_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+        if self.rlimit_nofile is not None:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (self.rlimit_nofile, self.rlimit_nofile))
+
+    def as_dict(self):
+        """ The settings of the profile, as reported in the job status.
+        """
+        return dict((name, getattr(self, name)) for name in self.SETTINGS
+                    if getattr(self, name) is not None)
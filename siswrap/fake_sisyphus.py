@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import math
+import random
+import hashlib
+import signal
+import yaml
+from argparse import ArgumentParser
+
+""" A fake Sisyphus toolkit, so that the service can be run for performance
+    and fault testing without Sisyphus installed.
+"""
+
+
+class FakeScript(object):
+    """ How a fake Sisyphus script behaves, as set in `fake_sisyphus` in the
+        app config:
+
+            runtime_seconds: how long the script runs; a number, or a
+                             distribution to draw it from:
+                                 {distribution: uniform, min: 10, max: 60}
+                                 {distribution: normal, mean: 30, stddev: 5}
+                                 {distribution: lognormal, median: 30,
+                                  sigma: 0.5}
+                                 {distribution: exponential, mean: 30}
+            stdout_bytes, stderr_bytes: how much output the script writes,
+                                        spread over its runtime
+            memory_mb: how much memory the script allocates and keeps
+                       resident while it runs
+            exit_codes: the exit code, or a dict with the weight of each
+                        exit code to draw it from, e.g. {0: 9, 1: 1}
+            crash_probability: the chance that the script is killed by
+                               SIGSEGV part way through its run
+            hang_probability: the chance that the script stops writing output
+                              part way through its run, and never exits
+            seed: makes the draws the same for the same arguments, so that a
+                  test run can be repeated
+
+        All the settings are optional; the default is a script that exits
+        successfully right away. The settings under `scripts` override the
+        others for single scripts, by script name.
+
+        Args:
+            settings: the dict with the settings of the script
+
+        Raises:
+            RuntimeError: if a setting isn't valid
+    """
+
+    SETTINGS = ("runtime_seconds", "stdout_bytes", "stderr_bytes", "memory_mb",
+                "exit_codes", "crash_probability", "hang_probability", "seed")
+
+    # The parameters of each runtime distribution
+    DISTRIBUTIONS = {"uniform": ("min", "max"),
+                     "normal": ("mean", "stddev"),
+                     "lognormal": ("median", "sigma"),
+                     "exponential": ("mean",)}
+
+    # How often the output is written
+    OUTPUT_INTERVAL = 1.0
+
+    PAGE_SIZE = 4096
+
+    def __init__(self, settings):
+        unknown = set(settings) - set(self.SETTINGS)
+        if unknown:
+            raise RuntimeError("Unknown fake Sisyphus settings: {0}".
+                               format(", ".join(sorted(unknown))))
+
+        self.runtime_seconds = self._runtime(settings.get("runtime_seconds", 0))
+        self.stdout_bytes = int(self._number(settings, "stdout_bytes", 0))
+        self.stderr_bytes = int(self._number(settings, "stderr_bytes", 0))
+        self.memory_mb = self._number(settings, "memory_mb", 0)
+        self.exit_codes = self._exit_codes(settings.get("exit_codes", 0))
+        self.crash_probability = self._probability(settings,
+                                                   "crash_probability")
+        self.hang_probability = self._probability(settings, "hang_probability")
+        self.seed = settings.get("seed")
+
+        if self.crash_probability + self.hang_probability > 1:
+            raise RuntimeError("crash_probability and hang_probability can't "
+                               "add up to more than 1")
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool)
+
+    @classmethod
+    def _number(cls, settings, name, default):
+        value = settings.get(name, default)
+        if not cls._is_number(value) or value < 0:
+            raise RuntimeError("{0} must be a number from 0".format(name))
+        return value
+
+    @classmethod
+    def _probability(cls, settings, name):
+        value = settings.get(name, 0)
+        if not cls._is_number(value) or not 0 <= value <= 1:
+            raise RuntimeError("{0} must be a number from 0 to 1".format(name))
+        return value
+
+    @classmethod
+    def _runtime(cls, value):
+        if not isinstance(value, dict):
+            return cls._number({"runtime_seconds": value}, "runtime_seconds", 0)
+
+        distribution = value.get("distribution")
+        if distribution not in cls.DISTRIBUTIONS:
+            raise RuntimeError("runtime_seconds distribution must be one of "
+                               "{0}".format(", ".join(sorted(cls.DISTRIBUTIONS))))
+
+        parameters = cls.DISTRIBUTIONS[distribution]
+        unknown = set(value) - set(parameters) - set(["distribution"])
+        if unknown:
+            raise RuntimeError("Unknown parameters of the {0} distribution: "
+                               "{1}".format(distribution,
+                                            ", ".join(sorted(unknown))))
+        for parameter in parameters:
+            cls._number(value, parameter, None)
+        if distribution == "uniform" and value["min"] > value["max"]:
+            raise RuntimeError("The uniform distribution's min can't be "
+                               "larger than its max")
+        return dict(value)
+
+    @classmethod
+    def _exit_codes(cls, value):
+        if not isinstance(value, dict):
+            value = {value: 1}
+
+        exit_codes = {}
+        for code, weight in value.items():
+            try:
+                code = int(code)
+            except (TypeError, ValueError):
+                code = -1
+            if not 0 <= code <= 255:
+                raise RuntimeError("exit_codes must be exit codes from 0 "
+                                   "to 255")
+            if not cls._is_number(weight) or weight < 0:
+                raise RuntimeError("The weights of exit_codes must be "
+                                   "numbers from 0")
+            exit_codes[code] = weight
+
+        if not sum(exit_codes.values()) > 0:
+            raise RuntimeError("exit_codes must have a weight above 0")
+        return exit_codes
+
+    @staticmethod
+    def settings_for(conf, name):
+        """ Helper method for returning the settings of a script from the
+            `fake_sisyphus` section of an app config.
+        """
+        settings = dict(conf.get("fake_sisyphus") or {})
+        overrides = settings.pop("scripts", None) or {}
+        settings.update(overrides.get(name) or {})
+        return settings
+
+    def random_for(self, name, argv):
+        """ The random generator of a run of the script; seeded from the seed
+            and the arguments, if there is a seed.
+        """
+        if self.seed is None:
+            return random.Random()
+        key = "{0}:{1}:{2}".format(self.seed, name, " ".join(argv))
+        return random.Random(int(hashlib.md5(key).hexdigest(), 16))
+
+    def draw_runtime(self, rng):
+        value = self.runtime_seconds
+        if not isinstance(value, dict):
+            return value
+
+        distribution = value["distribution"]
+        if distribution == "uniform":
+            seconds = rng.uniform(value["min"], value["max"])
+        elif distribution == "normal":
+            seconds = rng.gauss(value["mean"], value["stddev"])
+        elif distribution == "lognormal":
+            seconds = rng.lognormvariate(math.log(value["median"] or 1e-9),
+                                         value["sigma"])
+        else:
+            seconds = rng.expovariate(1.0 / value["mean"]) \
+                if value["mean"] else 0.0
+        return max(0.0, seconds)
+
+    def draw_outcome(self, rng):
+        """ How a run of the script ends: ("crash", None), ("hang", None) or
+            ("exit", exit code).
+        """
+        draw = rng.random()
+        if draw < self.crash_probability:
+            return "crash", None
+        if draw < self.crash_probability + self.hang_probability:
+            return "hang", None
+
+        draw = rng.uniform(0, sum(self.exit_codes.values()))
+        for code, weight in sorted(self.exit_codes.items()):
+            draw -= weight
+            if draw <= 0 and weight > 0:
+                return "exit", code
+        return "exit", max(code for code, weight in self.exit_codes.items()
+                           if weight > 0)
+
+    @staticmethod
+    def _write(stream, name, nr_bytes):
+        line = "{0}: fake Sisyphus output\n".format(name)
+        text = line * (nr_bytes // len(line) + 1)
+        stream.write(text[:nr_bytes])
+        stream.flush()
+
+    def run(self, name, argv):
+        """ Act as the script, and return its exit code.
+
+            Args:
+                name: the name of the script
+                argv: the arguments the script was called with
+        """
+        rng = self.random_for(name, argv)
+        runtime = self.draw_runtime(rng)
+        outcome, exit_code = self.draw_outcome(rng)
+
+        # A crash or hang happens somewhere in the middle of the run
+        stop_at = runtime * rng.uniform(0.1, 0.9) \
+            if outcome != "exit" else runtime
+
+        memory = bytearray(int(self.memory_mb * 1024 * 1024))
+        for i in xrange(0, len(memory), self.PAGE_SIZE):
+            memory[i] = 1
+
+        steps = max(1, int(math.ceil(runtime / self.OUTPUT_INTERVAL)))
+        start = time.time()
+        for step in xrange(steps):
+            if time.time() - start >= stop_at and step > 0:
+                break
+            self._write(sys.stdout, name, self.stdout_bytes // steps +
+                        (step < self.stdout_bytes % steps))
+            self._write(sys.stderr, name, self.stderr_bytes // steps +
+                        (step < self.stderr_bytes % steps))
+            time.sleep(max(0.0, min(start + stop_at,
+                                    start + (step + 1) * runtime / steps) -
+                           time.time()))
+
+        if outcome == "crash":
+            os.kill(os.getpid(), signal.SIGSEGV)
+        elif outcome == "hang":
+            while True:
+                time.sleep(3600)
+
+        return exit_code
+
+
+# The app config entries of the Sisyphus scripts, and the names of the scripts
+SCRIPTS = {"report_bin": "quickReport.pl",
+           "qc_bin": "qcValidateRun.pl",
+           "aeacus_stats": "aeacus-stats.pl",
+           "aeacus_reports": "aeacus-reports.pl",
+           "checkindices": "checkIndices.pl",
+           "version_bin": "version.pl"}
+
+VERSION_SCRIPT = "version.pl"
+VERSION = "fake-sisyphus"
+
+SCRIPT_TEMPLATE = """#!{python}
+# A fake {name}, generated by siswrap.fake_sisyphus
+import sys
+sys.path.insert(0, {package_root!r})
+from siswrap.fake_sisyphus import run_script
+sys.exit(run_script({name!r}, {settings!r}, sys.argv[1:]))
+"""
+
+
+def run_script(name, settings, argv):
+    """ The entry point of the generated scripts.
+
+        Args:
+            name: the name of the Sisyphus script that is faked
+            settings: the settings of the script, as JSON
+            argv: the arguments the script was called with
+
+        Returns:
+            the exit code of the script
+    """
+    if name == VERSION_SCRIPT:
+        print VERSION
+        return 0
+    return FakeScript(json.loads(settings)).run(name, argv)
+
+
+def generate(directory, conf, python=sys.executable):
+    """ Write a fake of every Sisyphus script that the service runs to a
+        directory, behaving as set in `fake_sisyphus` in the app config.
+
+        Args:
+            directory: where to write the scripts; created if it's missing
+            conf: the app config, as a dict
+            python: the Python interpreter to run the scripts with
+
+        Returns:
+            the app config entries that make the service run the scripts
+
+        Raises:
+            RuntimeError: if the settings of a script aren't valid
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    entries = {"perl": python}
+
+    for entry, name in sorted(SCRIPTS.items()):
+        settings = FakeScript.settings_for(conf, name)
+        # Fail here rather than when the script is run
+        FakeScript(settings)
+
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(SCRIPT_TEMPLATE.format(python=python, name=name,
+                                           package_root=package_root,
+                                           settings=json.dumps(settings)))
+        os.chmod(path, 0755)
+        entries[entry] = path
+
+    return entries
+
+
+def start():
+    parser = ArgumentParser(description="Writes a fake Sisyphus toolkit, and "
+                                        "an app config that uses it")
+    parser.add_argument("--app-config", dest="app_config", metavar="APP_CONFIG",
+                        default=os.path.join("/etc", "arteria", "siswrap",
+                                             "app.config"),
+                        help="the app config with the fake_sisyphus settings")
+    parser.add_argument("--output-dir", dest="output_dir", metavar="OUTPUT_DIR",
+                        required=True, help="where to write the scripts")
+    parser.add_argument("--write-config", dest="write_config",
+                        metavar="PATH", help="write a copy of the app config "
+                                             "that uses the scripts here")
+    args = parser.parse_args()
+
+    with open(args.app_config) as f:
+        conf = yaml.safe_load(f)
+
+    try:
+        entries = generate(args.output_dir, conf)
+    except RuntimeError, err:
+        parser.error(str(err))
+
+    if args.write_config:
+        conf.update(entries)
+        with open(args.write_config, "w") as f:
+            yaml.safe_dump(conf, f, default_flow_style=False)
+    else:
+        print yaml.safe_dump(entries, default_flow_style=False),
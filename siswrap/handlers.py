@@ -1,10 +1,14 @@
+import os
 import jsonpickle
-import json
+import time
 import arteria
 import tornado.web
+from tornado import gen
+from tornado.iostream import StreamClosedError
 from arteria.web.handlers import BaseRestHandler
-from arteria.web.state import State
-from wrapper_services import ProcessService, Wrapper, ProcessInfo
+from wrapper_services import ProcessService, Wrapper, ProcessInfo, State, \
+    ConflictError
+from siswrap.pipelines import Pipeline, PipelineStep
 from siswrap import __version__ as siswrap_version
 
 
@@ -14,12 +18,24 @@ class BaseSiswrapHandler(BaseRestHandler):
 
     HTTP_OK = 200
     HTTP_ACCEPTED = 202
+    HTTP_CONFLICT = 409
     HTTP_ERROR = 500
 
+    # Requests that are held open on purpose, like long polls and log
+    # streams, are left out of the request latencies
+    held_open = False
+
     # FIXME: This should probably be documented in arteria core.
-    def initialize(self, process_svc, config_svc):
+    def initialize(self, process_svc, config_svc, version_svc):
         self.process_svc = process_svc
         self.config_svc = config_svc
+        self.version_svc = version_svc
+
+    def on_finish(self):
+        if self.held_open:
+            return
+        self.process_svc.metrics.request_finished(type(self).__name__,
+                                                  self.request.request_time())
 
     def write_status(self, proc_info):
         """
@@ -35,12 +51,16 @@ class BaseSiswrapHandler(BaseRestHandler):
         # Write output for specific process
         state = proc_info.get("state")
 
-        if state == State.STARTED:
+        if state == State.QUEUED:
+            reason = "OK - waiting in queue"
+        elif state == State.STARTED:
             reason = "OK - still processing"
         elif state == State.DONE:
             reason = "OK - finished processing"
         elif state == State.ERROR:
             reason = "OK - but an error occured while processing"
+        elif state == State.TIMEOUT:
+            reason = "OK - but the process was stopped by the watchdog"
         # Write output for all processes
         else:
             reason = "OK"
@@ -60,9 +80,18 @@ class BaseSiswrapHandler(BaseRestHandler):
         http_code = self.HTTP_OK
         reason = "OK"
 
-        if state == State.STARTED:
+        if proc_info.get("cached") and state == State.DONE:
+            http_code = self.HTTP_OK
+            reason = "OK - result of an earlier identical job"
+        elif proc_info.get("coalesced") and state in [State.STARTED, State.QUEUED]:
+            http_code = self.HTTP_ACCEPTED
+            reason = "Request accepted - identical job already submitted"
+        elif state == State.STARTED:
             http_code = self.HTTP_ACCEPTED
             reason = "Request accepted"
+        elif state == State.QUEUED:
+            http_code = self.HTTP_ACCEPTED
+            reason = "Request accepted - waiting in queue"
         else:
             http_code = self.HTTP_ERROR
             reason = "An unexpected error occurred"
@@ -70,12 +99,113 @@ class BaseSiswrapHandler(BaseRestHandler):
         self.set_status(http_code, reason)
         self.write_object(proc_info)
 
+    def job_response(self, wrapper, result):
+        """ The response for a submitted job.
+
+            Args:
+                wrapper: the wrapper object that was submitted
+                result: the wrapper object that ProcessService.run returned
+                        for it
+        """
+        self.append_status_link(result)
+        response = {"job_id": result.info.job_id,
+                    "pid": result.info.pid,
+                    "state": result.info.state,
+                    "host": result.info.host,
+                    "runfolder": result.info.runfolder,
+                    "link": result.info.link,
+                    "msg": result.info.msg,
+                    "queue_position": result.info.queue_position,
+                    "priority": result.info.priority,
+                    "coalesced": result is not wrapper,
+                    "cached": result.cached,
+                    "service_version": siswrap_version,
+                    "sisyphus_version": self.version_svc.get()}
+        response.update(result.info.timings())
+        return response
+
+    def force_argument(self):
+        return self.get_argument("force", "false").lower() == "true"
+
+    @staticmethod
+    def priority_argument(body):
+        """ Picks out the priority class asked for in a JSON request body.
+
+            Returns:
+                high, normal or low, or None if no priority was given
+
+            Raises:
+                RuntimeError if the priority isn't one of the classes
+        """
+        priority = body.get("priority")
+        if priority is not None:
+            ProcessService.check_priority(priority)
+        return priority
+
+    @staticmethod
+    def wrapper_parameters(wrapper_type, body):
+        """ Picks out the input parameters to the wrapper type in question from
+            a JSON request body.
+
+            Args:
+                wrapper_type: specifies whether or not to look for a qc_config
+                              in the body.
+                body: the dict parsed from the JSON body
+
+            Returns:
+                A dict with the runfolder, and if given: the Sisyphus config
+                and the QC config.
+
+            Raises:
+                RuntimeError if the runfolder or qc_config are missing or empty
+        """
+        params = {}
+
+        if not isinstance(body.get("runfolder"), basestring) or \
+                not body["runfolder"].strip():
+            raise RuntimeError("runfolder can't be empty value!")
+        params["runfolder"] = body["runfolder"].strip()
+
+        if wrapper_type == "qc":
+            if isinstance(body.get("qc_config"), basestring) and \
+                    body["qc_config"].strip():
+                params["qc_config"] = body["qc_config"]
+            else:
+                raise RuntimeError("qc_config can't be empty value!")
+
+        if "sisyphus_config" in body and body["sisyphus_config"].strip():
+            params["sisyphus_config"] = body["sisyphus_config"]
+
+        return params
+
     def append_status_link(self, wrapper):
         wrapper.info.link = self.create_status_link(wrapper.type_txt,
-                                                    wrapper.info.pid)
+                                                    wrapper.info.job_id)
+
+    def create_status_link(self, wrapper, job_id):
+        return "%s/%s/status/%s" % (self.api_link(), wrapper, job_id)
 
-    def create_status_link(self, wrapper, pid):
-        return "%s/%s/status/%s" % (self.api_link(), wrapper, pid)
+    def pipeline_response(self, pipeline):
+        """ The response for a pipeline, with the state of each of its steps.
+        """
+        steps = []
+
+        for step in pipeline.steps.values():
+            info = step.wrapper.info
+            steps.append({"name": step.name,
+                          "depends_on": step.depends_on,
+                          "job_id": info.job_id,
+                          "state": info.state,
+                          "msg": info.msg,
+                          "link": self.create_status_link(step.name, info.job_id)
+                                  if info.job_id is not None else None})
+
+        return {"pipeline_id": pipeline.pipeline_id,
+                "runfolder": pipeline.steps.values()[0].wrapper.info.runfolder,
+                "state": pipeline.state,
+                "link": "%s/pipeline/status/%s" % (self.api_link(),
+                                                   pipeline.pipeline_id),
+                "steps": steps}
 
 
 class RunHandler(BaseSiswrapHandler):
@@ -96,29 +226,15 @@ class RunHandler(BaseSiswrapHandler):
                 the QC config.
         """
 
-        params = {}
         expect_param = ["runfolder"]
 
         if wrapper_type == "qc":
             expect_param = expect_param + ["qc_config"]
 
         body = self.body_as_object(expect_param)
+        return self.wrapper_parameters(wrapper_type, body)
 
-        params["runfolder"] = body["runfolder"].strip()
-
-        if wrapper_type == "qc":
-            if body["qc_config"].strip():
-                params["qc_config"] = body["qc_config"]
-            else:
-                raise RuntimeError("qc_config can't be empty value!")
-
-        body = json.loads(self.request.body)
-
-        if "sisyphus_config" in body and body["sisyphus_config"].strip():
-            params["sisyphus_config"] = body["sisyphus_config"]
-
-        return params
-
+    @gen.coroutine
     def post(self, runfolder="/some/runfolder"):
         """ Start running Sisyphus quick report or quality control for specific
             runfolder.
@@ -130,11 +246,29 @@ class RunHandler(BaseSiswrapHandler):
                            Sisyphus root folder (mandatory for QC actions)
                 sisyphus_config: Supply a custom YAML config file that will overwrite then
                                  default bundled in Sisyphus. (optional)
+                priority: The priority class of the job: high, normal or low.
+                          Defaults to the one set for the wrapper type in the
+                          config, or normal. (optional)
+                Idempotency-Key: Header. A key identifying the request, so
+                                 that a retry of it gets the job it started.
+                                 (optional)
+                force: Query argument. Set to true to run the job even if an
+                       earlier identical job already has a result. (optional)
 
             Returns:
                 A status code HTTP 202 if the report generation or quality control
-                is initialised successfully, and a JSON response including a link
-                to the status page to poll. An error code HTTP 500 otherwise.
+                is initialised successfully, or queued until there is a free
+                slot, and a JSON response including a link to the status page
+                to poll.
+                If an identical job (same runfolder and configs, or the same
+                Idempotency-Key) is already queued or running, no new job is
+                started; that job is returned with coalesced set to true.
+                If an identical job has already finished successfully, and the
+                runfolder hasn't changed since, HTTP 200 and that job is
+                returned with cached set to true.
+                HTTP 400 if the priority isn't valid. An error code HTTP 409 if
+                the Idempotency-Key was used for a different job, and HTTP 500
+                otherwise.
 
             Raises:
                 RuntimeError if an empty POST body was sent in, or an unknown
@@ -145,54 +279,376 @@ class RunHandler(BaseSiswrapHandler):
             wrapper_type = Wrapper.url_to_type(url)
             wrapper_params = self.setup_wrapper_parameters(wrapper_type)
 
+            try:
+                priority = self.priority_argument(self.body_as_object())
+            except RuntimeError, err:
+                raise tornado.web.HTTPError(400, str(err))
+
             wrapper = Wrapper.new_wrapper(wrapper_type, wrapper_params, self.config_svc)
-            result = self.process_svc.run(wrapper)
+            wrapper.info.priority = priority
+            idempotency_key = self.request.headers.get("Idempotency-Key")
+            yield self.process_svc.take_fingerprints([wrapper])
+            result = self.process_svc.run(wrapper, idempotency_key,
+                                          self.force_argument())
+
+            self.write_accepted(self.job_response(wrapper, result))
+        except ConflictError, err:
+            raise tornado.web.HTTPError(self.HTTP_CONFLICT, str(err))
+        except RuntimeError, err:
+            raise tornado.web.HTTPError(500, "An error occurred: {0}".format(str(err)))
 
-            self.append_status_link(result)
-            resp = {"pid": result.info.pid,
-                    "state": result.info.state,
-                    "host": result.info.host,
-                    "runfolder": result.info.runfolder,
-                    "link": result.info.link,
-                    "msg": result.info.msg,
-                    "service_version": siswrap_version,
-                    "sisyphus_version": wrapper.sisyphus_version()}
 
-            self.write_accepted(resp)
+class BatchRunHandler(BaseSiswrapHandler):
+    """ Our handler for requesting the launch of many jobs at once, for
+        several runfolders and wrapper types.
+    """
+
+    MAX_BATCH_SIZE = 1000
+
+    def batch_items(self):
+        """ Parses and validates all the jobs in the request body together.
+            Every runfolder is only looked up once, however many jobs there
+            are for it.
+
+            Returns:
+                A tuple with a list of the wrapper type, the parameters and the
+                priority of each job, and a list of errors for the invalid
+                jobs.
+        """
+        try:
+            jobs = self.body_as_object(["jobs"])["jobs"]
+        except ValueError:
+            raise tornado.web.HTTPError(400, "The body must be a JSON object")
+
+        if not isinstance(jobs, list) or not jobs:
+            raise tornado.web.HTTPError(400, "jobs must be a non-empty list")
+        if len(jobs) > self.MAX_BATCH_SIZE:
+            raise tornado.web.HTTPError(400, "At most {0} jobs can be submitted "
+                                        "at once".format(self.MAX_BATCH_SIZE))
+
+        items = []
+        errors = []
+        existing = {}
+
+        for index, job in enumerate(jobs):
+            try:
+                if not isinstance(job, dict):
+                    raise RuntimeError("expected a JSON object")
+                if job.get("type") not in Wrapper.TYPES:
+                    raise RuntimeError("unknown wrapper type {0}".
+                                       format(job.get("type")))
+
+                params = self.wrapper_parameters(job["type"], job)
+                priority = self.priority_argument(job)
+                path = Wrapper.runfolder_path(self.config_svc, params["runfolder"])
+
+                if path not in existing:
+                    existing[path] = os.path.isdir(path)
+                if not existing[path]:
+                    raise RuntimeError("no runfolder {0} exists".format(path))
+
+                items.append((job["type"], params, priority))
+            except (RuntimeError, AttributeError), err:
+                errors.append({"job": index, "error": str(err)})
+
+        return items, errors
+
+    @gen.coroutine
+    def post(self):
+        """ Start running many Sisyphus jobs at once, e.g. all the tools for
+            all the runfolders of a sequencer batch.
+
+            Args:
+                jobs: A list of jobs, each with the wrapper type (qc, report,
+                      aeacusstats, aeacusreports or checkindices), the
+                      runfolder, and the qc_config, sisyphus_config and
+                      priority like for a single run. (mandatory)
+                force: Query argument. Set to true to run the jobs even if
+                       earlier identical jobs already have results. (optional)
+
+            Returns:
+                A status code HTTP 202, and a JSON response with a list of
+                jobs, with the same fields as for a single run, in the order
+                they were given. The jobs are validated together, and none of
+                them is started if any is invalid; HTTP 400 and a list of the
+                errors, with the index of each invalid job, is returned then.
+                HTTP 500 if the jobs couldn't be queued.
+        """
+        items, errors = self.batch_items()
+
+        if errors:
+            self.set_status(400, "Invalid jobs in batch")
+            self.write_object({"errors": errors})
+            return
+
+        try:
+            wrappers = []
+            for wrapper_type, params, priority in items:
+                wrapper = Wrapper.new_wrapper(wrapper_type, params, self.config_svc,
+                                              runfolder_checked=True)
+                wrapper.info.priority = priority
+                wrappers.append(wrapper)
+            yield self.process_svc.take_fingerprints(wrappers)
+            results = self.process_svc.run_batch(wrappers, self.force_argument())
         except RuntimeError, err:
             raise tornado.web.HTTPError(500, "An error occurred: {0}".format(str(err)))
 
+        self.set_status(self.HTTP_ACCEPTED, "Request accepted")
+        self.write_object({"jobs": [self.job_response(submitted, result)
+                                    for submitted, result in zip(wrappers, results)]})
+
+
+class PipelineRunHandler(BaseSiswrapHandler):
+    """ Our handler for requesting a chain of Sisyphus steps for a runfolder,
+        where the service starts each step as soon as the steps it depends on
+        are done.
+    """
+
+    def new_pipeline(self, body):
+        """ Creates the pipeline described by the request body.
+
+            Raises:
+                RuntimeError if the steps or their parameters are invalid
+                OSError if the runfolder doesn't exist
+        """
+        names = body.get("steps", list(Pipeline.DEFAULT_STEPS))
+        if not isinstance(names, list):
+            raise RuntimeError("steps must be a list")
+
+        params = self.wrapper_parameters(None, body)
+        priority = self.priority_argument(body)
+        path = Wrapper.runfolder_path(self.config_svc, params["runfolder"])
+        if not os.path.isdir(path):
+            raise OSError("No runfolder {0} exists.".format(path))
+
+        steps = []
+        for item in names:
+            if isinstance(item, dict):
+                name = item.get("type")
+                depends_on = item.get("after", [])
+            else:
+                name = item
+                depends_on = [steps[-1].name] if steps else []
+
+            if name not in Wrapper.TYPES:
+                raise RuntimeError("Unknown pipeline step {0}".format(name))
+            if not isinstance(depends_on, list):
+                raise RuntimeError("after must be a list of step names")
+
+            wrapper = Wrapper.new_wrapper(name, self.wrapper_parameters(name, body),
+                                          self.config_svc, runfolder_checked=True)
+            wrapper.info.priority = priority
+            steps.append(PipelineStep(wrapper, depends_on))
+
+        return Pipeline(steps)
+
+    @gen.coroutine
+    def post(self, runfolder="/some/runfolder"):
+        """ Start a pipeline of Sisyphus steps for a specific runfolder. Each
+            step is started as soon as the steps it depends on are done, and
+            the steps that depend on a failed step are cancelled.
+
+            Args:
+                runfolder: Which runfolder to run the pipeline for. (mandatory)
+                steps: A list of the steps to run, out of checkindices,
+                       aeacusstats, aeacusreports, qc and report. A step given
+                       by name depends on the step before it; a step given as
+                       {"type": <name>, "after": [<names>]} depends on the
+                       steps listed in after, which have to come before it.
+                       Defaults to the whole chain, in the order above.
+                       (optional)
+                qc_config: The QC XML config for the qc step. (mandatory if
+                           the pipeline has a qc step)
+                sisyphus_config: A custom YAML config for all the steps.
+                                 (optional)
+                priority: The priority class of all the steps. (optional)
+                force: Query argument. Set to true to run the steps even if
+                       earlier identical jobs already have results. (optional)
+
+            Returns:
+                A status code HTTP 202, and a JSON response with a link to the
+                pipeline status and the state of each step. HTTP 400 if the
+                steps or the priority are invalid, or the runfolder doesn't
+                exist.
+        """
+        body = self.body_as_object(["runfolder"])
+
+        try:
+            pipeline = self.new_pipeline(body)
+        except (RuntimeError, OSError, AttributeError), err:
+            raise tornado.web.HTTPError(400, "Invalid pipeline: {0}".format(err))
+
+        yield self.process_svc.run_pipeline(pipeline, self.force_argument())
+
+        self.set_status(self.HTTP_ACCEPTED, "Request accepted")
+        self.write_object(self.pipeline_response(pipeline))
+
+
+class PipelineStatusHandler(BaseSiswrapHandler):
+    """ Our handler for checking on the status of a pipeline and its steps.
+    """
+
+    def get(self, pipeline_id):
+        """ Get the status of a pipeline, with the state of each of its steps.
+            The steps can also be followed as single jobs, with the link of
+            each step.
+
+            Args:
+                pipeline_id: the id of the pipeline to check
+
+            Returns:
+                A JSON response with the state of the pipeline and its steps.
+                A finished pipeline is reported until pipeline_ttl seconds
+                after it finished.
+        """
+        pipeline = self.process_svc.get_pipeline(pipeline_id)
+
+        if pipeline is None:
+            resp = {"pipeline_id": int(pipeline_id), "state": State.NONE,
+                    "msg": "No such pipeline exists"}
+        else:
+            resp = self.pipeline_response(pipeline)
+
+        self.write_status(resp)
+
 
 class StatusHandler(BaseSiswrapHandler):
     """ Our handler for checking on the status of the report generation or
         quality control.
     """
-    def get(self, pid):
+
+    DEFAULT_MAX_WAIT = 300
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    LISTING_ARGUMENTS = ("state", "runfolder", "submitted_after", "limit",
+                         "cursor")
+
+    def wait_arguments(self):
+        """ Parses the optional long-poll arguments of the request.
+
+            Returns:
+                A tuple with the number of seconds to wait, capped by
+                max_status_wait in the config, and the state to wait for the
+                job to leave (None for its current state).
+        """
+        try:
+            wait = float(self.get_argument("wait", 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "wait must be a number of seconds")
+
+        max_wait = self.config_svc.get_app_config().get("max_status_wait",
+                                                         self.DEFAULT_MAX_WAIT)
+        return min(max(wait, 0), max_wait), self.get_argument("since_state", None)
+
+    @staticmethod
+    def parse_time(value):
+        """ Parses a UNIX time, or a local time like 2016-08-24T13:00:00.
+        """
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+        try:
+            return time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "submitted_after must be a UNIX "
+                                        "time or YYYY-MM-DDTHH:MM:SS")
+
+    def listing_arguments(self):
+        """ Parses the optional filter and paging arguments of a listing.
+
+            Returns:
+                A dict with the arguments for ProcessService.list_jobs, or
+                None if none of the arguments were given.
+        """
+        if all(self.get_argument(name, None) is None
+               for name in self.LISTING_ARGUMENTS):
+            return None
+
+        try:
+            limit = int(self.get_argument("limit", self.DEFAULT_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise tornado.web.HTTPError(400, "limit must be a positive number")
+
+        states = self.get_argument("state", None)
+        submitted_after = self.get_argument("submitted_after", None)
+
+        return {"states": states.split(",") if states else None,
+                "runfolder": self.get_argument("runfolder", None),
+                "submitted_after": (self.parse_time(submitted_after)
+                                    if submitted_after else None),
+                "cursor": self.get_argument("cursor", None),
+                "limit": min(limit, self.MAX_PAGE_SIZE)}
+
+    @gen.coroutine
+    def get(self, job_id):
         """ Get the status for a Sisyphus quick report or quality control run.
 
                 Args:
-                    id: The ID of the process to check status of.
+                    id: The job ID of the process to check status of, as
+                    given in the link when it was started.
                     Or empty if all processes should be returned.
+                    wait: Query argument. Hold the request for up to this many
+                          seconds until the state of the process changes.
+                          (optional)
+                    since_state: Query argument. Used with wait; the state to
+                                 wait for the process to leave. Defaults to the
+                                 state it has when the request arrives.
+                                 (optional)
+
+                When listing all processes, any of these query arguments
+                lists the job history instead, a page at a time, newest first:
+                    state: Only jobs in this state, or in one of several
+                           comma separated states. (optional)
+                    runfolder: Only jobs for this runfolder. (optional)
+                    submitted_after: Only jobs submitted after this UNIX time
+                                     or YYYY-MM-DDTHH:MM:SS. (optional)
+                    limit: The maximum number of jobs on the page. (optional,
+                           defaults to 100, at most 1000)
+                    cursor: The next_cursor of the previous page. (optional)
 
                 Returns:
                     JSON with fields that describe current status for requested
                     process. List of dicts with Current status of all the
-                    processes if input parameter was non-existant.
+                    processes if input parameter was non-existant, or a page
+                    of them and the next_cursor if listing arguments were
+                    given.
         """
         try:
             url = self.request.uri
             wrapper_type = Wrapper.url_to_type(url)
 
-            # Get status for a specific PID and wrapper type
-            if pid:
-                response = self.process_svc.get_status(int(pid), wrapper_type)
+            # Get status for a specific job and wrapper type
+            if job_id:
+                wait, since_state = self.wait_arguments()
+
+                if wait:
+                    self.held_open = True
+                    if since_state is None:
+                        since_state = self.process_svc.current_state(int(job_id),
+                                                                     wrapper_type)
+                    yield self.process_svc.wait_for_change(int(job_id), wrapper_type,
+                                                           since_state, wait)
+
+                response = self.process_svc.get_status(int(job_id), wrapper_type)
 
-                payload = {"pid": response.pid,
+                payload = {"job_id": response.job_id,
+                           "pid": response.pid,
                            "state": response.state,
                            "host": response.host,
                            "msg": response.msg,
                            "stdout": response.stdout,
-                           "stderr": response.stderr}
+                           "stderr": response.stderr,
+                           "profile": response.profile,
+                           "usage": response.usage,
+                           "priority": response.priority,
+                           "queue_position": response.queue_position,
+                           "effective_priority":
+                               self.process_svc.effective_priority(response)}
+                payload.update(response.timings())
 
                 # If the process was found then we also want to return
                 # the runfolder
@@ -203,8 +659,214 @@ class StatusHandler(BaseSiswrapHandler):
 
                 self.write_status(payload)
             else:
-                # If a specific PID wasn't requested then return all
+                # If a specific job wasn't requested then return all
                 # processes of the specific wrapper type
-                self.write_status({"statuses": self.process_svc.get_all(wrapper_type)})
+                listing = self.listing_arguments()
+
+                if listing is None:
+                    self.write_status({"statuses": self.process_svc.get_all(wrapper_type)})
+                else:
+                    try:
+                        self.write_status(self.process_svc.list_jobs(wrapper_type,
+                                                                     **listing))
+                    except ValueError, err:
+                        raise tornado.web.HTTPError(400, str(err))
+        except RuntimeError, err:
+            raise tornado.web.HTTPError(500, "An error occurred: {0}".format(str(err)))
+
+
+class StopHandler(BaseSiswrapHandler):
+    """ Our handler for cancelling a report generation or quality control.
+    """
+
+    def post(self, job_id):
+        """ Cancel a Sisyphus job. A queued job is taken out of the queue. A
+            running job is stopped, together with every process it has
+            started: they are sent SIGTERM, and SIGKILL if they haven't
+            exited after cancel_grace_period seconds.
+
+                Args:
+                    id: The job ID of the process to cancel.
+
+                Returns:
+                    HTTP 200 and the status of the job if it was cancelled
+                    right away, or HTTP 202 if it is being stopped; poll the
+                    status link until its state is cancelled. HTTP 404 if
+                    there is no such job, and HTTP 409 if it has already
+                    finished, or has been started by a worker.
+        """
+        url = self.request.uri
+        wrapper_type = Wrapper.url_to_type(url)
+
+        try:
+            info = self.process_svc.cancel(int(job_id), wrapper_type)
+        except ConflictError, err:
+            raise tornado.web.HTTPError(self.HTTP_CONFLICT, str(err))
         except RuntimeError, err:
             raise tornado.web.HTTPError(500, "An error occurred: {0}".format(str(err)))
+
+        if info.state == State.NONE:
+            raise tornado.web.HTTPError(404, "No job {0} exists".format(job_id))
+
+        if info.state == State.STARTED:
+            self.set_status(self.HTTP_ACCEPTED, "Request accepted - stopping job")
+        else:
+            self.set_status(self.HTTP_OK, "OK - job was cancelled")
+
+        self.write_object({"job_id": info.job_id,
+                           "pid": info.pid,
+                           "state": info.state,
+                           "host": info.host,
+                           "runfolder": info.runfolder,
+                           "msg": info.msg,
+                           "link": self.create_status_link(wrapper_type,
+                                                           info.job_id)})
+
+
+class LogsHandler(BaseSiswrapHandler):
+    """ Our handler for following the output of a report generation or quality
+        control while it runs.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    KEEPALIVE_INTERVAL = 15
+
+    held_open = True
+
+    def log_arguments(self):
+        """ Parses the optional arguments of the request.
+
+            Returns:
+                A tuple with the name of the stream to follow, and the byte
+                offset to start at. A Last-Event-ID header sent by a
+                reconnecting client takes precedence over the offset argument.
+        """
+        stream = self.get_argument("stream", "stdout")
+        if stream not in ("stdout", "stderr"):
+            raise tornado.web.HTTPError(400, "stream must be stdout or stderr")
+
+        offset = self.request.headers.get("Last-Event-ID") or \
+            self.get_argument("offset", 0)
+        try:
+            offset = int(offset)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "offset must be a number of bytes")
+
+        return stream, max(offset, 0)
+
+    @staticmethod
+    def format_event(data, offset):
+        """ Formats a chunk of output as a Server-Sent Event, with the offset
+            after the chunk as the event id so a client can resume from it.
+        """
+        lines = "".join("data: {0}\n".format(line) for line in data.split("\n"))
+        return "id: {0}\n{1}\n".format(offset, lines)
+
+    def on_connection_close(self):
+        self.disconnected = True
+
+    @gen.coroutine
+    def get(self, job_id):
+        """ Stream the output of a Sisyphus quick report or quality control
+            run as Server-Sent Events. Each event holds one or more complete
+            lines, and has the byte offset after them as its id. The stream
+            ends with an "end" event when the process has exited and all of
+            its output has been sent. The log of a job that a worker runs is
+            followed until the job store has the job in a final state.
+
+                Args:
+                    id: The job ID of the process to follow.
+                    stream: Query argument. stdout or stderr. (optional,
+                            defaults to stdout)
+                    offset: Query argument. The byte offset in the log to
+                            start at. (optional, defaults to 0)
+
+                Returns:
+                    A text/event-stream with the output of the process, or
+                    HTTP 404 if there is no log for the process.
+        """
+        self.disconnected = False
+        url = self.request.uri
+        wrapper_type = Wrapper.url_to_type(url)
+        stream, offset = self.log_arguments()
+
+        path, output = self.process_svc.get_log(int(job_id), wrapper_type,
+                                                stream)
+
+        try:
+            log_file = open(path, "rb")
+        except IOError:
+            raise tornado.web.HTTPError(404, "No log found for job {0}".
+                                        format(job_id))
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+
+        try:
+            with log_file:
+                log_file.seek(offset)
+                pending = ""
+
+                while not self.disconnected:
+                    # Check if the job is done before reading, so that no
+                    # output written in between can be missed
+                    finished = output is None or output.closed
+                    pending += log_file.read(self.CHUNK_SIZE)
+
+                    # Only send complete lines, unless nothing more will come
+                    # or the line is too long to hold on to
+                    if finished or len(pending) >= self.CHUNK_SIZE:
+                        end = len(pending)
+                    else:
+                        end = pending.rfind("\n") + 1
+
+                    if end > 0:
+                        offset += end
+                        self.write(self.format_event(pending[:end], offset))
+                        pending = pending[end:]
+                        yield self.flush()
+                    elif finished:
+                        break
+                    elif not (yield output.wait_for_data(self.KEEPALIVE_INTERVAL)):
+                        # Keep the connection from being dropped as idle
+                        self.write(": keepalive\n\n")
+                        yield self.flush()
+
+            if not self.disconnected:
+                self.write("event: end\ndata: {0}\n\n".format(offset))
+                self.finish()
+        except StreamClosedError:
+            pass
+
+
+class MetricsHandler(BaseSiswrapHandler):
+    """ Our handler for the metrics of the service, to be scraped by
+        Prometheus.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def get(self):
+        """ Get the metrics of the jobs and the requests, in the Prometheus
+            text exposition format: the number of jobs started, finished and
+            failed per wrapper type, the time the jobs waited in the queue and
+            ran, the number of running and queued jobs, the number of open
+            file descriptors, and the time spent on the requests per handler.
+        """
+        self.set_header("Content-Type", self.CONTENT_TYPE)
+        self.write(self.process_svc.metrics.exposition())
+
+
+class VersionHandler(BaseSiswrapHandler):
+    """ Our handler for checking which versions of Siswrap and Sisyphus are
+        used.
+    """
+    def get(self):
+        """ Get the version of this service and of the Sisyphus installation it
+            runs.
+
+                Returns:
+                    JSON with the fields service_version and sisyphus_version.
+        """
+        self.write_object({"service_version": siswrap_version,
+                           "sisyphus_version": self.version_svc.get()})
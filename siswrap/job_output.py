@@ -0,0 +1,205 @@
+import os
+import time
+import errno
+import logging
+import datetime
+from collections import deque
+from functools import partial
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.locks import Condition
+
+""" Capture of the output from the Sisyphus scripts.
+"""
+
+
+class TailBuffer(object):
+    """ Keeps the last part of a stream in memory, so that the memory use stays
+        the same no matter how much has been written to it.
+
+        Args:
+            max_bytes: how many bytes from the end of the stream to keep
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._chunks = deque()
+        self._size = 0
+
+    def append(self, data):
+        if not data:
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+
+        # Drop whole chunks from the front as long as what is left is enough
+        while self._size - len(self._chunks[0]) >= self.max_bytes:
+            self._size -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return "".join(self._chunks)[-self.max_bytes:]
+
+
+class JobOutput(object):
+    """ Drains stdout and stderr of a running job on the IOLoop as the data
+        arrives, so the job can never block on a full pipe. Everything is
+        written to one log file per stream, and only a bounded tail of each
+        stream is kept in memory. `last_data_at` is the time output was last
+        written, or the time the job was started if it hasn't written any.
+
+        The log files are opened up front, so that a job whose logs can't be
+        written is never started. Give the process to `follow` once it has
+        been started, or call `discard` if it couldn't be.
+
+        Args:
+            process: a tornado.process.Subprocess started with its stdout and
+                     stderr set to Subprocess.STREAM, or None to `follow` it
+                     later
+            log_prefix: path prefix for the log files; the name of the stream
+                        is appended to it
+            tail_bytes: how many bytes from the end of each stream to keep in
+                        memory
+            logger: the Logger object in charge of printouts
+    """
+
+    STREAMS = ("stdout", "stderr")
+
+    def __init__(self, process, log_prefix, tail_bytes, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.paths = {}
+        self.tails = {}
+        self._files = {}
+        self._open_streams = len(self.STREAMS)
+        self._closed = Future()
+        self._new_data = Condition()
+        self.last_data_at = time.time()
+
+        try:
+            os.makedirs(os.path.dirname(log_prefix))
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        for name in self.STREAMS:
+            path = self.log_path(log_prefix, name)
+            # Unbuffered, so that the log can be followed while it's written
+            self._files[name] = open(path, "wb", 0)
+            self.paths[name] = path
+            self.tails[name] = TailBuffer(tail_bytes)
+
+        if process is not None:
+            self.follow(process)
+
+    def follow(self, process):
+        """ Start draining the streams of the process into the log files.
+        """
+        self.last_data_at = time.time()
+
+        for name in self.STREAMS:
+            log_file = self._files[name]
+            stream = getattr(process, name)
+            stream.read_until_close(
+                callback=partial(self._on_close, name, log_file),
+                streaming_callback=partial(self._on_data, name, log_file))
+
+    def discard(self):
+        """ Close the log files of a process that was never started.
+        """
+        for log_file in self._files.values():
+            log_file.close()
+
+    @staticmethod
+    def log_path(log_prefix, name):
+        return "{0}.{1}".format(log_prefix, name)
+
+    @property
+    def closed(self):
+        """ True when both streams have been read until they were closed.
+        """
+        return self._closed.done()
+
+    def wait_for_close(self):
+        """ Returns a Future which resolves when both streams have been closed.
+        """
+        return self._closed
+
+    def wait_for_data(self, timeout):
+        """ Returns a Future which resolves when more output has been written
+            to the log files, or the streams have been closed, or after
+            `timeout` seconds.
+        """
+        return self._new_data.wait(timeout=datetime.timedelta(seconds=timeout))
+
+    def tail(self, name):
+        return self.tails[name].getvalue()
+
+    def _on_data(self, name, log_file, data):
+        try:
+            log_file.write(data)
+        except IOError, err:
+            self.logger.error("Could not write {0} of job to {1}: {2}".
+                              format(name, self.paths[name], err))
+
+        self.tails[name].append(data)
+
+        if data:
+            self.last_data_at = time.time()
+            self._new_data.notify_all()
+
+    def _on_close(self, name, log_file, data):
+        self._on_data(name, log_file, data)
+        log_file.close()
+
+        self._open_streams -= 1
+        if self._open_streams == 0:
+            self._closed.set_result(None)
+            self._new_data.notify_all()
+
+
+class WorkerJobOutput(object):
+    """ The output of a job that a worker runs, followed through its log file
+        in the shared `job_log_root`. Offers the same `closed` and
+        `wait_for_data` as JobOutput, but as nothing is told when the worker
+        writes to the file or finishes the job, both are found by polling.
+
+        Args:
+            path: the path of the log file to follow
+            is_running: a function returning True as long as the job hasn't
+                        reached a final state
+            poll_interval: how often to look for more output, in seconds
+    """
+
+    def __init__(self, path, is_running, poll_interval):
+        self.path = path
+        self.is_running = is_running
+        self.poll_interval = poll_interval
+
+    @property
+    def closed(self):
+        """ True when the job has finished, so that nothing more will be
+            written to the log file.
+        """
+        return not self.is_running()
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return None
+
+    @gen.coroutine
+    def wait_for_data(self, timeout):
+        """ Resolves to True when the log file has grown or the job has
+            finished, or to False after `timeout` seconds without either.
+        """
+        deadline = time.time() + timeout
+        size = self._size()
+
+        while True:
+            yield gen.sleep(min(self.poll_interval,
+                                max(0, deadline - time.time())))
+            if self._size() != size or self.closed:
+                raise gen.Return(True)
+            if time.time() >= deadline:
+                raise gen.Return(False)
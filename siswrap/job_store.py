@@ -0,0 +1,418 @@
+import json
+import time
+import sqlite3
+import logging
+from siswrap.states import State
+
+""" Persistence of the jobs run by Siswrap.
+"""
+
+
+class JobStoreError(Exception):
+    """ Raised when a job store can't be read or written.
+    """
+    pass
+
+
+class JobStore(object):
+    """ Keeps a record of every job that has been submitted, so that the
+        history of the jobs survives restarts and isn't lost when a client
+        has read the status of a finished job.
+
+        A record is a dict with the fields id, type, runfolder, params, state,
+        pid, host, msg, stdout, stderr, submitted_at, updated_at, worker,
+        profile, priority, usage, started_at, finished_at and collected_at. The
+        id is given by the store when the job is first saved, and is never
+        reused, so it identifies the job for its whole life. The worker is
+        set for jobs that have been claimed by a worker, the profile is the
+        execution profile the job's process was started with, the priority
+        is the job's priority class, and the usage is what its process has
+        used of CPU, memory and I/O. The times are UNIX times, and are None
+        until the job has got that far.
+
+        A store that is shared between hosts also works as the queue that
+        workers claim jobs from.
+
+        Backends are picked with `job_store` in the app config.
+    """
+
+    # The states that a job is claimed from and to
+    CLAIMABLE_STATE = State.QUEUED
+    CLAIMED_STATE = State.STARTED
+
+    def save(self, wrapper):
+        """ Insert or update the record of a job. A job that hasn't been saved
+            before gets its id set in `wrapper.info.job_id`.
+        """
+        raise NotImplementedError
+
+    def save_many(self, wrappers):
+        """ Save several jobs at once. Either all of them are saved, or none.
+        """
+        for wrapper in wrappers:
+            self.save(wrapper)
+
+    def mark(self, job_id, state, msg, from_state=None):
+        """ Update the state and message of a job that isn't in memory, and
+            set the time it finished.
+
+            Args:
+                job_id: the id of the job
+                state: the new state, which the job has finished in
+                msg: the new message
+                from_state: only update the job if it is in this state; as
+                            one statement, so that no worker can claim the
+                            job in between (optional)
+
+            Returns:
+                True if the job was updated
+        """
+        raise NotImplementedError
+
+    def get(self, wrapper_type, job_id):
+        """ The record of a job of a type, or None.
+        """
+        raise NotImplementedError
+
+    def get_many(self, job_ids):
+        """ The records of the jobs with the given ids, of any type.
+        """
+        raise NotImplementedError
+
+    def find(self, state, worker=None):
+        """ The records of all jobs in `state`, oldest first, optionally only
+            the ones claimed by `worker`.
+        """
+        raise NotImplementedError
+
+    def claim(self, worker, host, types=None, head_starts=None):
+        """ Claim the queued job that is first in line for a worker, so that
+            no other worker can claim it. The job is marked as started by the
+            worker.
+
+            Args:
+                worker: the id of the worker
+                host: the host the worker runs on
+                types: only claim a job of one of these types (optional)
+                head_starts: a dict with the number of seconds earlier than
+                             it was submitted that a job of each priority
+                             class counts as; a job without a class gets
+                             none (optional)
+
+            Returns:
+                the record of the claimed job, or None if there is no job to
+                claim
+        """
+        raise NotImplementedError
+
+    def query(self, wrapper_type, states=None, runfolder=None,
+              submitted_after=None, before_id=None, limit=100):
+        """ One page of the jobs of a type, newest first. The records don't
+            include stdout and stderr.
+
+            Args:
+                wrapper_type: the type of the jobs
+                states: only jobs in one of these states (optional)
+                runfolder: only jobs for this runfolder path (optional)
+                submitted_after: only jobs submitted after this UNIX time
+                                 (optional)
+                before_id: only jobs with a lower id than this; the id of the
+                           last job on the previous page (optional)
+                limit: the maximum number of jobs to return
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def create(configuration_svc, logger=None):
+        """ Helper method for returning the job store asked for in the config.
+        """
+        conf = configuration_svc.get_app_config()
+        backend = conf.get("job_store", "sqlite")
+
+        if backend == "sqlite":
+            return SQLiteJobStore(conf.get("job_store_path",
+                                           SQLiteJobStore.DEFAULT_PATH),
+                                  conf.get("job_store_journal_mode",
+                                           SQLiteJobStore.DEFAULT_JOURNAL_MODE),
+                                  logger)
+        else:
+            raise RuntimeError("Unknown job store requested: {0}".
+                               format(backend))
+
+
+class SQLiteJobStore(JobStore):
+    """ Job store in an embedded SQLite database. Every save is committed
+        right away. In WAL mode such a commit is cheap, and status reads are
+        never blocked by it. WAL doesn't work on network file systems though,
+        so the journal mode can be changed for a database on NFS.
+
+        Args:
+            path: the database file, or ":memory:" for a store that only lives
+                  as long as the process
+            journal_mode: the SQLite journal mode, e.g. WAL or DELETE
+            logger: the Logger object in charge of printouts
+    """
+
+    DEFAULT_PATH = "/tmp/siswrap_jobs.db"
+    DEFAULT_JOURNAL_MODE = "WAL"
+
+    FIELDS = ("id", "type", "runfolder", "params", "state", "pid", "host",
+              "msg", "stdout", "stderr", "submitted_at", "updated_at",
+              "worker", "profile", "priority", "usage", "started_at",
+              "finished_at", "collected_at")
+    LISTING_FIELDS = ("id", "type", "runfolder", "state", "pid", "host",
+                      "msg", "submitted_at", "updated_at", "worker", "priority",
+                      "usage", "started_at", "finished_at", "collected_at")
+
+    # The columns that have been added since the first version of the schema
+    ADDED_COLUMNS = (("worker", "TEXT"), ("profile", "TEXT"),
+                     ("priority", "TEXT"), ("usage", "TEXT"),
+                     ("started_at", "REAL"), ("finished_at", "REAL"),
+                     ("collected_at", "REAL"))
+
+    # SQLite allows at most 999 parameters in a statement
+    MAX_PARAMETERS = 500
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            runfolder TEXT,
+            params TEXT,
+            state TEXT NOT NULL,
+            pid INTEGER,
+            host TEXT,
+            msg TEXT,
+            stdout TEXT,
+            stderr TEXT,
+            submitted_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            worker TEXT,
+            profile TEXT,
+            priority TEXT,
+            usage TEXT,
+            started_at REAL,
+            finished_at REAL,
+            collected_at REAL);
+        CREATE INDEX IF NOT EXISTS jobs_type ON jobs (type);
+        CREATE INDEX IF NOT EXISTS jobs_type_state ON jobs (type, state);
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+        CREATE INDEX IF NOT EXISTS jobs_runfolder ON jobs (runfolder);
+        CREATE INDEX IF NOT EXISTS jobs_submitted_at ON jobs (submitted_at);
+    """
+
+    def __init__(self, path=":memory:", journal_mode=DEFAULT_JOURNAL_MODE,
+                 logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+
+        try:
+            self.db = sqlite3.connect(path)
+            self.db.row_factory = sqlite3.Row
+
+            # An in-memory database has no journal on disk to configure
+            if path != ":memory:":
+                mode = self.db.execute("PRAGMA journal_mode={0}".
+                                       format(journal_mode)).fetchone()[0]
+                if mode.lower() != journal_mode.lower():
+                    self.logger.warning("Job store {0} uses journal mode {1} "
+                                        "instead of {2}".format(path, mode,
+                                                                journal_mode))
+            # Durable enough with WAL, and doesn't sync on every commit
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(self.SCHEMA)
+
+            # Bring databases created by earlier versions up to date
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in self.ADDED_COLUMNS:
+                if column not in columns:
+                    self.db.execute("ALTER TABLE jobs ADD COLUMN {0} {1}".
+                                    format(column, column_type))
+        except sqlite3.Error, err:
+            raise JobStoreError("Could not open job store {0}: {1}".
+                                format(path, err))
+
+    def _record(self, row, fields=FIELDS):
+        record = dict(zip(fields, row))
+        if "params" in record:
+            record["params"] = json.loads(record["params"] or "{}")
+        if "profile" in record:
+            record["profile"] = json.loads(record["profile"] or "null")
+        if "usage" in record:
+            record["usage"] = json.loads(record["usage"] or "null")
+        return record
+
+    def _execute(self, sql, args=()):
+        try:
+            with self.db:
+                return self.db.execute(sql, args)
+        except sqlite3.Error, err:
+            raise JobStoreError("Job store {0} failed: {1}".
+                                format(self.path, err))
+
+    def _write(self, wrapper):
+        info = wrapper.info
+        now = time.time()
+
+        if info.job_id is None:
+            if info.submitted_at is None:
+                info.submitted_at = now
+            cursor = self.db.execute(
+                "INSERT INTO jobs (type, runfolder, params, state, pid, host, "
+                "msg, stdout, stderr, submitted_at, updated_at, profile, "
+                "priority, usage, started_at, finished_at, collected_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (wrapper.type_txt, info.runfolder,
+                 json.dumps(getattr(wrapper, "params", {})), info.state,
+                 info.pid, info.host, info.msg, info.stdout, info.stderr,
+                 info.submitted_at, now, json.dumps(info.profile),
+                 info.priority, json.dumps(info.usage), info.started_at,
+                 info.finished_at, info.collected_at))
+            info.job_id = cursor.lastrowid
+        else:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, pid = ?, host = ?, msg = ?, "
+                "stdout = ?, stderr = ?, updated_at = ?, profile = ?, "
+                "priority = ?, usage = ?, started_at = ?, finished_at = ?, "
+                "collected_at = ? WHERE id = ?",
+                (info.state, info.pid, info.host, info.msg, info.stdout,
+                 info.stderr, now, json.dumps(info.profile), info.priority,
+                 json.dumps(info.usage), info.started_at, info.finished_at,
+                 info.collected_at, info.job_id))
+
+    def save(self, wrapper):
+        self.save_many([wrapper])
+
+    def save_many(self, wrappers):
+        # All the jobs go in one transaction, so a batch costs a single commit
+        new = [wrapper for wrapper in wrappers if wrapper.info.job_id is None]
+
+        try:
+            with self.db:
+                for wrapper in wrappers:
+                    self._write(wrapper)
+        except sqlite3.Error, err:
+            # The inserts were rolled back, so the ids aren't valid
+            for wrapper in new:
+                wrapper.info.job_id = None
+            raise JobStoreError("Job store {0} failed: {1}".
+                                format(self.path, err))
+
+    def mark(self, job_id, state, msg, from_state=None):
+        where = "id = ?"
+        now = time.time()
+        args = [state, msg, now, now, job_id]
+
+        if from_state is not None:
+            where += " AND state = ?"
+            args.append(from_state)
+
+        cursor = self._execute("UPDATE jobs SET state = ?, msg = ?, "
+                               "updated_at = ?, finished_at = ? WHERE {0}".
+                               format(where), args)
+        return cursor.rowcount == 1
+
+    def get(self, wrapper_type, job_id):
+        row = self._execute("SELECT {0} FROM jobs WHERE id = ? AND type = ?".
+                            format(", ".join(self.FIELDS)),
+                            (job_id, wrapper_type)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def get_many(self, job_ids):
+        job_ids = list(job_ids)
+        records = []
+
+        for start in range(0, len(job_ids), self.MAX_PARAMETERS):
+            chunk = job_ids[start:start + self.MAX_PARAMETERS]
+            rows = self._execute("SELECT {0} FROM jobs WHERE id IN ({1})".
+                                 format(", ".join(self.FIELDS),
+                                        ", ".join("?" * len(chunk))),
+                                 chunk).fetchall()
+            records.extend(self._record(row) for row in rows)
+
+        return records
+
+    def find(self, state, worker=None):
+        where = "state = ?"
+        args = [state]
+
+        if worker is not None:
+            where += " AND worker = ?"
+            args.append(worker)
+
+        rows = self._execute("SELECT {0} FROM jobs WHERE {1} "
+                             "ORDER BY id".format(", ".join(self.FIELDS), where),
+                             args).fetchall()
+        return [self._record(row) for row in rows]
+
+    def claim(self, worker, host, types=None, head_starts=None):
+        where = "state = ?"
+        args = [self.CLAIMABLE_STATE]
+
+        if types is not None:
+            if not types:
+                return None
+            where += " AND type IN ({0})".format(", ".join("?" * len(types)))
+            args.extend(types)
+
+        order = "id"
+        if head_starts:
+            order = "submitted_at - CASE priority {0} ELSE 0 END, id".format(
+                " ".join("WHEN ? THEN ?" for _ in head_starts))
+            for priority, seconds in sorted(head_starts.items()):
+                args.extend([priority, seconds])
+
+        # Another worker can claim the same job in between the select and
+        # the update. Only one of the updates matches the queued state, so
+        # the loser just tries the next job.
+        while True:
+            row = self._execute("SELECT id FROM jobs WHERE {0} ORDER BY {1} "
+                                "LIMIT 1".format(where, order), args).fetchone()
+            if row is None:
+                return None
+
+            cursor = self._execute(
+                "UPDATE jobs SET state = ?, worker = ?, host = ?, msg = ?, "
+                "updated_at = ? WHERE id = ? AND state = ?",
+                (self.CLAIMED_STATE, worker, host,
+                 "Claimed by worker {0}".format(worker), time.time(), row[0],
+                 self.CLAIMABLE_STATE))
+
+            if cursor.rowcount == 1:
+                return self._record(self._execute(
+                    "SELECT {0} FROM jobs WHERE id = ?".
+                    format(", ".join(self.FIELDS)), (row[0],)).fetchone())
+
+    def query(self, wrapper_type, states=None, runfolder=None,
+              submitted_after=None, before_id=None, limit=100):
+        # The indexes on type and state include the id, so every page is a
+        # range scan from the cursor rather than a scan of the whole history
+        where = ["type = ?"]
+        args = [wrapper_type]
+
+        if states:
+            where.append("state IN ({0})".format(", ".join("?" * len(states))))
+            args.extend(states)
+        if runfolder is not None:
+            where.append("runfolder = ?")
+            args.append(runfolder)
+        if submitted_after is not None:
+            where.append("submitted_at > ?")
+            args.append(submitted_after)
+        if before_id is not None:
+            where.append("id < ?")
+            args.append(before_id)
+
+        rows = self._execute("SELECT {0} FROM jobs WHERE {1} "
+                             "ORDER BY id DESC LIMIT ?".
+                             format(", ".join(self.LISTING_FIELDS),
+                                    " AND ".join(where)),
+                             args + [limit]).fetchall()
+        return [self._record(row, self.LISTING_FIELDS) for row in rows]
+
+    def close(self):
+        self.db.close()
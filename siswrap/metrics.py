@@ -0,0 +1,239 @@
+import os
+import bisect
+from siswrap.states import State, FAILED_STATES
+
+""" Metrics of the service, in the Prometheus text exposition format.
+"""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").\
+            replace("\n", "\\n")
+
+    return "{" + ",".join("{0}=\"{1}\"".format(name, escape(value))
+                          for name, value in pairs) + "}"
+
+
+class Metric(object):
+    """ A metric with a fixed set of label names. A sample is kept for every
+        combination of label values that has been recorded.
+
+        Args:
+            name: the name of the metric
+            doc: what the metric measures
+            labels: the names of the labels (optional)
+    """
+
+    TYPE = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+
+    def samples(self):
+        """ The lines of the metric's samples, without the HELP and TYPE lines.
+        """
+        raise NotImplementedError
+
+    def exposition(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.doc),
+                 "# TYPE {0} {1}".format(self.name, self.TYPE)]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """ A count that only goes up.
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        super(Counter, self).__init__(name, doc, labels)
+        self._values = {}
+
+    def inc(self, label_values=(), amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, label_values=()):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        return ["{0}{1} {2}".format(self.name,
+                                    _format_labels(self.labels, label_values),
+                                    _format_value(value))
+                for label_values, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """ A value that is read when the metrics are collected, so that keeping
+        it up to date costs nothing.
+
+        Args:
+            collect: a function returning a dict with the value for each
+                     tuple of label values
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, doc, collect, labels=()):
+        super(Gauge, self).__init__(name, doc, labels)
+        self.collect = collect
+
+    def samples(self):
+        return ["{0}{1} {2}".format(self.name,
+                                    _format_labels(self.labels, label_values),
+                                    _format_value(value))
+                for label_values, value in sorted(self.collect().items())]
+
+
+class Histogram(Metric):
+    """ The distribution of a measured value, counted in buckets.
+
+        Args:
+            buckets: the increasing upper bounds of the buckets; a bucket
+                     for everything above them is added
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, doc, buckets, labels=()):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, label_values=()):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * len(self.buckets)
+            self._sums[label_values] = 0.0
+
+        # Only the bucket the value falls in is counted here; the cumulative
+        # counts are added up when the metrics are collected
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def count(self, label_values=()):
+        return sum(self._counts.get(label_values, []))
+
+    def samples(self):
+        lines = []
+
+        for label_values, counts in sorted(self._counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                lines.append("{0}_bucket{1} {2}".format(
+                    self.name,
+                    _format_labels(self.labels, label_values,
+                                   [("le", _format_value(float(bound)))]),
+                    total))
+
+            labels = _format_labels(self.labels, label_values)
+            lines.append("{0}_sum{1} {2}".format(
+                self.name, labels, _format_value(self._sums[label_values])))
+            lines.append("{0}_count{1} {2}".format(self.name, labels, total))
+
+        return lines
+
+
+class SiswrapMetrics(object):
+    """ The metrics of the jobs and the requests of the service. Recording a
+        job or a request is a dict lookup and a few additions; everything else
+        is done when the metrics are collected.
+
+        Args:
+            job_counts: a function returning a dict with the number of jobs
+                        in memory for each (state, wrapper type)
+    """
+
+    QUEUE_WAIT_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400,
+                          28800, 86400)
+    RUN_DURATION_BUCKETS = (10, 60, 300, 900, 1800, 3600, 7200, 14400, 28800,
+                            86400, 172800)
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, job_counts):
+        self.job_counts = job_counts
+
+        self.jobs_started = Counter(
+            "siswrap_jobs_started_total",
+            "Jobs whose process has been started.", ["type"])
+        self.jobs_finished = Counter(
+            "siswrap_jobs_finished_total",
+            "Jobs that have finished, by their final state.", ["type", "state"])
+        self.jobs_failed = Counter(
+            "siswrap_jobs_failed_total",
+            "Jobs that failed to start, or ended with an error or a timeout.",
+            ["type"])
+        self.queue_wait = Histogram(
+            "siswrap_job_queue_wait_seconds",
+            "Time from a job being queued until its process was started.",
+            self.QUEUE_WAIT_BUCKETS, ["type"])
+        self.run_duration = Histogram(
+            "siswrap_job_run_duration_seconds",
+            "Time from a job's process being started until it had exited.",
+            self.RUN_DURATION_BUCKETS, ["type"])
+        self.request_latency = Histogram(
+            "siswrap_request_duration_seconds",
+            "Time spent on the HTTP requests, by handler; long polls and "
+            "log streams are left out.",
+            self.LATENCY_BUCKETS, ["handler"])
+
+        self.metrics = [
+            self.jobs_started, self.jobs_finished, self.jobs_failed,
+            Gauge("siswrap_jobs_running", "Jobs whose process is running.",
+                  lambda: self._in_state(State.STARTED), ["type"]),
+            Gauge("siswrap_jobs_queued", "Jobs waiting in the queue.",
+                  lambda: self._in_state(State.QUEUED), ["type"]),
+            Gauge("siswrap_open_fds", "File descriptors open in the service.",
+                  self._open_fds),
+            self.queue_wait, self.run_duration, self.request_latency]
+
+    def _in_state(self, state):
+        return dict(((wrapper_type,), count) for (job_state, wrapper_type), count
+                    in self.job_counts().items() if job_state == state)
+
+    @staticmethod
+    def _open_fds():
+        try:
+            return {(): len(os.listdir("/proc/self/fd"))}
+        except OSError:
+            return {}
+
+    def job_started(self, wrapper_type, queued_at, started_at):
+        self.jobs_started.inc((wrapper_type,))
+        if queued_at is not None:
+            self.queue_wait.observe(max(0, started_at - queued_at),
+                                    (wrapper_type,))
+
+    def job_finished(self, wrapper_type, state, started_at, finished_at):
+        self.jobs_finished.inc((wrapper_type, state))
+        if state in FAILED_STATES:
+            self.jobs_failed.inc((wrapper_type,))
+        if started_at is not None:
+            self.run_duration.observe(max(0, finished_at - started_at),
+                                      (wrapper_type,))
+
+    def request_finished(self, handler, seconds):
+        self.request_latency.observe(seconds, (handler,))
+
+    def exposition(self):
+        """ All the metrics in the Prometheus text exposition format.
+        """
+        return "\n".join(metric.exposition() for metric in self.metrics) + "\n"
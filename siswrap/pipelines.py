@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from siswrap.wrapper_services import Wrapper
+from siswrap.states import State, FINISHED_STATES
+
+""" Chains of Sisyphus steps that are run by the service itself.
+"""
+
+
+class PipelineStep(object):
+    """ One step of a pipeline: a job, and the steps it has to wait for.
+
+        Until the job is submitted, the step is pending; after that its state
+        is the state of the job.
+
+        Args:
+            wrapper: the wrapper object of the job
+            depends_on: the names of the steps that have to be done before
+                        this one can be started
+    """
+
+    def __init__(self, wrapper, depends_on=()):
+        self.name = wrapper.type_txt
+        self.wrapper = wrapper
+        self.depends_on = list(depends_on)
+        self.submitted = False
+        wrapper.info.state = State.PENDING
+        wrapper.info.msg = "Waiting for the steps it depends on"
+
+    @property
+    def state(self):
+        return self.wrapper.info.state
+
+    def skip(self, failed_step):
+        self.wrapper.info.state = State.CANCELLED
+        self.wrapper.info.msg = "Not run, since step {0} did not finish " \
+                                "successfully".format(failed_step)
+
+
+class Pipeline(object):
+    """ A number of Sisyphus steps for a runfolder, where each step is started
+        as soon as the steps it depends on are done. The steps form a DAG; a
+        step may only depend on steps given before it, so there can't be any
+        cycles. If a step fails, the steps that depend on it, directly or
+        not, are cancelled, while independent steps carry on.
+
+        Pipelines are only kept in memory, and are dropped some time after
+        they have finished; see ProcessService.get_pipeline. Their steps are
+        ordinary jobs, and can be followed like any other job once they are
+        submitted.
+
+        Args:
+            steps: a list of PipelineSteps, in an order where every step comes
+                   after the steps it depends on
+
+        Raises:
+            RuntimeError: if a step depends on a step that isn't before it, or
+                          if there are two steps with the same name
+    """
+
+    DEFAULT_STEPS = (Wrapper.CHECK_INDICES_TYPE, Wrapper.AEACUS_STATS_TYPE,
+                     Wrapper.AEACUS_REPORTS_TYPE, Wrapper.QC_TYPE,
+                     Wrapper.REPORT_TYPE)
+
+    FINISHED_STATES = FINISHED_STATES
+
+    def __init__(self, steps):
+        self.pipeline_id = None
+        self.force = False
+        self.finished_at = None
+        self.steps = OrderedDict()
+
+        for step in steps:
+            if step.name in self.steps:
+                raise RuntimeError("Step {0} is in the pipeline twice".
+                                   format(step.name))
+            for dependency in step.depends_on:
+                if dependency not in self.steps:
+                    raise RuntimeError("Step {0} depends on {1}, which isn't "
+                                       "an earlier step".format(step.name,
+                                                                dependency))
+            self.steps[step.name] = step
+
+        if not self.steps:
+            raise RuntimeError("A pipeline needs at least one step")
+
+    @staticmethod
+    def chain(wrappers):
+        """ A pipeline where each step depends on the one before it.
+        """
+        steps = []
+        for wrapper in wrappers:
+            steps.append(PipelineStep(wrapper,
+                                      [steps[-1].name] if steps else []))
+        return Pipeline(steps)
+
+    def skip_blocked(self):
+        """ Cancel the pending steps that depend on a step that didn't finish
+            successfully.
+        """
+        for step in self.steps.values():
+            if step.state != State.PENDING:
+                continue
+
+            for dependency in step.depends_on:
+                if self.steps[dependency].state in (State.ERROR, State.CANCELLED,
+                                                    State.TIMEOUT):
+                    step.skip(dependency)
+                    break
+
+    def ready_steps(self):
+        """ The steps that haven't been submitted, and whose dependencies are
+            all done.
+        """
+        return [step for step in self.steps.values()
+                if not step.submitted and step.state == State.PENDING and
+                all(self.steps[dependency].state == State.DONE
+                    for dependency in step.depends_on)]
+
+    @property
+    def state(self):
+        states = [step.state for step in self.steps.values()]
+
+        if not all(state in self.FINISHED_STATES for state in states):
+            if all(state == State.PENDING for state in states):
+                return State.PENDING
+            return State.STARTED
+        elif all(state == State.DONE for state in states):
+            return State.DONE
+        else:
+            return State.ERROR
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED_STATES
@@ -0,0 +1,131 @@
+import os
+import errno
+import signal
+import logging
+from tornado.ioloop import IOLoop
+
+""" Detection of exiting child processes.
+"""
+
+
+class ChildReaper(object):
+    """ Reaps watched child processes as soon as they exit, and reports their
+        return codes on the IOLoop. A SIGCHLD handler wakes the IOLoops, which
+        then collects the exit status of every watched process that has
+        exited, so nobody has to poll the processes to find out.
+
+        Only the watched PIDs are waited for, so children started by other
+        means (e.g. subprocess.check_output) are left alone.
+
+        The return code follows the subprocess convention: the exit status of
+        the process, or the negative signal number if it was killed by a
+        signal. It's None if the exit status was lost, e.g. because something
+        else waited for the process first.
+        The resource usage of the process, and of the children it has waited
+        for, comes from wait4.
+    """
+
+    # What the Popen object of a process whose exit status was lost is left
+    # with
+    LOST_RETURNCODE = -1
+
+    _watched = {}
+    _initialized = False
+    _logger = logging.getLogger(__name__)
+
+    @classmethod
+    def initialize(cls):
+        """ Install the SIGCHLD handler. Has to be called from the main thread,
+            and is done automatically by the first call to `watch`.
+        """
+        if cls._initialized:
+            return
+
+        signal.signal(signal.SIGCHLD, cls._on_sigchld)
+        cls._initialized = True
+
+    @classmethod
+    def uninitialize(cls):
+        """ Restore the default SIGCHLD handler.
+        """
+        if not cls._initialized:
+            return
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        cls._initialized = False
+
+    @classmethod
+    def watch(cls, process, callback):
+        """ Call `callback` with the return code of `process` when it exits.
+
+            Args:
+                process: the subprocess.Popen to watch
+                callback: called on the current IOLoop with the return code
+                          (None if the exit status was lost) and the
+                          resource.struct_rusage of the process, or None if
+                          it couldn't be had
+        """
+        cls.initialize()
+        cls._watched[process.pid] = (process, callback, IOLoop.current())
+
+        # The process may already have exited before it was watched
+        cls._reap(process.pid)
+
+    @classmethod
+    def _on_sigchld(cls, signum, frame):
+        io_loops = set(io_loop for _, _, io_loop in cls._watched.values())
+        for io_loop in io_loops:
+            try:
+                io_loop.add_callback_from_signal(cls._reap_all)
+            except Exception:
+                # An IOLoop that has been closed can't take callbacks. The
+                # handler mustn't raise, as that would happen in whatever code
+                # the signal interrupted.
+                pass
+
+    @classmethod
+    def _reap_all(cls):
+        for pid in list(cls._watched.keys()):
+            cls._reap(pid)
+
+    @classmethod
+    def _reap(cls, pid):
+        if pid not in cls._watched:
+            return
+
+        try:
+            ret_pid, status, usage = os.wait4(pid, os.WNOHANG)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                return
+            # Somebody else has already waited for the process
+            cls._logger.error("Could not wait for process {0}: {1}".
+                              format(pid, err))
+            ret_pid, status, usage = pid, None, None
+
+        if ret_pid == 0:
+            return
+
+        process, callback, io_loop = cls._watched.pop(pid)
+
+        if status is None:
+            # Nothing is known about how the process ended, so it mustn't be
+            # taken for a success
+            returncode = process.returncode
+        elif os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+
+        # Let the Popen object know too, so it won't try to wait for the
+        # process itself
+        process.returncode = returncode if returncode is not None \
+            else cls.LOST_RETURNCODE
+
+        try:
+            io_loop.add_callback(callback, returncode, usage)
+        except RuntimeError, err:
+            # The IOLoop that watched the process has been closed; don't let
+            # that stop the other processes from being reaped
+            cls._logger.warning("Could not report exit of process {0}: {1}".
+                                format(pid, err))
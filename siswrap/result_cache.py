@@ -0,0 +1,253 @@
+import os
+import sys
+import stat
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from siswrap.wrapper_services import Wrapper
+
+""" Reuse of the results of earlier jobs for runfolders that haven't changed.
+"""
+
+
+class ResultCache(object):
+    """ Remembers which job produced a successful result for a fingerprint of
+        everything that goes into a job: the wrapper type, the runfolder, the
+        state of the runfolder's input files (sizes and mtimes), the digest of
+        the posted configs and the Sisyphus version. A new job with the same
+        fingerprint would give the same result, so the earlier job can be
+        handed out instead.
+
+        The cache only keeps job ids, and is kept in memory. The least
+        recently used entries are evicted when there are more than
+        `result_cache_max_entries`, and entries expire `result_cache_ttl`
+        seconds after they were added.
+
+        The input files are looked at in a background thread by
+        `fingerprint_all`, so that a slow file system doesn't hold up the
+        IOLoop, and at most `result_cache_max_input_entries` of them are
+        looked at. A job with more input files than that isn't cached.
+
+        Args:
+            configuration_svc: the ConfigurationService serving conf lookups
+            version_svc: the SisyphusVersionService telling the Sisyphus
+                         version in use
+            logger: the Logger object in charge of printouts
+    """
+
+    DEFAULT_MAX_ENTRIES = 1000
+    DEFAULT_TTL = 24 * 60 * 60
+    DEFAULT_MAX_INPUT_ENTRIES = 10000
+
+    # The files and directories in a runfolder that Sisyphus reads its input
+    # from. The configs are only looked at if they weren't posted with the job.
+    # The directories are the ones each step reads: the demultiplexed output
+    # in Unaligned, and the output of aeacus in Summary.
+    INPUT_FILES = ("RunInfo.xml", "runParameters.xml", "RunParameters.xml",
+                   "SampleSheet.csv", "RTAComplete.txt")
+    INPUT_DIRS = {
+        Wrapper.CHECK_INDICES_TYPE: ("InterOp", "Unaligned"),
+        Wrapper.AEACUS_STATS_TYPE: ("InterOp", "Unaligned"),
+        Wrapper.AEACUS_REPORTS_TYPE: ("InterOp", "Unaligned", "Summary"),
+        Wrapper.QC_TYPE: ("InterOp", "Unaligned", "Summary"),
+        Wrapper.REPORT_TYPE: ("InterOp", "Unaligned", "Summary")}
+    CONFIG_FILES = {"sisyphus_config": "sisyphus.yml",
+                    "qc_config": "sisyphus_qc.xml"}
+
+    def __init__(self, configuration_svc, version_svc, logger=None):
+        self.version_svc = version_svc
+        self.logger = logger or logging.getLogger(__name__)
+
+        conf = configuration_svc.get_app_config()
+        self.max_entries = conf.get("result_cache_max_entries",
+                                    self.DEFAULT_MAX_ENTRIES)
+        self.ttl = conf.get("result_cache_ttl", self.DEFAULT_TTL)
+        self.max_input_entries = conf.get("result_cache_max_input_entries",
+                                          self.DEFAULT_MAX_INPUT_ENTRIES)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            result = os.stat(path)
+        except OSError:
+            return None
+        return result.st_size, result.st_mtime
+
+    def _walk(self, runfolder, name, state):
+        """ Add the sizes and mtimes of the files under a directory in the
+            runfolder to `state`, in the same order every time.
+
+            Returns:
+                False if that made `state` longer than `max_input_entries`
+        """
+        pending = [name]
+        while pending:
+            relative = pending.pop()
+            try:
+                children = sorted(os.listdir(os.path.join(runfolder, relative)),
+                                  reverse=True)
+            except OSError:
+                continue
+
+            for child in children:
+                path = os.path.join(relative, child)
+                try:
+                    result = os.stat(os.path.join(runfolder, path))
+                except OSError:
+                    continue
+
+                if stat.S_ISDIR(result.st_mode):
+                    pending.append(path)
+                else:
+                    state.append((path, (result.st_size, result.st_mtime)))
+                    if len(state) > self.max_input_entries:
+                        return False
+
+        return True
+
+    def input_state(self, wrapper):
+        """ The sizes and mtimes of the input files of a job's runfolder.
+
+            Returns:
+                a list of (path, (size, mtime)) in the runfolder, or None if
+                there are more than `max_input_entries` input files
+        """
+        runfolder = wrapper.info.runfolder
+        state = []
+
+        names = list(self.INPUT_FILES)
+        names.extend(path for param, path in sorted(self.CONFIG_FILES.items())
+                     if param not in wrapper.params)
+
+        for name in names:
+            state.append((name, self._stat(os.path.join(runfolder, name))))
+
+        for name in self.INPUT_DIRS.get(wrapper.type_txt, ()):
+            if not self._walk(runfolder, name, state):
+                return None
+
+        return state
+
+    def _input_states(self, wrappers):
+        """ The input_state of each wrapper object. The jobs of a type for
+            the same runfolder and with the same configs posted have the same
+            inputs, so those are only looked at once.
+        """
+        states = {}
+        result = []
+
+        for wrapper in wrappers:
+            key = (wrapper.type_txt, wrapper.info.runfolder,
+                   tuple(sorted(param for param in self.CONFIG_FILES
+                                if param in wrapper.params)))
+            if key not in states:
+                states[key] = self.input_state(wrapper)
+            result.append(states[key])
+
+        return result
+
+    def _digest(self, wrapper, version, input_state):
+        if version is None:
+            return None
+
+        if input_state is None:
+            self.logger.debug("Not caching {0}/{1}, as it has too many input "
+                              "files".format(wrapper.type_txt,
+                                             wrapper.info.runfolder))
+            return None
+
+        digest = hashlib.sha1()
+        digest.update(repr((wrapper.type_txt, wrapper.info.runfolder,
+                            wrapper.config_digest(), version,
+                            input_state)))
+        return digest.hexdigest()
+
+    def fingerprint(self, wrapper):
+        """ The fingerprint of a job, or None if it can't be told (e.g. when
+            the Sisyphus version isn't known). The input files are looked at
+            right away; use `fingerprint_all` on the IOLoop.
+        """
+        return self._digest(wrapper, self.version_svc.get(),
+                            self.input_state(wrapper))
+
+    @gen.coroutine
+    def fingerprint_all(self, wrappers):
+        """ The fingerprints of a number of jobs, with their input files
+            looked at in a background thread.
+
+            Args:
+                wrappers: the wrapper objects to fingerprint
+
+            Returns:
+                a list with the fingerprint of each wrapper object, None
+                where it can't be told
+        """
+        # Nothing is ever cached with the cache turned off
+        version = self.version_svc.get()
+        if version is None or self.max_entries <= 0 or not wrappers:
+            raise gen.Return([None] * len(wrappers))
+
+        input_states = yield self._in_thread(self._input_states, wrappers)
+        raise gen.Return([self._digest(wrapper, version, input_state)
+                          for wrapper, input_state
+                          in zip(wrappers, input_states)])
+
+    @staticmethod
+    def _in_thread(func, *args):
+        """ Run a function in a thread of its own, and return a Future which
+            resolves on the current IOLoop with what it returned.
+        """
+        io_loop = IOLoop.current()
+        future = Future()
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception:
+                io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                io_loop.add_callback(future.set_result, result)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def get(self, fingerprint):
+        """ The id of the job with a result for the fingerprint, or None.
+        """
+        entry = self._entries.pop(fingerprint, None)
+        if entry is None:
+            return None
+
+        job_id, added = entry
+        if time.time() - added > self.ttl:
+            return None
+
+        # Move it to the end, as the most recently used
+        self._entries[fingerprint] = entry
+        return job_id
+
+    def put(self, fingerprint, job_id):
+        """ Remember that the job gave a successful result for the fingerprint.
+        """
+        if self.max_entries <= 0:
+            return
+
+        self._entries.pop(fingerprint, None)
+        self._entries[fingerprint] = (job_id, time.time())
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, fingerprint):
+        self._entries.pop(fingerprint, None)
+
+    def __len__(self):
+        return len(self._entries)
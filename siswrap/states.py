@@ -0,0 +1,20 @@
+from arteria.web.state import State as ArteriaState
+
+""" The states of the Siswrap jobs. Kept apart from the services, so that
+    every module can use them without importing the services.
+"""
+
+
+class State(ArteriaState):
+    """ The Arteria states, extended with the ones that only make sense for
+        the Siswrap job queue.
+    """
+    QUEUED = "queued"
+    TIMEOUT = "timeout"
+
+
+# The states that a job never leaves
+FINISHED_STATES = (State.DONE, State.ERROR, State.CANCELLED, State.TIMEOUT)
+
+# The finished states of the jobs that failed
+FAILED_STATES = (State.ERROR, State.TIMEOUT)
@@ -0,0 +1,102 @@
+import os
+
+""" Accounting of the resources used by the processes of the jobs.
+"""
+
+
+def read_proc(proc_root, *path):
+    """ The contents of a file in the proc file system, or None if it can't
+        be read, e.g. because the process has exited.
+    """
+    try:
+        with open(os.path.join(proc_root, *path)) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def proc_fields(text):
+    """ The numbers of a "name: value [unit]" file in the proc file system,
+        such as /proc/meminfo or /proc/<pid>/status, by name. The units are
+        left out; the sizes are in kB.
+    """
+    fields = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(":")
+        value = value.split()
+        if value and value[0].isdigit():
+            fields[name] = int(value[0])
+    return fields
+
+
+class ProcessUsage(object):
+    """ Collects what the process of a job has used, so that slow jobs can be
+        told apart as CPU bound, I/O bound or swapping.
+
+        While the job runs, its memory and I/O are sampled from the proc file
+        system. When its process has exited, the figures from wait4 are
+        added; these also cover the children that the process has waited for.
+
+        The usage of a job is a dict with some of these fields:
+
+            user_cpu_seconds, system_cpu_seconds: the CPU time used
+            max_rss_kb: the peak resident set size
+            block_input_ops, block_output_ops: the file system reads and writes
+                                               that went to disk
+            voluntary_context_switches: how often the process waited for
+                                        something, such as I/O
+            involuntary_context_switches: how often the process was preempted
+            rss_kb: the resident set size, when it was last sampled
+            read_bytes, write_bytes: the bytes read from and written to
+                                     storage, when it was last sampled
+
+        Args:
+            proc_root: where the proc file system is mounted
+    """
+
+    RUSAGE_FIELDS = (("user_cpu_seconds", "ru_utime"),
+                     ("system_cpu_seconds", "ru_stime"),
+                     ("max_rss_kb", "ru_maxrss"),
+                     ("block_input_ops", "ru_inblock"),
+                     ("block_output_ops", "ru_oublock"),
+                     ("voluntary_context_switches", "ru_nvcsw"),
+                     ("involuntary_context_switches", "ru_nivcsw"))
+    STATUS_FIELDS = (("rss_kb", "VmRSS"),
+                     ("max_rss_kb", "VmHWM"),
+                     ("voluntary_context_switches", "voluntary_ctxt_switches"),
+                     ("involuntary_context_switches",
+                      "nonvoluntary_ctxt_switches"))
+    IO_FIELDS = (("read_bytes", "read_bytes"),
+                 ("write_bytes", "write_bytes"))
+
+    def __init__(self, proc_root="/proc"):
+        self.proc_root = proc_root
+
+    @classmethod
+    def from_rusage(cls, rusage):
+        """ The usage from the resource.struct_rusage of an exited process.
+        """
+        usage = {}
+        for name, field in cls.RUSAGE_FIELDS:
+            value = getattr(rusage, field)
+            usage[name] = round(value, 3) if isinstance(value, float) else value
+        return usage
+
+    def sample(self, pid):
+        """ The usage of a running process, as far as it can be read.
+        """
+        usage = {}
+
+        # The io file is only readable by the owner of the process
+        for name, wanted in [("status", self.STATUS_FIELDS),
+                             ("io", self.IO_FIELDS)]:
+            text = read_proc(self.proc_root, str(pid), name)
+            if not text:
+                continue
+
+            fields = proc_fields(text)
+            for key, field in wanted:
+                if field in fields:
+                    usage[key] = fields[field]
+
+        return usage
@@ -0,0 +1,142 @@
+import os
+import socket
+import logging
+import logging.config
+from argparse import ArgumentParser
+from tornado.ioloop import IOLoop, PeriodicCallback
+from arteria.configuration import ConfigurationService
+from siswrap.job_store import JobStore, JobStoreError
+from siswrap.wrapper_services import ProcessService, ProcessInfo, Wrapper, \
+    State
+
+""" Workers that run the jobs queued in a job store shared with the Siswrap
+    front-ends, so that the jobs can be spread over several hosts.
+"""
+
+
+class Worker(object):
+    """ Runs the jobs that have been submitted to Siswrap front-ends with
+        `job_dispatch: workers` in their app config. The worker claims queued
+        jobs from the job store it shares with the front-ends, as long as it
+        has free slots for them, highest effective priority first, and runs
+        them with the ordinary wrappers. The progress of the jobs is saved in
+        the job store, where the front-ends pick it up.
+
+        The slots are set by `max_concurrent_jobs` and
+        `max_concurrent_jobs_per_type` in the worker's app config. Any number
+        of workers, on one host or several, can share a job store, as long as
+        each has its own worker id. The job store then has to be on a file
+        system that all of them can reach.
+
+        Args:
+            configuration_svc: the ConfigurationService serving conf lookups
+            job_store: the JobStore shared with the front-ends
+            worker_id: what the worker is known as in the job store. Defaults
+                       to the host name.
+            logger: the Logger object in charge of printouts
+    """
+
+    def __init__(self, configuration_svc, job_store, worker_id=None,
+                 logger=None):
+        self.conf_svc = configuration_svc
+        self.store = job_store
+        self.worker_id = worker_id or socket.gethostname()
+        self.logger = logger or logging.getLogger(__name__)
+        self.process_svc = ProcessService(configuration_svc, self.logger,
+                                          job_store, local_dispatch=True)
+        self.poll_interval = self.process_svc.worker_poll_interval
+        self._poller = None
+
+    def recover(self):
+        """ Mark the jobs that this worker was running when it went down as
+            failed, as they can't be followed anymore.
+        """
+        for record in self.store.find(State.STARTED, worker=self.worker_id):
+            self.store.mark(record["id"], State.ERROR,
+                            "The worker was restarted while the process "
+                            "was running")
+
+    def poll(self):
+        """ Claim queued jobs and start them, as long as there are free slots
+            for them.
+
+            Returns:
+                the number of jobs that were claimed
+        """
+        self._forget_finished()
+        claimed = 0
+
+        while True:
+            types = self.process_svc.free_types()
+            if not types:
+                break
+
+            try:
+                record = self.store.claim(self.worker_id,
+                                          ProcessService._host(), types,
+                                          self.process_svc.head_starts)
+            except JobStoreError, err:
+                self.logger.error("Could not claim a job: {0}".format(err))
+                break
+
+            if record is None:
+                break
+            claimed += 1
+
+            try:
+                wrapper = Wrapper.new_wrapper(record["type"], record["params"],
+                                              self.conf_svc)
+            except (OSError, RuntimeError), err:
+                self.store.mark(record["id"], State.ERROR,
+                                "Could not start job: {0}".format(err))
+                continue
+
+            self.logger.info("Worker {0} claimed job {1}/{2}".
+                             format(self.worker_id, record["type"],
+                                    record["id"]))
+            wrapper.info.job_id = record["id"]
+            wrapper.info.priority = record["priority"]
+            wrapper.info.queued_at = record["submitted_at"]
+            self.process_svc.enqueue(wrapper)
+            self.process_svc.dispatch()
+
+        return claimed
+
+    def _forget_finished(self):
+        # Nobody asks the worker for the status of its jobs, so the finished
+        # ones can be dropped; their states are in the job store
+        for state in ProcessInfo.FINISHED_STATES:
+            for wrapper in ProcessService.proc_queue.in_state(state):
+                ProcessService.proc_queue.remove(wrapper.info.job_id)
+
+    def start(self):
+        """ Start claiming jobs on the current IOLoop.
+        """
+        self.recover()
+        self._poller = PeriodicCallback(self.poll, self.poll_interval * 1000)
+        self._poller.start()
+        self.poll()
+
+    def stop(self):
+        if self._poller is not None:
+            self._poller.stop()
+
+
+def start():
+    parser = ArgumentParser(description="Runs the Siswrap jobs queued in a "
+                                        "shared job store")
+    parser.add_argument("--configroot", dest="configroot", metavar="CONFIGROOT",
+                        default=os.path.join("/etc", "arteria", "siswrap"))
+    parser.add_argument("--worker-id", dest="worker_id", metavar="WORKER_ID",
+                        help="what the worker is known as in the job store; "
+                             "has to be unique (default: the host name)")
+    args = parser.parse_args()
+
+    config_svc = ConfigurationService(
+        logger_config_path=os.path.join(args.configroot, "logger.config"),
+        app_config_path=os.path.join(args.configroot, "app.config"))
+    logging.config.dictConfig(config_svc.get_logger_config())
+
+    worker = Worker(config_svc, JobStore.create(config_svc), args.worker_id)
+    worker.start()
+    IOLoop.current().start()
@@ -4,28 +4,72 @@ import subprocess
 import shutil
 import time
 import re
+import threading
 from subprocess import check_output
 import logging
-from arteria.web.state import State
+from collections import deque, OrderedDict
+import functools
+import itertools
+import datetime
+import base64
+import hashlib
+import errno
+import signal
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Condition
+from tornado.process import Subprocess
+from siswrap.job_output import JobOutput, WorkerJobOutput
+from siswrap.job_store import JobStoreError, SQLiteJobStore
+from siswrap.reaper import ChildReaper
+from siswrap.admission import ResourceAdmission
+from siswrap.exec_profile import ExecutionProfile
+from siswrap.metrics import SiswrapMetrics
+from siswrap.usage import ProcessUsage
+from siswrap.states import State, FINISHED_STATES
 
 """ Simple wrapper for the Sisyphus tools suite.
 """
 
 
+class ConflictError(Exception):
+    """ Raised when a request clashes with a job that has already been
+        submitted.
+    """
+    pass
+
+
 class ProcessInfo(object):
     """Information about a process.
 
         State can be:
             none: Not ready for processing or invalid
             ready: Ready for processing by Arteria
+            queued: Waiting in the job queue for a free slot
             started: Arteria started processing the runfolder
             done: Arteria is done processing the runfolder
             error: Arteria started processing the runfolder but there was an
                    error; see property msg for details
+            cancelled: The job was cancelled before it finished
+            timeout: The process was stopped, since it ran for too long or
+                     stopped writing output
 
-        Also keeps track of other meta data for the process.
+        Also keeps track of other meta data for the process. The job_id is
+        the id the job got in the job store when it was submitted, and is
+        what the job is known by; the pid is only set while it has a process.
     """
 
+    CANCELLED_IN_QUEUE_MSG = "Job was cancelled while waiting in the queue"
+
+    FINISHED_STATES = FINISHED_STATES
+
+    # The durations between the times in the life of a job, from and to
+    DURATIONS = (("queue_seconds", "submitted_at", "started_at"),
+                 ("run_seconds", "started_at", "finished_at"),
+                 ("turnaround_seconds", "submitted_at", "finished_at"),
+                 ("collection_delay_seconds", "finished_at", "collected_at"))
+    TIMESTAMPS = ("submitted_at", "started_at", "finished_at", "collected_at")
+
     def __init__(self, runfolder=None, host=None, state=State.NONE,
                  proc=None, msg=None, pid=None):
         self.runfolder = runfolder
@@ -37,10 +81,38 @@ class ProcessInfo(object):
         self.link = None
         self.stdout = None
         self.stderr = None
+        self.queue_position = None
+        self.output = None
+        self.job_id = None
+        # The execution profile the process was started with
+        self.profile = None
+        # The priority class the job was queued with, and when it was first
+        # queued, for the priority aging
+        self.priority = None
+        self.queued_at = None
+        self.started_at = None
+        self.submitted_at = None
+        self.finished_at = None
+        self.collected_at = None
+        # What the process has used of CPU, memory and I/O; see ProcessUsage
+        self.usage = None
+        # The status of the job in the listing of its type, once it has
+        # finished; see ProcessService.get_all
+        self.listed_status = None
 
     def __str__(self):
         return "{0} {3}: {1}@{2}".format(self.state, self.runfolder,
-                                         self.host, self.pid)
+                                         self.host, self.job_id)
+
+    def set_queued(self, position):
+        """ Update the meta data for a job that is waiting for a free slot.
+        """
+        self.host = ProcessService._host()
+        self.state = State.QUEUED
+        self.msg = "Job is waiting in the queue"
+        self.queue_position = position
+        if self.queued_at is None:
+            self.queued_at = time.time()
 
     def set_started(self, process):
         """ Update the appropriate meta data for the process when it has been started.
@@ -50,15 +122,117 @@ class ProcessInfo(object):
         self.proc = process
         self.msg = "Process has been started"
         self.pid = process.pid
+        self.queue_position = None
+        self.started_at = time.time()
+
+    def set_cancelled(self):
+        """ Update the meta data for a job that was cancelled.
+        """
+        self.state = State.CANCELLED
+        self.msg = self.CANCELLED_IN_QUEUE_MSG if self.pid is None else \
+            "Job was cancelled while running"
+        self.queue_position = None
+        if self.finished_at is None:
+            self.finished_at = time.time()
+
+    def set_timed_out(self, reason):
+        """ Update the meta data for a job whose process was stopped by the
+            watchdog.
+        """
+        self.state = State.TIMEOUT
+        self.msg = "Process was stopped, since {0}.".format(reason)
+
+    def set_exited(self, returncode, stdout, stderr):
+        """ Update the meta data for the process when it has exited.
+
+            Args:
+                returncode: the return code of the process, negative if it
+                            was killed by a signal, or None if its exit
+                            status was lost
+                stdout: the tail of the process' stdout
+                stderr: the tail of the process' stderr
+        """
+        self.stdout = stdout
+        self.stderr = stderr
+        self.finished_at = time.time()
+
+        if returncode is None:
+            self.msg = "Process has exited, but its exit status was lost."
+            self.state = State.ERROR
+        elif returncode < 0:
+            self.msg = ("Process was terminated with "
+                        "Unix code {0}.").format(returncode)
+            self.state = State.ERROR
+        elif returncode == 0:
+            self.msg = ("Process was completed successfully with "
+                        "return code ") + str(returncode) + "."
+            self.state = State.DONE
+        else:
+            self.msg = "Process was completed successfully, " \
+                       "but encounted an error, with return " \
+                       "code {}.".format(returncode)
+            self.state = State.ERROR
 
     @staticmethod
-    def none_process(pid):
-        """  Return an empty process information container if a non valid PID
-             was requested.
+    def from_record(record):
+        """ Return a process information container for a job read from the
+            job store.
         """
-        return ProcessInfo(host=ProcessService._host(), pid=pid,
-                           state=State.NONE,
+        info = ProcessInfo(runfolder=record["runfolder"], host=record["host"],
+                           state=record["state"], msg=record["msg"],
+                           pid=record["pid"])
+        info.stdout = record["stdout"]
+        info.stderr = record["stderr"]
+        info.job_id = record["id"]
+        info.profile = record.get("profile")
+        info.priority = record.get("priority")
+        info.queued_at = record["submitted_at"]
+        for name in ProcessInfo.TIMESTAMPS:
+            setattr(info, name, record.get(name))
+        info.usage = record.get("usage")
+        return info
+
+    @staticmethod
+    def lifecycle(times):
+        """ The times in the life of a job, and the durations between them,
+            rounded to milliseconds. The times are submitted_at, when the job
+            was saved in the job store, started_at, when its process was
+            started, finished_at, when it reached a final state, and
+            collected_at, when a client first read its status after that. A
+            duration is None until both its times are known.
+
+            Args:
+                times: a dict with the TIMESTAMPS of the job, any of them None
+
+            Returns:
+                a dict with the timestamps and the durations
+        """
+        result = dict((name, times.get(name))
+                      for name in ProcessInfo.TIMESTAMPS)
+
+        for name, start, end in ProcessInfo.DURATIONS:
+            if result[start] is None or result[end] is None:
+                result[name] = None
+            else:
+                # Don't let a clock that was set back give negative durations
+                result[name] = round(max(0.0, result[end] - result[start]), 3)
+
+        return result
+
+    def timings(self):
+        """ The times in the life of the job, and the durations between them.
+        """
+        return ProcessInfo.lifecycle(vars(self))
+
+    @staticmethod
+    def none_process(job_id):
+        """  Return an empty process information container if a non valid job
+             id was requested.
+        """
+        info = ProcessInfo(host=ProcessService._host(), state=State.NONE,
                            msg="No such process exists")
+        info.job_id = job_id
+        return info
 
 
 class ExecStringWithEmailConfig(object):
@@ -112,35 +286,52 @@ class Wrapper(object):
             params: Dict of parameters to the wrapper. Must contain the name of
                     the runfolder to use (not full path). Can contain a YAML
                     object containing the Sisyphus config to use, and a XML
-                    object cotaining the QC config to use.
+                    object cotaining the QC config to use. The configs are
+                    written to the runfolder when the job is started.
             configuration_svc: The ConfigurationService for our config lookups
             logger: Logger object for printouts
+            runfolder_checked: set if the caller has already made sure that the
+                               runfolder exists
 
         Raises:
             OSError: If the given runfolder doesn't exist.
     """
 
+    CONFIG_PARAMS = ("sisyphus_config", "qc_config")
+
     QC_TYPE = "qc"
     REPORT_TYPE = "report"
     AEACUS_STATS_TYPE = "aeacusstats"
     AEACUS_REPORTS_TYPE = "aeacusreports"
     CHECK_INDICES_TYPE = "checkindices"
+    TYPES = (QC_TYPE, REPORT_TYPE, AEACUS_STATS_TYPE, AEACUS_REPORTS_TYPE,
+             CHECK_INDICES_TYPE)
 
-    def __init__(self, params, configuration_svc, logger=None):
+    DEFAULT_JOB_LOG_ROOT = "/tmp/siswrap_logs"
+    DEFAULT_OUTPUT_TAIL_BYTES = 65536
+
+    def __init__(self, params, configuration_svc, logger=None,
+                 runfolder_checked=False):
         self.conf_svc = configuration_svc
         self.logger = logger or logging.getLogger(__name__)
+        self.params = params
+        self.idempotency_key = None
+        self.fingerprint = None
+        self.cached = False
 
-        conf = configuration_svc.get_app_config()
-        runpath = conf["runfolder_root"] + "/" + params["runfolder"]
+        runpath = self.runfolder_path(configuration_svc, params["runfolder"])
 
-        if not os.path.isdir(runpath):
+        if not runfolder_checked and not os.path.isdir(runpath):
             raise OSError("No runfolder {0} exists.".format(runpath))
 
         self.info = ProcessInfo(runpath)
 
-        if "sisyphus_config" in params:
-            path = runpath + "/sisyphus.yml"
-            self.write_new_config_file(path, params["sisyphus_config"])
+    @staticmethod
+    def runfolder_path(configuration_svc, runfolder):
+        """ The full path of a runfolder, given its name.
+        """
+        conf = configuration_svc.get_app_config()
+        return conf["runfolder_root"] + "/" + runfolder
 
     def __get_attr__(self, attr):
         return getattr(self.info, attr)
@@ -172,19 +363,71 @@ class Wrapper(object):
             logger.error("Error writing new config file {0}: {1}".
                               format(path, err))
 
-    def sisyphus_version(self):
+    def write_config_files(self):
+        """ Write the configs given with the job to the runfolder, where
+            Sisyphus will pick them up. This is done when the job is started,
+            so a job that waits in the queue, or turns out to be a duplicate,
+            doesn't change the configs under a job that is already running.
         """
-        Use Sisyphus own script to check which version is used.
-        :return: the sisyphus version used.
+        if "sisyphus_config" in self.params:
+            path = self.info.runfolder + "/sisyphus.yml"
+            self.write_new_config_file(path, self.params["sisyphus_config"])
+
+    def config_digest(self):
+        """ A SHA-1 digest of the configs given with the job, which tells if
+            two jobs for the same runfolder would run with the same configs.
         """
-        conf = self.conf_svc.get_app_config()
-        cmd = [conf["perl"], conf["version_bin"]]
-        sisphus_version = check_output(cmd)
-        return sisphus_version
+        digest = hashlib.sha1()
+
+        for name in self.CONFIG_PARAMS:
+            content = self.params.get(name)
+            if isinstance(content, unicode):
+                content = content.encode("utf-8")
+            digest.update("{0}={1}\0".format(name, content))
+
+        return digest.hexdigest()
+
+    def duplicates(self, other):
+        """ True if `other` is a job of the same type, for the same runfolder
+            and with the same configs, which would give the same result.
+        """
+        return (self.type_txt == other.type_txt and
+                self.info.runfolder == other.info.runfolder and
+                self.config_digest() == other.config_digest())
+
+    def stop(self, signum=signal.SIGTERM):
+        """ Send a signal to the process of the job, and to every process it
+            has started, as they are all in the session of the job's process.
+
+            Returns:
+                True if there was any process to signal, otherwise False
+        """
+        if self.info.pid is None:
+            return False
+
+        try:
+            os.killpg(self.info.pid, signum)
+            return True
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+            return False
+
+    def log_prefix(self):
+        """ Path prefix of the log files that the job's output is written to.
+        """
+        return self.log_prefix_for(self.conf_svc, self.type_txt,
+                                   self.info.job_id)
 
-    # TODO: Perhaps implement support for stopping running process.
-    def stop(self):
-        pass
+    @staticmethod
+    def log_prefix_for(configuration_svc, wrapper_type, job_id):
+        conf = configuration_svc.get_app_config()
+        log_root = conf.get("job_log_root", Wrapper.DEFAULT_JOB_LOG_ROOT)
+        return os.path.join(log_root, "{0}_{1}".format(wrapper_type, job_id))
+
+    def output_tail_bytes(self):
+        conf = self.conf_svc.get_app_config()
+        return conf.get("output_tail_bytes", self.DEFAULT_OUTPUT_TAIL_BYTES)
 
     def get_exec_string(self):
         return ExecStringWithEmailConfig(self, self.conf_svc, self.info.runfolder).text
@@ -192,24 +435,55 @@ class Wrapper(object):
     def run(self):
         """  Creates an execution string that will be unique depending on
              what kind of object did the call to the method. Spawns a subprocess
-             with this execution string.
+             with this execution string, whose stdout and stderr are written
+             to the job's log files as the data arrives.
+
+             The process is run in a session of its own, so that it can be
+             stopped together with its children, and with the execution
+             profile of the wrapper type, if there is one in the config.
 
              Raises:
-                OSError, ValueError: if an error occured with the subprocess
+                OSError, IOError, ValueError: if an error occured with the
+                subprocess or its log files
         """
         try:
+            self.write_config_files()
+
             if os.getenv("ARTERIA_TEST"):
-                proc = subprocess.Popen(["/bin/sleep", "1m"])
-                exec_string = "/bin/sleep 1m"
+                exec_string = ["/bin/sleep", "1m"]
             else:
                 exec_string = self.get_exec_string()
-                proc = subprocess.Popen(exec_string, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
 
-            self.info.set_started(proc)
+            profile = ExecutionProfile.for_type(self.conf_svc, self.type_txt)
+
+            def preexec():
+                # The process group gets the same id as the process
+                os.setsid()
+                if profile is not None:
+                    profile.apply()
+
+            # Nothing that can fail is left once the process is started, so
+            # that it never runs without anyone watching it
+            output = JobOutput(None, self.log_prefix(),
+                               self.output_tail_bytes(), self.logger)
+            try:
+                proc = Subprocess(exec_string, stdout=Subprocess.STREAM,
+                                  stderr=Subprocess.STREAM,
+                                  preexec_fn=preexec)
+            except (OSError, ValueError):
+                output.discard()
+                raise
+
+            output.follow(proc)
+            self.info.set_started(proc.proc)
+            self.info.profile = profile.as_dict() if profile else None
+            self.info.output = output
             self.logger.info("{0} started for {1} with: {2}".
                              format(type(self), self.info.runfolder, exec_string))
-        except (OSError, ValueError), err:
+        except (OSError, IOError, ValueError, RuntimeError), err:
+            self.info.state = State.ERROR
+            self.info.msg = "Process could not be started: {0}".format(err)
+            self.info.finished_at = time.time()
             self.logger.error("An error occurred in Wrapper for {0}: {1}".
                               format(self.info.runfolder, err))
 
@@ -236,20 +510,23 @@ class Wrapper(object):
                                format(url))
 
     @staticmethod
-    def new_wrapper(wrapper_type, runfolder, configuration_svc):
+    def new_wrapper(wrapper_type, runfolder, configuration_svc,
+                    runfolder_checked=False):
         """ Helper method for returning an appropriate wrapper object, depending on
             the requested type.
         """
+        args = (runfolder, configuration_svc, None, runfolder_checked)
+
         if wrapper_type == Wrapper.QC_TYPE:
-            return QCWrapper(runfolder, configuration_svc)
+            return QCWrapper(*args)
         elif wrapper_type == Wrapper.REPORT_TYPE:
-            return ReportWrapper(runfolder, configuration_svc)
+            return ReportWrapper(*args)
         elif wrapper_type == Wrapper.AEACUS_STATS_TYPE:
-            return AeacusStatsWrapper(runfolder, configuration_svc)
+            return AeacusStatsWrapper(*args)
         elif wrapper_type == Wrapper.AEACUS_REPORTS_TYPE:
-            return AeacusReportsWrapper(runfolder, configuration_svc)
+            return AeacusReportsWrapper(*args)
         elif wrapper_type == Wrapper.CHECK_INDICES_TYPE:
-            return CheckIndicesWrapper(runfolder, configuration_svc)
+            return CheckIndicesWrapper(*args)
         else:
             raise RuntimeError("Unknown wrapper runner requested: {0}".
                                format(wrapper_type))
@@ -279,8 +556,10 @@ class AeacusStatsWrapper(BaseWrapperWithoutEmail):
             configuration_svc: the ConfigurationService for our conf lookups
             logger: the Logger object in charge of logging output
     """
-    def __init__(self, params, configuration_svc, logger=None):
-        super(AeacusStatsWrapper, self).__init__(params, configuration_svc, logger)
+    def __init__(self, params, configuration_svc, logger=None,
+                 runfolder_checked=False):
+        super(AeacusStatsWrapper, self).__init__(params, configuration_svc, logger,
+                                  runfolder_checked)
         self.binary_conf_lookup = "aeacus_stats"
         self.type_txt = Wrapper.AEACUS_STATS_TYPE
 
@@ -297,8 +576,10 @@ class AeacusReportsWrapper(BaseWrapperWithoutEmail):
             logger: the Logger object in charge of logging output
     """
 
-    def __init__(self, params, configuration_svc, logger=None):
-        super(AeacusReportsWrapper, self).__init__(params, configuration_svc, logger)
+    def __init__(self, params, configuration_svc, logger=None,
+                 runfolder_checked=False):
+        super(AeacusReportsWrapper, self).__init__(params, configuration_svc, logger,
+                                  runfolder_checked)
         self.binary_conf_lookup = "aeacus_reports"
         self.type_txt = Wrapper.AEACUS_REPORTS_TYPE
 
@@ -314,8 +595,10 @@ class ReportWrapper(Wrapper):
             logger: the Logger object in charge of logging output
     """
 
-    def __init__(self, params, configuration_svc, logger=None):
-        super(ReportWrapper, self).__init__(params, configuration_svc, logger)
+    def __init__(self, params, configuration_svc, logger=None,
+                 runfolder_checked=False):
+        super(ReportWrapper, self).__init__(params, configuration_svc, logger,
+                                  runfolder_checked)
         self.binary_conf_lookup = "report_bin"
         self.type_txt = Wrapper.REPORT_TYPE
 
@@ -332,8 +615,10 @@ class CheckIndicesWrapper(BaseWrapperWithoutEmail):
             logger: the Logger object in charge of logging output
     """
 
-    def __init__(self, params, configuration_svc, logger=None):
-        super(CheckIndicesWrapper, self).__init__(params, configuration_svc, logger)
+    def __init__(self, params, configuration_svc, logger=None,
+                 runfolder_checked=False):
+        super(CheckIndicesWrapper, self).__init__(params, configuration_svc, logger,
+                                  runfolder_checked)
         self.binary_conf_lookup = "checkindices"
         self.type_txt = Wrapper.CHECK_INDICES_TYPE
 
@@ -348,210 +633,1503 @@ class QCWrapper(Wrapper):
                     object containing the Sisyphus config to use, and a XML
                     object containing the QC config to use. If a config is given
                     then they will be written to the runfolder where Sisyphus
-                    will be able to use them.
+                    will be able to use them, when the job is started.
              configuration_svc: ConfigurationService serving our conf lookups
              logger: the Logger object in charge of logging output
-
-        Raises:
-            IOError: if we couldn't copy the QC settings input file
      """
 
-    def __init__(self, params, configuration_svc, logger=None):
-        super(QCWrapper, self).__init__(params, configuration_svc, logger)
+    def __init__(self, params, configuration_svc, logger=None,
+                 runfolder_checked=False):
+        super(QCWrapper, self).__init__(params, configuration_svc, logger,
+                                  runfolder_checked)
         self.binary_conf_lookup = "qc_bin"
         self.type_txt = Wrapper.QC_TYPE
-        conf = self.conf_svc.get_app_config()
 
-        if "qc_config" in params:
-            path = conf["runfolder_root"] + "/" + params["runfolder"] + "/sisyphus_qc.xml"
-            self.write_new_config_file(path, params["qc_config"])
+    def write_config_files(self):
+        super(QCWrapper, self).write_config_files()
 
+        if "qc_config" in self.params:
+            path = self.info.runfolder + "/sisyphus_qc.xml"
+            self.write_new_config_file(path, self.params["qc_config"])
 
-class ProcessService(object):
-    """ Keeps a queue over all the processes currently running. Methods for
-        starting a new process and checking the status for one process or many.
-        Status check of a finished process will remove it from the queue.
-
-        NB. The processes are saved in a dict with the process' Linux PID as
-        the key. The maximum number of Linux PIDs for a system can be found in
-        /proc/sys/kernel/pid_max. New PIDs usually start at a low number and
-        is then increased up to this maximum. When the limit is reached the
-        kernel will wrap around and start generating low PIDs again. Some
-        security patches can make this behaviour more random though. This
-        means that if someone starts running a process but never checks it
-        its status after it has finished, or takes a VERY long time before
-        doing it, can get the status response from a different process in the
-        future, as the entry might have been overwritten by a new process
-        with the same PID.
+
+class SisyphusVersionService(object):
+    """ Keeps track of which Sisyphus version is used, so that Sisyphus own
+        version script doesn't have to be run for every request. The version
+        is resolved once at startup, and is only looked up again when the
+        version script or the Sisyphus directory it lives in has changed
+        (i.e. got a new mtime or inode). Such a refresh is done in a
+        background thread, and until it has finished the previous version is
+        returned. A lookup that failed is retried at most every
+        RETRY_INTERVAL seconds.
 
         Args:
             configuration_svc: the ConfigurationService serving conf lookups
             logger: the Logger object in charge of printouts
     """
 
-    proc_queue = {}
+    RETRY_INTERVAL = 60
 
     def __init__(self, configuration_svc, logger=None):
         self.conf_svc = configuration_svc
         self.logger = logger or logging.getLogger(__name__)
+        self._version = None
+        self._fingerprint = None
+        self._refreshing = False
+        self._retry_at = 0
+
+    def _version_bin(self):
+        return self.conf_svc.get_app_config()["version_bin"]
+
+    def _lookup(self):
+        """
+        Use Sisyphus own script to check which version is used.
+        :return: the sisyphus version used.
+        """
+        conf = self.conf_svc.get_app_config()
+        cmd = [conf["perl"], conf["version_bin"]]
+        return check_output(cmd).strip()
+
+    def _current_fingerprint(self):
+        """ The mtime and inode of the version script and of the Sisyphus
+            directory, or None if they can't be read.
+        """
+        version_bin = self._version_bin()
+        fingerprint = []
+
+        for path in [version_bin, os.path.dirname(version_bin)]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            fingerprint.append((stat.st_mtime, stat.st_ino))
+
+        return tuple(fingerprint)
+
+    def resolve(self):
+        """ Look up the Sisyphus version right away. Meant to be called at
+            startup, before the IOLoop is serving any requests.
+        """
+        fingerprint = self._current_fingerprint()
+
+        try:
+            self._version = self._lookup()
+        except (OSError, subprocess.CalledProcessError), err:
+            self.logger.error("Could not look up the Sisyphus version: {0}".
+                              format(err))
+            self._retry_at = time.time() + self.RETRY_INTERVAL
+        else:
+            self._fingerprint = fingerprint
+        return self._version
+
+    def get(self):
+        """ Returns the cached Sisyphus version. If Sisyphus has changed since
+            it was looked up, a refresh is started in the background.
+        """
+        fingerprint = self._current_fingerprint()
+
+        if (fingerprint != self._fingerprint and not self._refreshing and
+                time.time() >= self._retry_at):
+            self._refresh(fingerprint)
+
+        return self._version
+
+    def _refresh(self, fingerprint):
+        io_loop = IOLoop.current()
+        self._refreshing = True
+
+        def lookup():
+            try:
+                version = self._lookup()
+            except (OSError, subprocess.CalledProcessError), err:
+                self.logger.error("Could not look up the Sisyphus version: {0}".
+                                  format(err))
+                version = None
+            io_loop.add_callback(self._refreshed, version, fingerprint)
+
+        thread = threading.Thread(target=lookup)
+        thread.daemon = True
+        thread.start()
+
+    def _refreshed(self, version, fingerprint):
+        # Only a version that was found is kept, so that a failed lookup is
+        # retried
+        if version is not None:
+            if version != self._version:
+                self.logger.info("Sisyphus version changed from {0} to {1}".
+                                 format(self._version, version))
+            self._version = version
+            self._fingerprint = fingerprint
+        else:
+            self._retry_at = time.time() + self.RETRY_INTERVAL
+
+        self._refreshing = False
+
+
+class JobIndex(object):
+    """ The jobs kept in memory, by job id, with secondary indexes by wrapper
+        type and by state. Listing the jobs of a type, or counting the running
+        jobs, then only touches the jobs in question instead of all of them.
+        The jobs of a type are kept in the order of their ids, so that they
+        can be listed without sorting. The state index has to be told with
+        `update_state` when a job has changed state.
+
+        Args:
+            wrappers: wrapper objects to put in the index from the start
+    """
+
+    def __init__(self, wrappers=()):
+        self._jobs = {}
+        self._by_type = {}
+        self._by_state = {}
+        self._states = {}
+
+        for wrapper in wrappers:
+            self.add(wrapper)
+
+    def add(self, wrapper):
+        job_id = wrapper.info.job_id
+        self.remove(job_id)
+
+        self._jobs[job_id] = wrapper
+        self._index_type(wrapper)
+        self._index_state(wrapper)
+
+    def _index_type(self, wrapper):
+        job_id = wrapper.info.job_id
+        jobs = self._by_type.setdefault(wrapper.type_txt, OrderedDict())
+        # The jobs are added in the order of their ids, apart from when they
+        # are recovered from the job store
+        in_order = not jobs or job_id > next(reversed(jobs))
+        jobs[job_id] = wrapper
+
+        if not in_order:
+            self._by_type[wrapper.type_txt] = OrderedDict(sorted(jobs.items()))
+
+    def remove(self, job_id):
+        """ Remove a job from the index, and return it (or None if it wasn't
+            in the index).
+        """
+        wrapper = self._jobs.pop(job_id, None)
+
+        if wrapper is not None:
+            self._drop(self._by_type, wrapper.type_txt, job_id)
+            self._drop(self._by_state, self._states.pop(job_id), job_id)
+
+        return wrapper
+
+    def update_state(self, wrapper):
+        job_id = wrapper.info.job_id
+
+        if job_id in self._jobs:
+            self._drop(self._by_state, self._states[job_id], job_id)
+            self._index_state(wrapper)
+
+    def _index_state(self, wrapper):
+        job_id = wrapper.info.job_id
+        self._states[job_id] = wrapper.info.state
+        self._by_state.setdefault(wrapper.info.state, {})[job_id] = wrapper
+
+    @staticmethod
+    def _drop(index, key, job_id):
+        jobs = index.get(key)
+
+        if jobs is not None:
+            jobs.pop(job_id, None)
+            if not jobs:
+                del index[key]
+
+    def of_type(self, wrapper_type):
+        return self._by_type.get(wrapper_type, {}).values()
+
+    def in_state(self, state):
+        return self._by_state.get(state, {}).values()
+
+    def get(self, job_id, default=None):
+        return self._jobs.get(job_id, default)
+
+    def values(self):
+        return self._jobs.values()
+
+    def __getitem__(self, job_id):
+        return self._jobs[job_id]
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class ProcessService(object):
+    """ Keeps a queue over all the processes currently queued or running.
+        Methods for starting a new process and checking the status for one
+        process or many. Status check of a finished process will remove it
+        from the queue.
+
+        The jobs are saved in a JobIndex with their job id as the key, and
+        are also indexed by wrapper type and state. The job id is handed out
+        by the job store when the job is submitted, and is never reused,
+        unlike Linux PIDs which wrap around. A job therefore has an id while
+        it waits in the queue, and a status link can never lead to another
+        job.
+
+        Every state change of a job is written through to the job store. A
+        finished job is dropped from memory when its status has been read,
+        but can still be looked up in the store afterwards.
+
+        Args:
+            configuration_svc: the ConfigurationService serving conf lookups
+            logger: the Logger object in charge of printouts
+            job_store: the JobStore that jobs are persisted in. Defaults to
+                       an in-memory store, which doesn't survive a restart.
+            result_cache: the ResultCache for reusing earlier results
+                          (optional)
+            local_dispatch: run the jobs here, rather than leaving them to
+                            the siswrap-worker processes; see `refresh`.
+                            Defaults to what `job_dispatch` in the app config
+                            says.
+    """
+
+    proc_queue = JobIndex()
+    wait_queue = deque()
+    state_waiters = {}
+    # The pipelines by id, the pipelines waiting for each submitted job, and
+    # the ids of the finished pipelines, with when they finished, oldest first
+    pipelines = {}
+    pipeline_steps = {}
+    finished_pipelines = deque()
+    pipeline_ids = itertools.count(1)
+    # The ids of the running jobs that are being cancelled, the reasons of
+    # the ones being stopped by the watchdog, and their pending SIGKILLs
+    cancelling = set()
+    timing_out = {}
+    kill_timeouts = {}
+
+    # The fields of a job that the workers update in the job store
+    REFRESHED_FIELDS = ("state", "pid", "host", "msg", "stdout", "stderr",
+                        "usage", "profile", "started_at", "finished_at")
+
+    DEFAULT_WORKER_POLL_INTERVAL = 1.0
+    DEFAULT_CANCEL_GRACE_PERIOD = 10
+    TIMEOUT_CHECK_INTERVAL = 10
+    DEFAULT_USAGE_SAMPLE_INTERVAL = 30
+    DEFAULT_PIPELINE_TTL = 24 * 60 * 60
+
+    PRIORITIES = {"low": 0, "normal": 1, "high": 2}
+    DEFAULT_PRIORITY = "normal"
+    DEFAULT_PRIORITY_AGING_INTERVAL = 300
+
+    def __init__(self, configuration_svc, logger=None, job_store=None,
+                 result_cache=None, local_dispatch=None):
+        self.conf_svc = configuration_svc
+        self.logger = logger or logging.getLogger(__name__)
+        self.store = job_store or SQLiteJobStore(logger=self.logger)
+        self.result_cache = result_cache
+
+        conf = configuration_svc.get_app_config()
+        if local_dispatch is None:
+            local_dispatch = conf.get("job_dispatch", "local") != "workers"
+        self.local_dispatch = local_dispatch
+        self.worker_poll_interval = conf.get("worker_poll_interval",
+                                             self.DEFAULT_WORKER_POLL_INTERVAL)
+        self.cancel_grace_period = conf.get("cancel_grace_period",
+                                            self.DEFAULT_CANCEL_GRACE_PERIOD)
+        self.job_timeout = conf.get("job_timeout")
+        self.job_timeout_per_type = conf.get("job_timeout_per_type") or {}
+        self.output_idle_timeout = conf.get("output_idle_timeout")
+        self.output_idle_timeout_per_type = \
+            conf.get("output_idle_timeout_per_type") or {}
+        self._timeout_checks = None
+        self.usage = ProcessUsage()
+        self.usage_sample_interval = conf.get("usage_sample_interval",
+                                              self.DEFAULT_USAGE_SAMPLE_INTERVAL)
+        self._usage_samples = None
+        self._usage_saved_at = None
+        self.pipeline_ttl = conf.get("pipeline_ttl", self.DEFAULT_PIPELINE_TTL)
+
+        self.metrics = SiswrapMetrics(self._job_counts)
+        self.admission = ResourceAdmission.create(configuration_svc, self.logger)
+        self.max_jobs = conf.get("max_concurrent_jobs")
+        self.max_jobs_per_type = conf.get("max_concurrent_jobs_per_type") or {}
+
+        self.aging_interval = conf.get("priority_aging_interval",
+                                       self.DEFAULT_PRIORITY_AGING_INTERVAL)
+        if not self.aging_interval > 0:
+            raise RuntimeError("priority_aging_interval must be a positive "
+                               "number of seconds")
+        self.default_priorities = conf.get("default_priorities") or {}
+        for priority in self.default_priorities.values():
+            self.check_priority(priority)
+
+        # How many seconds earlier than it was submitted a job of each class
+        # is queued as
+        self.head_starts = dict((name, rank * self.aging_interval)
+                                for name, rank in self.PRIORITIES.items())
 
     @staticmethod
     def _host():
         return socket.gethostname()
 
-    def run(self, wrapper_object):
-        """  Execute the wrapper object and add it to the process queue.
+    def recover(self):
+        """ Bring the job store up to date after a restart. Jobs that were
+            running when the service went down can't be followed anymore, and
+            are marked as failed. Jobs that were waiting in the queue are put
+            back in it, in the order they were submitted.
+
+            When the jobs are run by workers, nothing has been lost; the jobs
+            that are queued or running are just followed again.
+        """
+        if not self.local_dispatch:
+            for state in [State.QUEUED, State.STARTED]:
+                for record in self.store.find(state):
+                    self._follow(record)
+
+            self.logger.info("Following {0} jobs run by workers".
+                             format(len(ProcessService.proc_queue)))
+            return
+
+        for record in self.store.find(State.STARTED):
+            self.store.mark(record["id"], State.ERROR,
+                            "The service was restarted while the process "
+                            "was running")
+
+        for record in self.store.find(State.QUEUED):
+            try:
+                wrapper = Wrapper.new_wrapper(record["type"], record["params"],
+                                              self.conf_svc)
+            except (OSError, RuntimeError), err:
+                self.store.mark(record["id"], State.ERROR,
+                                "Could not requeue job after restart: {0}".
+                                format(err))
+                continue
+
+            wrapper.info.job_id = record["id"]
+            wrapper.info.priority = record.get("priority")
+            wrapper.info.queued_at = record["submitted_at"]
+            self._prioritise(wrapper)
+            ProcessService.wait_queue.append(wrapper)
+            wrapper.info.set_queued(len(ProcessService.wait_queue))
+            ProcessService.proc_queue.add(wrapper)
+            self._save(wrapper)
+
+        self.logger.info("Recovered {0} queued jobs from the job store".
+                         format(len(ProcessService.wait_queue)))
+        self.dispatch()
+
+    def _follow(self, record):
+        """ Keep a job that is run by a worker in memory.
+        """
+        try:
+            wrapper = Wrapper.new_wrapper(record["type"], record["params"],
+                                          self.conf_svc, runfolder_checked=True)
+        except RuntimeError, err:
+            self.logger.error("Could not follow job {0}: {1}".
+                              format(record["id"], err))
+            return
+
+        wrapper.info = ProcessInfo.from_record(record)
+        ProcessService.proc_queue.add(wrapper)
+
+    def refresh(self):
+        """ Update the jobs in memory with the states that the workers have
+            saved in the job store. Only used when the jobs are run by
+            workers; the jobs run here are updated as soon as they change.
+
+            With `job_dispatch: workers` in the app config, the jobs aren't
+            run here, but by siswrap-worker processes that claim them from a
+            job store shared with the workers. The jobs submitted here are
+            kept in memory all the same, and followed through this.
+        """
+        in_flight = (ProcessService.proc_queue.in_state(State.QUEUED) +
+                     ProcessService.proc_queue.in_state(State.STARTED))
+        if not in_flight:
+            return
+
+        try:
+            records = self.store.get_many(wrapper.info.job_id
+                                          for wrapper in in_flight)
+        except JobStoreError, err:
+            self.logger.error("Could not refresh the jobs: {0}".format(err))
+            return
+
+        for record in records:
+            wrapper = ProcessService.proc_queue.get(record["id"])
+            info = wrapper.info
+            was_started = info.started_at is not None
+            moved_on = (record["state"], record["pid"]) != (info.state,
+                                                             info.pid)
+
+            # The usage and the profile change while the job runs, without
+            # its state changing
+            for name in self.REFRESHED_FIELDS:
+                setattr(info, name, record.get(name))
+
+            # The workers keep metrics of their own, but the front-end
+            # should count the jobs it has handed out too. A claimed job is
+            # started once the worker has started its process.
+            if not was_started and info.started_at is not None:
+                self.metrics.job_started(wrapper.type_txt, info.queued_at,
+                                         info.started_at)
+
+            if not moved_on:
+                continue
+            if info.state != State.QUEUED:
+                info.queue_position = None
+
+            if info.state in FINISHED_STATES:
+                self.metrics.job_finished(wrapper.type_txt, info.state,
+                                          info.started_at,
+                                          info.finished_at or time.time())
+
+            self._notify(wrapper)
+
+    def _save(self, wrapper):
+        try:
+            self.store.save(wrapper)
+        except JobStoreError, err:
+            self.logger.error("Could not save job {0}/{1}: {2}".
+                              format(wrapper.type_txt, wrapper.info.runfolder,
+                                     err))
+
+    def find_duplicate(self, wrapper_object, idempotency_key=None):
+        """ Look for a queued or running job that the wrapper object would
+            duplicate. With an idempotency key, the job that was submitted
+            with the same key is the match. Otherwise, or if no job has the
+            key, it's a job of the same type, for the same runfolder and with
+            the same configs; the key is then recorded on that job, if it has
+            none, so that the retries of this request find it too.
+
+            Returns:
+                the wrapper object of the matching job, or None
+
+            Raises:
+                ConflictError: if the idempotency key belongs to a job that
+                isn't the same as this one
+        """
+        in_flight = (ProcessService.proc_queue.in_state(State.QUEUED) +
+                     ProcessService.proc_queue.in_state(State.STARTED))
+
+        if idempotency_key is not None:
+            for other in in_flight:
+                if other.idempotency_key != idempotency_key:
+                    continue
+                if not wrapper_object.duplicates(other):
+                    raise ConflictError("Idempotency key {0} was used for "
+                                        "job {1}, which is a different "
+                                        "job".format(idempotency_key,
+                                                     other.info.job_id))
+                return other
+
+        for other in in_flight:
+            if wrapper_object.duplicates(other):
+                if other.idempotency_key is None:
+                    other.idempotency_key = idempotency_key
+                return other
+
+        return None
+
+    def _cached_result(self, wrapper_object):
+        """ Fill in the wrapper object with the result of an earlier identical
+            job from the result cache, if there is one.
+
+            Returns:
+                the wrapper_object, or None if there was no cached result
+        """
+        if wrapper_object.fingerprint is None:
+            return None
+
+        job_id = self.result_cache.get(wrapper_object.fingerprint)
+        if job_id is None:
+            return None
+
+        info = self._stored_info(job_id, wrapper_object.type_txt)
+        if info.state != State.DONE:
+            self.result_cache.discard(wrapper_object.fingerprint)
+            return None
+
+        self.logger.info("Request for {0}/{1} is answered with the result of "
+                         "job {2}".format(wrapper_object.type_txt,
+                                          wrapper_object.info.runfolder,
+                                          job_id))
+        wrapper_object.info = info
+        wrapper_object.cached = True
+        return wrapper_object
+
+    def _reuse(self, wrapper_object, idempotency_key=None, force=False):
+        """ Look for an identical job that is queued or running, or that has
+            a cached result, so that no new job has to be started.
+
+            Returns:
+                the wrapper object of the identical job, the wrapper_object
+                filled with a cached result, or None
+        """
+        duplicate = self.find_duplicate(wrapper_object, idempotency_key)
+        if duplicate is not None:
+            self.logger.info("Request for {0}/{1} is a duplicate of job {2}".
+                             format(wrapper_object.type_txt,
+                                    wrapper_object.info.runfolder,
+                                    duplicate.info.job_id))
+            return duplicate
+
+        if self.result_cache is not None and not force:
+            return self._cached_result(wrapper_object)
+
+        return None
+
+    @gen.coroutine
+    def take_fingerprints(self, wrapper_objects):
+        """ Fingerprint jobs for the result cache before they are run, with
+            their input files looked at off the IOLoop. Jobs that haven't
+            been fingerprinted are never given a cached result, nor is their
+            result cached.
+
+            Args:
+                wrapper_objects: the wrapper objects that are about to be run
+        """
+        if self.result_cache is None:
+            return
+
+        fingerprints = yield self.result_cache.fingerprint_all(wrapper_objects)
+        for wrapper_object, fingerprint in zip(wrapper_objects, fingerprints):
+            wrapper_object.fingerprint = fingerprint
+
+    @classmethod
+    def check_priority(cls, priority):
+        """ Make sure that a priority asked for is one of the classes.
+
+            Raises:
+                RuntimeError: if it isn't
+        """
+        if priority not in cls.PRIORITIES:
+            raise RuntimeError("priority must be one of {0}".
+                               format(", ".join(sorted(cls.PRIORITIES,
+                                                       key=cls.PRIORITIES.get))))
+
+    def _prioritise(self, wrapper_object):
+        """ Give a job the default priority of its wrapper type, unless it
+            already has one.
+        """
+        if wrapper_object.info.priority is None:
+            wrapper_object.info.priority = self.default_priorities.get(
+                wrapper_object.type_txt, self.DEFAULT_PRIORITY)
+
+    def _queue_key(self, wrapper):
+        info = wrapper.info
+        return info.queued_at - self.head_starts.get(info.priority, 0), info.job_id
+
+    def effective_priority(self, info, now=None):
+        """ The rank of a queued job's priority class, plus what it has
+            gained by waiting.
+
+            Every job has a priority class: high, normal or low. The client
+            can ask for one, or else the job gets the one set for its wrapper
+            type in `default_priorities` in the app config, or normal. The
+            rank of the class (low 0, normal 1, high 2) is raised by one for
+            every `priority_aging_interval` seconds the job has waited, so
+            that the low priority jobs aren't starved by a steady stream of
+            high priority ones. Since all the waiting jobs age at the same
+            rate, the dispatcher gets the same order by queueing a job as if
+            it was submitted one aging interval earlier for every rank of its
+            class; see `_queue_key`.
+
+            Returns:
+                the effective priority, or None if the job isn't queued
+        """
+        if info.state != State.QUEUED or info.queued_at is None:
+            return None
+
+        waited = max(0, (now or time.time()) - info.queued_at)
+        return round(self.PRIORITIES.get(info.priority, 0) +
+                     waited / float(self.aging_interval), 2)
+
+    def run(self, wrapper_object, idempotency_key=None, force=False):
+        """  Give the wrapper object a job id, put it in the wait queue, and
+             start it right away if there is a free slot for it. If an
+             identical job is already queued or running, that job is returned
+             instead, and no new one is started. Likewise, if an identical job
+             has already finished successfully and the inputs haven't changed
+             since, the wrapper object gets the result of that job; see
+             `take_fingerprints`.
+
+             The job is queued with the priority set in
+             `wrapper_object.info.priority`, or the default priority of its
+             type if none is set.
 
             Args:
                 wrapper_object: the object to put in the process queue and run
+                idempotency_key: a key from the client that identifies the
+                                 submission, so a retry of it is matched with
+                                 the job it started (optional)
+                force: run the job even if there is a cached result for it
 
             Returns:
-                the wrapper_object, filled with some extra meta information
+                the wrapper_object, filled with some extra meta information,
+                or the wrapper object of the identical job
 
             Raises:
-                RuntimeError: something unexpected happened when running the process
+                RuntimeError: something unexpected happened when running the
+                process, or the job couldn't be saved
+                ConflictError: the idempotency key was used for another job
         """
+        self._prioritise(wrapper_object)
+        reused = self._reuse(wrapper_object, idempotency_key, force)
+        if reused is not None:
+            return reused
+
         try:
-            wrapper_object.run()
-            ProcessService.proc_queue[wrapper_object.info.pid] = wrapper_object
+            wrapper_object.idempotency_key = idempotency_key
+            wrapper_object.info.set_queued(self._queue_position())
+
+            try:
+                self.store.save(wrapper_object)
+            except JobStoreError, err:
+                raise RuntimeError("Could not save job: {0}".format(err))
+
+            self.enqueue(wrapper_object)
+            self.dispatch()
             return wrapper_object
         except RuntimeError, err:
             self.logger.error("An error ocurred in ProcessService for: {0}".
                               format(err))
+            raise
 
-    def poll_process(self, pid):
-        """ Poll the status of the process. Removes it from the queue if finished.
-            Accepts a pid and returns the associated ProcessInfo if it exists,
-            otherwise an empty ProcessInfo with state NONE.
+    def run_batch(self, wrapper_objects, force=False):
+        """ Submit many jobs in one go, e.g. all the tools for all the
+            runfolders of a sequencer batch. Each job is matched against
+            identical jobs and cached results like in `run`, also against the
+            other jobs in the batch. The new jobs are saved in one transaction
+            and queued in the order given, and the dispatcher is run once.
 
             Args:
-                pid: the pid of the process to poll
+                wrapper_objects: the list of objects to put in the process
+                                 queue and run
+                force: run the jobs even if there are cached results for them
 
             Returns:
-                the associated ProcessInfo if it exists, otherwise an empty ProcessInfo
+                a list with the wrapper object of each job, in the same order
+
+            Raises:
+                RuntimeError: if the jobs couldn't be saved. None of the jobs
+                are queued then.
         """
+        results = []
+        new = []
+
+        for wrapper_object in wrapper_objects:
+            self._prioritise(wrapper_object)
+            reused = self._reuse(wrapper_object, force=force)
+            if reused is None:
+                reused = next((other for other in new
+                               if wrapper_object.duplicates(other)), None)
+
+            if reused is None:
+                new.append(wrapper_object)
+                results.append(wrapper_object)
+            else:
+                results.append(reused)
 
-        pid = int(pid)
-        wrapper = ProcessService.proc_queue.get(pid)
-        debugmsg = ""
+        for ahead, wrapper_object in enumerate(new):
+            wrapper_object.info.set_queued(self._queue_position(ahead))
 
-        # No such process exists
-        if wrapper is None:
-            return ProcessInfo.none_process(pid)
-
-        proc = wrapper.info.proc
-        returncode = proc.poll()
-
-        if returncode < 0 and returncode is not None:
-            wrapper.info.msg = ("Process was terminated with "
-                                "Unix code {0}.").format(returncode)
-            wrapper.info.state = State.ERROR
-        elif returncode == 0 and returncode is not None:
-            # We can't communicate with a dead process; became obvious
-            # within Docker testing
-            if wrapper.info.state is not State.DONE:
-                out, err = proc.communicate()
-                wrapper.info.msg = ("Process was completed successfully with "
-                                    "return code ") + str(returncode) + "."
-
-                wrapper.info.stdout = out
-                wrapper.info.stderr = err
-
-                if out is None:
-                    out = "(no txt msg)"
-
-                debugmsg = "Message was: " + out
-                wrapper.info.state = State.DONE
-        elif returncode > 0:
-            try:
-                # We can only communicate with the process if it hasn't been
-                # killed off.
-                if wrapper.info.state is not State.ERROR:
-                    out, err = proc.communicate()
-                    wrapper.info.msg = "Process was completed successfully, " \
-                                       "but encounted an error, with return " \
-                                       "code {}.".format(returncode)
-                    wrapper.info.stdout = out
-                    wrapper.info.stderr = err
-                    debugmsg = "Message was: " + err
-                    wrapper.info.state = State.ERROR
-            except OSError, err:
-                self.logger.error(("An error occurred in "
-                                   "ProcessService:poll_process() for {0}/{1} "
-                                   "when communicating with the process: {2}").
-                                  format(pid, wrapper.type_txt, err))
+        try:
+            self.store.save_many(new)
+        except JobStoreError, err:
+            self.logger.error("An error ocurred in ProcessService for: {0}".
+                              format(err))
+            raise RuntimeError("Could not save jobs: {0}".format(err))
+
+        for wrapper_object in new:
+            self.enqueue(wrapper_object)
+
+        self.logger.info("Queued {0} new jobs out of a batch of {1}".
+                         format(len(new), len(wrapper_objects)))
+        self.dispatch()
+        return results
+
+    def _queue_position(self, ahead=0):
+        """ The position a new job gets in the wait queue, behind `ahead` other
+            new jobs.
+        """
+        # The workers' queue is in the job store, and can't be seen from here
+        if not self.local_dispatch:
+            return None
+        return len(ProcessService.wait_queue) + ahead + 1
+
+    def enqueue(self, wrapper_object):
+        """ Put a job that has been saved in the job store in the queue, to
+            be started by `dispatch`. When the jobs are run by workers, the
+            job is only kept in memory, to be followed.
+        """
+        if self.local_dispatch:
+            ProcessService.wait_queue.append(wrapper_object)
+        ProcessService.proc_queue.add(wrapper_object)
+
+    def free_types(self):
+        """ The wrapper types that there is a free slot, and room on the node,
+            for.
+        """
+        per_type, total = self._running_counts()
+        types = [wrapper_type for wrapper_type in Wrapper.TYPES
+                 if self._has_free_slot(wrapper_type, per_type, total)]
+
+        if self.admission is not None:
+            running = ProcessService.proc_queue.in_state(State.STARTED)
+            types = [wrapper_type for wrapper_type in types
+                     if self.admission.refusal(wrapper_type, running) is None]
+        return types
+
+    def _job_counts(self):
+        """ Count the queued and started jobs in memory, per state and
+            wrapper type.
+        """
+        counts = {}
+        for state in [State.QUEUED, State.STARTED]:
+            for wrapper in ProcessService.proc_queue.in_state(state):
+                key = (state, wrapper.type_txt)
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def _running_counts(self):
+        """ Count the started jobs, per wrapper type and in total.
+        """
+        per_type = {}
+        started = ProcessService.proc_queue.in_state(State.STARTED)
+
+        for wrapper in started:
+            per_type[wrapper.type_txt] = per_type.get(wrapper.type_txt, 0) + 1
+
+        return per_type, len(started)
+
+    def _has_free_slot(self, wrapper_type, per_type, total):
+        if self.max_jobs is not None and total >= self.max_jobs:
+            return False
+
+        limit = self.max_jobs_per_type.get(wrapper_type)
+        return limit is None or per_type.get(wrapper_type, 0) < limit
+
+    def dispatch(self):
+        """ Start as many queued jobs as the concurrency limits, and the
+            resources of the node, allow, highest effective priority first. A
+            job that has to wait for a slot of its own wrapper type doesn't
+            hold back jobs of other types.
+
+            The number of slots is set by `max_concurrent_jobs` (in total)
+            and `max_concurrent_jobs_per_type` (per wrapper type) in the app
+            config; a missing limit means unlimited. If admission thresholds
+            are set in the app config, jobs are also held while the node is
+            too loaded or short of memory; see ResourceAdmission.
+        """
+        self._watch_timeouts()
+        self._watch_usage()
+
+        if not ProcessService.wait_queue:
+            return
+
+        # The order of the waiting jobs only changes when new jobs come in,
+        # since they all age at the same rate
+        queue = sorted(ProcessService.wait_queue, key=self._queue_key)
+        ProcessService.wait_queue.clear()
+        ProcessService.wait_queue.extend(queue)
+
+        per_type, total = self._running_counts()
+        running = ProcessService.proc_queue.in_state(State.STARTED)
+        refusals = {}
+
+        for wrapper in list(ProcessService.wait_queue):
+            if not self._has_free_slot(wrapper.type_txt, per_type, total):
+                continue
+
+            if self.admission is not None:
+                if wrapper.type_txt not in refusals:
+                    refusals[wrapper.type_txt] = self.admission.refusal(
+                        wrapper.type_txt, running)
+                if refusals[wrapper.type_txt] is not None:
+                    wrapper.info.msg = "Job is waiting in the queue, since " \
+                                       "{0}".format(refusals[wrapper.type_txt])
+                    continue
+
+            ProcessService.wait_queue.remove(wrapper)
+            wrapper.run()
+            self._state_changed(wrapper)
+
+            if wrapper.info.state == State.ERROR:
+                self.logger.error("Could not start queued job {0}/{1}: {2}".
+                                  format(wrapper.type_txt,
+                                         wrapper.info.runfolder,
+                                         wrapper.info.msg))
+                self.metrics.job_finished(wrapper.type_txt, State.ERROR, None,
+                                          wrapper.info.finished_at)
+                # The failure can still be looked up in the job store
+                ProcessService.proc_queue.remove(wrapper.info.job_id)
+                continue
+
+            ChildReaper.watch(wrapper.info.proc,
+                              functools.partial(self._on_exit, wrapper))
+            self.metrics.job_started(wrapper.type_txt, wrapper.info.queued_at,
+                                     wrapper.info.started_at)
+            per_type[wrapper.type_txt] = per_type.get(wrapper.type_txt, 0) + 1
+            total += 1
+
+            if self.admission is not None:
+                self.admission.started(wrapper)
+                running.append(wrapper)
+                refusals.clear()
+
+        for position, wrapper in enumerate(ProcessService.wait_queue, 1):
+            wrapper.info.queue_position = position
+
+    def _watch_timeouts(self):
+        """ Start the watchdog, if any timeouts are set. Only the jobs run
+            here are watched, as the processes of the jobs run by workers
+            can't be reached from here.
+        """
+        if self._timeout_checks is not None or not self.local_dispatch:
+            return
+
+        if (self.job_timeout is None and self.output_idle_timeout is None and
+                not self.job_timeout_per_type and
+                not self.output_idle_timeout_per_type):
+            return
+
+        self._timeout_checks = PeriodicCallback(self.check_timeouts,
+                                                self.TIMEOUT_CHECK_INTERVAL * 1000)
+        self._timeout_checks.start()
+
+    def _watch_usage(self):
+        """ Start sampling the running jobs. With admission control, they
+            are sampled every `admission_interval` seconds, and the jobs it
+            has held back are retried each time, since the load may have
+            dropped without any job finishing here. Otherwise they are
+            sampled every `usage_sample_interval` seconds, unless that is 0.
+        """
+        if self._usage_samples is not None or not self.local_dispatch:
+            return
+
+        if self.admission is not None:
+            interval = self.admission.interval
+        elif self.usage_sample_interval:
+            interval = self.usage_sample_interval
         else:
-            wrapper.info.msg = "Process " + str(pid) + " hasn't finished yet."
-            wrapper.info.state = State.STARTED
-
-        self.logger.info(("In ProcessService:poll_process() for "
-                           "{0}/{1}: {2} {3}").format(pid,
-                                                      wrapper.type_txt,
-                                                      wrapper.info.msg,
-                                                      debugmsg))
+            return
+
+        def check():
+            self.sample_usage()
+            if self.admission is not None:
+                self.dispatch()
+
+        self._usage_samples = PeriodicCallback(check, interval * 1000)
+        self._usage_samples.start()
+
+    def sample_usage(self, now=None):
+        """ Sample the processes of the running jobs from the proc file
+            system, once per job for both the admission control and the
+            usage. The usage is saved every `usage_sample_interval` seconds,
+            so that the long running jobs can be followed while they run, and
+            is completed with what wait4 reports when they have exited.
+        """
+        now = now or time.time()
+        running = [wrapper for wrapper in
+                   ProcessService.proc_queue.in_state(State.STARTED)
+                   if wrapper.info.pid is not None]
+
+        for wrapper in running:
+            sample = self.usage.sample(wrapper.info.pid)
+            if self.admission is not None:
+                self.admission.sample(wrapper, sample)
+            if self.usage_sample_interval:
+                usage = dict(wrapper.info.usage or {})
+                usage.update(sample)
+                wrapper.info.usage = usage or None
+
+        if not running or not self.usage_sample_interval:
+            return
+        if (self._usage_saved_at is not None and
+                now - self._usage_saved_at < self.usage_sample_interval):
+            return
+        self._usage_saved_at = now
+
+        try:
+            self.store.save_many(running)
+        except JobStoreError, err:
+            self.logger.error("Could not save the usage of the jobs: {0}".
+                              format(err))
+
+    def _timeout_reason(self, wrapper, now):
+        """ Tell why a running job has to be stopped, or None if it may go on.
+        """
+        info = wrapper.info
+
+        limit = self.job_timeout_per_type.get(wrapper.type_txt, self.job_timeout)
+        if limit is not None and now - info.started_at > limit:
+            return "it ran for longer than {0} seconds".format(limit)
+
+        limit = self.output_idle_timeout_per_type.get(wrapper.type_txt,
+                                                      self.output_idle_timeout)
+        if (limit is not None and info.output is not None and
+                not info.output.closed and
+                now - info.output.last_data_at > limit):
+            return "it wrote no output for {0} seconds".format(limit)
+
+        return None
+
+    def check_timeouts(self, now=None):
+        """ Stop the running jobs that have run for too long, or haven't
+            written any output for too long. Called by the watchdog.
+
+            The limits are `job_timeout` and `output_idle_timeout` seconds,
+            or `job_timeout_per_type` and `output_idle_timeout_per_type` for
+            a wrapper type; a missing limit means unlimited. Such a job ends
+            up in the timeout state once its process has exited.
+        """
+        now = now or time.time()
+
+        for wrapper in ProcessService.proc_queue.in_state(State.STARTED):
+            job_id = wrapper.info.job_id
+            if job_id in ProcessService.cancelling or \
+                    job_id in ProcessService.timing_out:
+                continue
+
+            reason = self._timeout_reason(wrapper, now)
+            if reason is None:
+                continue
+
+            self.logger.warning("Stopping job {0}/{1} (pid {2}), since {3}".
+                                format(wrapper.type_txt, job_id,
+                                       wrapper.info.pid, reason))
+            ProcessService.timing_out[job_id] = reason
+            wrapper.info.msg = "Job is being stopped, since {0}".format(reason)
+            self._stop(wrapper)
+
+    def _on_exit(self, wrapper, returncode, rusage=None):
+        """ Called by the ChildReaper when the process of a job has exited.
+            The job is finished once the rest of its output has been read.
+            This is the only time the state of a started job changes here;
+            status checks only look at what is already in memory, or in the
+            job store.
+        """
+        output = wrapper.info.output
+
+        if output is None or output.closed:
+            self._finish(wrapper, returncode, rusage)
+        else:
+            IOLoop.current().add_future(
+                output.wait_for_close(),
+                lambda future: self._finish(wrapper, returncode, rusage))
+
+    def _finish(self, wrapper, returncode, rusage=None):
+        # A job that stopped within its grace period isn't killed: its
+        # process group may be gone, and its id taken by somebody else.
+        # Children that outlive the job's process and keep its output open
+        # hold off the finish, so they are still killed in time.
+        kill_timeout = ProcessService.kill_timeouts.pop(wrapper.info.job_id,
+                                                        None)
+        if kill_timeout is not None:
+            IOLoop.current().remove_timeout(kill_timeout)
+
+        out, err = self._output_tails(wrapper.info.output)
+        wrapper.info.set_exited(returncode, out, err)
+
+        # The last sample of the bytes read and written is kept, as wait4
+        # doesn't count them
+        if rusage is not None:
+            usage = dict(wrapper.info.usage or {})
+            usage.pop("rss_kb", None)
+            usage.update(ProcessUsage.from_rusage(rusage))
+            wrapper.info.usage = usage
+
+        # A job that managed to finish successfully keeps its result
+        reason = ProcessService.timing_out.pop(wrapper.info.job_id, None)
+        if reason is not None and returncode != 0:
+            wrapper.info.set_timed_out(reason)
+
+        if wrapper.info.job_id in ProcessService.cancelling:
+            ProcessService.cancelling.discard(wrapper.info.job_id)
+            if returncode != 0:
+                wrapper.info.set_cancelled()
+
+        if self.admission is not None:
+            self.admission.finished(wrapper)
+        self.metrics.job_finished(wrapper.type_txt, wrapper.info.state,
+                                  wrapper.info.started_at,
+                                  wrapper.info.finished_at)
+
+        self.logger.info("Job {0}/{1} (pid {2}) has exited: {3}".
+                         format(wrapper.type_txt, wrapper.info.job_id,
+                                wrapper.info.pid,
+                                wrapper.info.msg))
+        self._state_changed(wrapper)
+
+        # The job has released its slot
+        self.dispatch()
+
+    def _state_changed(self, wrapper):
+        """ Called whenever a submitted job has changed state. Saves the new
+            state, and wakes up the requests waiting for it to change.
+        """
+        self._save(wrapper)
+        self._notify(wrapper)
+
+    def _notify(self, wrapper):
+        """ Act on the new state of a job, which is already in the job store.
+        """
+        ProcessService.proc_queue.update_state(wrapper)
+
+        if (self.result_cache is not None and wrapper.info.state == State.DONE
+                and wrapper.fingerprint is not None):
+            self.result_cache.put(wrapper.fingerprint, wrapper.info.job_id)
+
+        condition = ProcessService.state_waiters.pop(wrapper.info.job_id, None)
+        if condition is not None:
+            condition.notify_all()
+
+        if wrapper.info.state in ProcessInfo.FINISHED_STATES:
+            # Advance the pipelines on the next IOLoop iteration, as starting
+            # their next steps mustn't happen in the middle of a dispatch
+            for pipeline in ProcessService.pipeline_steps.pop(wrapper.info.job_id, []):
+                IOLoop.current().add_callback(self._advance, pipeline)
+
+    def cancel(self, job_id, wrapper_type):
+        """ Cancel a job. A queued job is taken out of the queue right away.
+            The processes of a running job are sent SIGTERM, and SIGKILL if
+            they are still around after `cancel_grace_period` seconds; the job
+            is cancelled when its process has exited. Every job runs in a
+            session of its own, so the signals reach all the processes it
+            has started. Jobs that are run by workers can only be cancelled
+            while they are queued.
+
+            Args:
+                job_id: the id of the job to cancel
+                wrapper_type: the type of the job
+
+            Returns:
+                the ProcessInfo of the job, or an empty ProcessInfo if there
+                is no such job
+
+            Raises:
+                ConflictError: if the job has already finished, or has been
+                started by a worker
+        """
+        job_id = int(job_id)
+        wrapper = ProcessService.proc_queue.get(job_id)
+        if wrapper is not None and wrapper.type_txt != wrapper_type:
+            wrapper = None
+
+        info = wrapper.info if wrapper else self._stored_info(job_id, wrapper_type)
+        if info.state == State.NONE:
+            return info
+        if info.state not in [State.QUEUED, State.STARTED]:
+            raise ConflictError("Job {0} has already finished".format(job_id))
+
+        if wrapper is None or not self.local_dispatch:
+            return self._cancel_in_store(job_id, wrapper_type, wrapper)
+
+        if info.state == State.QUEUED:
+            ProcessService.wait_queue.remove(wrapper)
+            info.set_cancelled()
+            self.logger.info("Queued job {0}/{1} was cancelled".
+                             format(wrapper_type, job_id))
+            self.metrics.job_finished(wrapper_type, State.CANCELLED, None,
+                                      info.finished_at)
+            self._state_changed(wrapper)
+            # The jobs behind it have moved up
+            self.dispatch()
+        elif job_id not in ProcessService.cancelling:
+            ProcessService.cancelling.add(job_id)
+            info.msg = "Job is being cancelled"
+            self.logger.info("Stopping job {0}/{1} (pid {2})".
+                             format(wrapper_type, job_id, info.pid))
+            # Already being stopped by the watchdog
+            if job_id not in ProcessService.timing_out:
+                self._stop(wrapper)
+
+        return info
+
+    def _stop(self, wrapper):
+        """ Send SIGTERM to the processes of a running job, and SIGKILL
+            after the grace period.
+        """
+        wrapper.stop(signal.SIGTERM)
+        ProcessService.kill_timeouts[wrapper.info.job_id] = \
+            IOLoop.current().call_later(self.cancel_grace_period, self._kill,
+                                        wrapper)
+
+    def _kill(self, wrapper):
+        """ Kill whatever is left of a cancelled job after the grace period,
+            including children that have outlived the job's process.
+        """
+        ProcessService.kill_timeouts.pop(wrapper.info.job_id, None)
+        if wrapper.stop(signal.SIGKILL):
+            self.logger.warning("Job {0}/{1} was killed, as it didn't stop "
+                                "within {2} seconds".
+                                format(wrapper.type_txt, wrapper.info.job_id,
+                                       self.cancel_grace_period))
+
+    def _cancel_in_store(self, job_id, wrapper_type, wrapper):
+        """ Cancel a queued job in the job store, unless a worker has claimed
+            it already.
+        """
+        try:
+            cancelled = self.store.mark(job_id, State.CANCELLED,
+                                        ProcessInfo.CANCELLED_IN_QUEUE_MSG,
+                                        from_state=State.QUEUED)
+        except JobStoreError, err:
+            raise RuntimeError("Could not cancel job: {0}".format(err))
+
+        if not cancelled:
+            raise ConflictError("Job {0} has been started by a worker, and "
+                                "can't be cancelled anymore".format(job_id))
+
+        self.logger.info("Queued job {0}/{1} was cancelled".
+                         format(wrapper_type, job_id))
+        self.metrics.job_finished(wrapper_type, State.CANCELLED, None,
+                                  time.time())
+        if wrapper is None:
+            return self._stored_info(job_id, wrapper_type)
+
+        wrapper.info.set_cancelled()
+        self._notify(wrapper)
         return wrapper.info
 
-    def get_status(self, pid, wrapper_type):
-        """ Get status of a specific process. Removes the pid from the queue
+    @gen.coroutine
+    def run_pipeline(self, pipeline, force=False):
+        """ Submit the steps of a pipeline that don't depend on any other
+            step. The other steps are submitted as soon as the steps they
+            depend on are done.
+
+            Args:
+                pipeline: the Pipeline to run
+                force: run the steps even if there are cached results for them
+
+            Returns:
+                the pipeline, with its pipeline_id set
+        """
+        self._expire_pipelines()
+        pipeline.pipeline_id = next(ProcessService.pipeline_ids)
+        pipeline.force = force
+        ProcessService.pipelines[pipeline.pipeline_id] = pipeline
+
+        self.logger.info("Starting pipeline {0} with steps {1}".
+                         format(pipeline.pipeline_id,
+                                ", ".join(pipeline.steps.keys())))
+        yield self._advance(pipeline)
+        raise gen.Return(pipeline)
+
+    @gen.coroutine
+    def _advance(self, pipeline):
+        """ Cancel the steps of a pipeline that can't be run anymore, and
+            submit the steps that are ready. A step can be done right away,
+            e.g. from the result cache, so this goes on until no more steps
+            become ready.
+        """
+        while True:
+            pipeline.skip_blocked()
+            ready = pipeline.ready_steps()
+            if not ready:
+                break
+
+            for step in ready:
+                step.submitted = True
+            yield self.take_fingerprints([step.wrapper for step in ready])
+
+            for step in ready:
+                try:
+                    step.wrapper = self.run(step.wrapper, force=pipeline.force)
+                except RuntimeError, err:
+                    step.wrapper.info.state = State.ERROR
+                    step.wrapper.info.msg = "Could not submit step: {0}".format(err)
+                    continue
+
+                if step.state in [State.QUEUED, State.STARTED]:
+                    ProcessService.pipeline_steps.setdefault(
+                        step.wrapper.info.job_id, []).append(pipeline)
+
+        if pipeline.finished and pipeline.finished_at is None:
+            pipeline.finished_at = time.time()
+            ProcessService.finished_pipelines.append((pipeline.finished_at,
+                                                      pipeline.pipeline_id))
+            self.logger.info("Pipeline {0} has finished: {1}".
+                             format(pipeline.pipeline_id, pipeline.state))
+
+    def get_pipeline(self, pipeline_id):
+        """ Get a pipeline. A finished pipeline can be read until
+            `pipeline_ttl` seconds after it finished, when it's dropped from
+            memory.
+
+            Returns:
+                the Pipeline, or None if there is no such pipeline
+        """
+        self._expire_pipelines()
+        return ProcessService.pipelines.get(int(pipeline_id))
+
+    def _expire_pipelines(self, now=None):
+        """ Drop the pipelines that finished more than `pipeline_ttl` seconds
+            ago.
+        """
+        expired_at = (now or time.time()) - self.pipeline_ttl
+        finished = ProcessService.finished_pipelines
+
+        while finished and finished[0][0] <= expired_at:
+            _, pipeline_id = finished.popleft()
+            ProcessService.pipelines.pop(pipeline_id, None)
+
+    def current_state(self, job_id, wrapper_type):
+        """ The state of a job, without removing it from the queue if it has
+            finished, like get_status does.
+        """
+        wrapper = ProcessService.proc_queue.get(int(job_id))
+
+        if wrapper and wrapper.type_txt == wrapper_type:
+            return wrapper.info.state
+        return self._stored_info(job_id, wrapper_type).state
+
+    @gen.coroutine
+    def wait_for_change(self, job_id, wrapper_type, since_state, timeout):
+        """ Wait until a job is no longer in a given state, or until the
+            timeout expires. Returns right away if the job isn't in that state,
+            or doesn't exist.
+
+            Args:
+                job_id: the id of the job to wait for
+                wrapper_type: the type of the process we want to wait for
+                since_state: the state to wait for the job to leave
+                timeout: the maximum number of seconds to wait
+        """
+        if self.current_state(job_id, wrapper_type) != since_state:
+            return
+
+        # Jobs that are only found in the store have finished, and won't
+        # change anymore
+        wrapper = ProcessService.proc_queue.get(int(job_id))
+        if wrapper is None:
+            return
+
+        condition = ProcessService.state_waiters.get(wrapper.info.job_id)
+        if condition is None:
+            condition = Condition()
+            ProcessService.state_waiters[wrapper.info.job_id] = condition
+
+        yield condition.wait(timeout=datetime.timedelta(seconds=timeout))
+
+    @staticmethod
+    def _output_tails(output):
+        """ The last part of stdout and stderr of a finished job. The complete
+            output is found in the job's log files.
+        """
+        if output is None:
+            return None, None
+        return output.tail("stdout"), output.tail("stderr")
+
+    def get_status(self, job_id, wrapper_type):
+        """ Get status of a specific job. Removes the job from the queue
             if the process has finished executing.
 
             Args:
-                pid: the pid of the process to check for
+                job_id: the id of the job to check for
                 wrapper_type: the type of the process we want to check
 
             Returns:
-                a ProcessInfo filled with status information if it is still
-                running, otherwise an empty ProcessInfo
+                a ProcessInfo filled with status information if the process
+                is known, in memory or in the job store, otherwise an empty
+                ProcessInfo
         """
-        pid = int(pid)
+        job_id = int(job_id)
 
-        # If someone is requesting an existing process but of the wrong type
+        # If someone is requesting an existing job but of the wrong type
         # we should respond with an empty answer.
-        wrapper = ProcessService.proc_queue.get(pid)
+        wrapper = ProcessService.proc_queue.get(job_id)
 
         if wrapper and wrapper.type_txt == wrapper_type:
-            proc_info = self.poll_process(pid)
+            proc_info = wrapper.info
         else:
-            self.logger.debug(("No process found for PID {0} in "
-                              "ProcessService:get_status().").format(pid))
-            return ProcessInfo.none_process(pid)
-
-        # Remove the process from the queue if we're checking the status and
-        # it has finished. Don't remove a key if we are still working, or if
-        # the process doesn't exist
-        if proc_info.state not in [State.STARTED,
+            return self._stored_info(job_id, wrapper_type)
+
+        # Remove the job from the queue if we're checking the status and
+        # it has finished. Don't remove a key if we are still waiting or
+        # working, or if the process doesn't exist
+        if proc_info.state not in [State.QUEUED,
+                                   State.STARTED,
                                    State.NONE]:
-            self.logger.debug(("Process {0} has finished/terminated. "
-                              "Removing from queue.").format(pid))
-            del ProcessService.proc_queue[pid]
+            self.logger.debug(("Job {0} has finished/terminated. "
+                              "Removing from queue.").format(job_id))
+            ProcessService.proc_queue.remove(job_id)
+            proc_info.collected_at = time.time()
+            self._save(wrapper)
 
         return proc_info
 
+    def _stored_info(self, job_id, wrapper_type):
+        """ Look up a job that isn't in memory in the job store.
+        """
+        try:
+            record = self.store.get(wrapper_type, int(job_id))
+        except JobStoreError, err:
+            self.logger.error("Could not look up job {0}: {1}".
+                              format(job_id, err))
+            record = None
+
+        if record is None:
+            self.logger.debug(("No job found for id {0} in "
+                              "ProcessService:get_status().").format(job_id))
+            return ProcessInfo.none_process(job_id)
+
+        return ProcessInfo.from_record(record)
+
+    def get_log(self, job_id, wrapper_type, stream):
+        """ Find one of the log files of a job.
+
+            Args:
+                job_id: the id of the job whose log we want
+                wrapper_type: the type of the process
+                stream: "stdout" or "stderr"
+
+            Returns:
+                a tuple with the path to the log file, and the JobOutput that
+                is writing it if the job is still running (otherwise None).
+                For a job that a worker is running, it's a WorkerJobOutput
+                that follows the job's state in the job store.
+        """
+        job_id = int(job_id)
+        wrapper = ProcessService.proc_queue.get(job_id)
+
+        if (wrapper and wrapper.type_txt == wrapper_type and
+                wrapper.info.output is not None):
+            output = wrapper.info.output
+            return output.paths[stream], None if output.closed else output
+
+        prefix = Wrapper.log_prefix_for(self.conf_svc, wrapper_type, job_id)
+        path = JobOutput.log_path(prefix, stream)
+
+        is_running = functools.partial(self._in_flight, job_id, wrapper_type)
+        if not self.local_dispatch and is_running():
+            return path, WorkerJobOutput(path, is_running,
+                                         self.worker_poll_interval)
+        return path, None
+
+    def _in_flight(self, job_id, wrapper_type):
+        """ Whether a job is queued or running, as far as is known here. The
+            jobs in memory are kept up to date by `refresh`; the others are
+            looked up in the job store.
+        """
+        wrapper = ProcessService.proc_queue.get(job_id)
+        if wrapper is not None and wrapper.type_txt == wrapper_type:
+            state = wrapper.info.state
+        else:
+            state = self._stored_info(job_id, wrapper_type).state
+        return state in (State.QUEUED, State.STARTED)
+
     # Should we respond with a status link? Should we return something more
     # than empty list when we have no results?
     def get_all(self, wrapper_type):
-        """ Get status of all running processes
+        """ Get status of all queued, running and not yet collected processes
 
             Args:
                 wrapper_type: the object type to check statuses for
 
             Returns:
-                a dict of processes and some meta information if they are running, otherwise
-                an empty dict
-        """
-        # Only update processes of our requested wrapper class
-        map(lambda pid: self.poll_process(pid)
-            if ProcessService.proc_queue[pid].type_txt is wrapper_type
-            else None, ProcessService.proc_queue.keys())
-
-        results = map(lambda p: {"host": p.info.host,
-                                 "runfolder": p.info.runfolder,
-                                 "pid": p.info.pid,
-                                 "state": p.info.state}
-                      if p.type_txt == wrapper_type
-                      else None, ProcessService.proc_queue.values())
-
-        self.logger.debug("Fetching all PIDs of type {0} from queue.".
+                a list of dicts with some meta information about the processes,
+                or an empty list if there are none
+        """
+        def status(p):
+            # Most of the jobs listed have finished, and won't change while
+            # they are kept in memory
+            if p.info.listed_status is not None:
+                return p.info.listed_status
+
+            result = {"job_id": p.info.job_id,
+                      "host": p.info.host,
+                      "runfolder": p.info.runfolder,
+                      "pid": p.info.pid,
+                      "state": p.info.state,
+                      "priority": p.info.priority,
+                      "usage": p.info.usage}
+            result.update(p.info.timings())
+            if p.info.state == State.QUEUED:
+                result["queue_position"] = p.info.queue_position
+                result["effective_priority"] = self.effective_priority(p.info)
+            elif p.info.state in ProcessInfo.FINISHED_STATES:
+                p.info.listed_status = result
+            return result
+
+        self.logger.debug("Fetching all jobs of type {0} from queue.".
                           format(wrapper_type))
 
-        return filter(None, results)
+        # The index keeps the jobs of a type in the order of their ids
+        return [status(p) for p in
+                ProcessService.proc_queue.of_type(wrapper_type)]
+
+    def list_jobs(self, wrapper_type, states=None, runfolder=None,
+                  submitted_after=None, cursor=None, limit=100):
+        """ Get one page of the jobs of a type from the job store, newest
+            first, including jobs that have finished and been collected.
+
+            Args:
+                wrapper_type: the object type to list jobs for
+                states: only list jobs in one of these states (optional)
+                runfolder: only list jobs for this runfolder, by name or full
+                           path (optional)
+                submitted_after: only list jobs submitted after this UNIX time
+                                 (optional)
+                cursor: the next_cursor of the previous page (optional)
+                limit: the maximum number of jobs on the page
+
+            Returns:
+                a dict with the statuses of the jobs on the page, and the
+                cursor for the next page (None if this is the last page)
+
+            Raises:
+                ValueError: if the cursor isn't valid
+                RuntimeError: if the job store couldn't be read
+        """
+        before_id = self._decode_cursor(cursor) if cursor else None
+
+        if runfolder is not None and not os.path.isabs(runfolder):
+            conf = self.conf_svc.get_app_config()
+            runfolder = conf["runfolder_root"] + "/" + runfolder
+
+        try:
+            # One more than asked for, to know if there is a next page
+            records = self.store.query(wrapper_type, states, runfolder,
+                                       submitted_after, before_id, limit + 1)
+        except JobStoreError, err:
+            raise RuntimeError("Could not list jobs: {0}".format(err))
+
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = self._encode_cursor(records[-1]["id"])
+
+        return {"statuses": [self._listed_status(r) for r in records],
+                "next_cursor": next_cursor}
+
+    def _listed_status(self, record):
+        status = {"job_id": record["id"],
+                  "host": record["host"],
+                  "runfolder": record["runfolder"],
+                  "pid": record["pid"],
+                  "state": record["state"],
+                  "priority": record["priority"],
+                  "usage": record["usage"]}
+        status.update(ProcessInfo.lifecycle(record))
+
+        # Only the jobs in memory know their place in the queue
+        wrapper = ProcessService.proc_queue.get(record["id"])
+        if wrapper is not None and wrapper.info.state == State.QUEUED:
+            status["queue_position"] = wrapper.info.queue_position
+            status["effective_priority"] = self.effective_priority(wrapper.info)
+
+        return status
+
+    @staticmethod
+    def _encode_cursor(job_id):
+        return base64.urlsafe_b64encode("before:{0}".format(job_id))
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            name, job_id = base64.urlsafe_b64decode(str(cursor)).split(":")
+            if name != "before":
+                raise ValueError
+            return int(job_id)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor: {0}".format(cursor))
@@ -0,0 +1,80 @@
+import timeit
+import logging
+from arteria.configuration import ConfigurationService
+from siswrap.wrapper_services import *
+
+# Micro-benchmark of the status listing of ProcessService, with many jobs
+# kept in memory. Run from the root of the repository:
+#
+#   python tests/benchmarks/siswrap_listing_benchmark.py
+#
+# It prints the time it takes to list the jobs of one wrapper type, and to
+# count the running jobs, with the JobIndex and, for comparison, with full
+# scans over all jobs, sorted by job id, as was done before the index. Both
+# reuse the listed statuses of the finished jobs, so the difference is what
+# the indexes save.
+
+NR_JOBS = 10000
+REPEAT = 5
+NUMBER = 20
+
+TYPES = [Wrapper.QC_TYPE, Wrapper.REPORT_TYPE, Wrapper.AEACUS_STATS_TYPE,
+         Wrapper.AEACUS_REPORTS_TYPE, Wrapper.CHECK_INDICES_TYPE]
+
+
+# Most of the jobs kept around have finished; a few are running or queued
+def state_of(job_id):
+    if job_id % 100 == 0:
+        return State.STARTED
+    elif job_id % 100 == 1:
+        return State.QUEUED
+    elif job_id % 100 == 2:
+        return State.ERROR
+    return State.DONE
+
+
+class BenchmarkWrapper(object):
+    def __init__(self, job_id, wrapper_type, state):
+        self.info = ProcessInfo(runfolder="/data/runfolder_{0}".format(job_id),
+                                host="localhost", state=state, pid=job_id)
+        self.info.job_id = job_id
+        self.type_txt = wrapper_type
+
+
+class ScanningJobIndex(JobIndex):
+    def of_type(self, wrapper_type):
+        return sorted((w for w in self.values()
+                       if w.type_txt == wrapper_type),
+                      key=lambda w: w.info.job_id)
+
+    def in_state(self, state):
+        return [w for w in self.values() if w.info.state == state]
+
+
+def populate(index, nr_jobs):
+    for job_id in xrange(1, nr_jobs + 1):
+        index.add(BenchmarkWrapper(job_id, TYPES[job_id % len(TYPES)],
+                                   state_of(job_id)))
+    return index
+
+
+def best_of(func):
+    timings = timeit.repeat(func, repeat=REPEAT, number=NUMBER)
+    return min(timings) / NUMBER * 1000
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    conf = ConfigurationService(app_config_path="./config/app.config")
+    process_svc = ProcessService(conf)
+
+    print "Jobs in memory: {0} ({1} per type)".format(NR_JOBS,
+                                                      NR_JOBS / len(TYPES))
+
+    for name, index in [("indexed", JobIndex()),
+                        ("full scan", ScanningJobIndex())]:
+        ProcessService.proc_queue = populate(index, NR_JOBS)
+        print "{0}: get_all({1}) {2:.3f} ms, running job counts {3:.3f} ms".format(
+            name, Wrapper.QC_TYPE,
+            best_of(lambda: process_svc.get_all(Wrapper.QC_TYPE)),
+            best_of(process_svc._running_counts))
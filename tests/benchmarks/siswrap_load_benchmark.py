@@ -0,0 +1,341 @@
+import os
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import itertools
+import multiprocessing
+import yaml
+import tornado.web
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.ioloop import IOLoop
+from arteria.configuration import ConfigurationService
+from siswrap import __version__
+from siswrap.app import create_routes
+from siswrap.fake_sisyphus import generate
+from siswrap.wrapper_services import Wrapper
+
+# End-to-end load benchmark of the REST service. The app is set up by
+# siswrap.app.create_routes, the same as siswrap-ws, in a process of its own,
+# against a temporary runfolder root and a fake Sisyphus toolkit from
+# siswrap.fake_sisyphus. Concurrent clients then submit jobs and poll their
+# status for a while. Run from the root of the repository:
+#
+#   python tests/benchmarks/siswrap_load_benchmark.py --duration 30 \
+#       --submitters 4 --pollers 16 --output results.json
+#
+# It prints the throughput and the p50/p95/p99 latency of each endpoint, and
+# writes them as JSON with --output. Give the results of an earlier version
+# with --baseline to see how they compare.
+
+API_URL = "/api/1.0"
+
+# QC jobs can't be submitted without a QC config
+QC_CONFIG = "<QCrequirements><platforms></platforms></QCrequirements>"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load benchmark of the "
+                                                 "Siswrap REST service.")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds to run the load for")
+    parser.add_argument("--submitters", type=int, default=4,
+                        help="number of clients submitting jobs")
+    parser.add_argument("--pollers", type=int, default=16,
+                        help="number of clients polling the job status")
+    parser.add_argument("--list-ratio", type=float, default=0.1,
+                        help="the share of the polls that list all the jobs "
+                             "of a type, rather than get the status of one")
+    parser.add_argument("--jobs", type=int, default=500,
+                        help="the most jobs to submit")
+    parser.add_argument("--runfolders", type=int, default=100,
+                        help="number of runfolders to submit jobs for")
+    parser.add_argument("--job-seconds", type=float, default=1.0,
+                        help="how long each fake Sisyphus script runs")
+    parser.add_argument("--fake-sisyphus", type=json.loads, default={},
+                        help="more fake_sisyphus settings, as JSON, e.g. "
+                             "'{\"stdout_bytes\": 1048576}'")
+    parser.add_argument("--max-jobs", type=int, default=8,
+                        help="max_concurrent_jobs of the service")
+    parser.add_argument("--types", default=",".join(Wrapper.TYPES),
+                        help="the comma separated wrapper types to submit")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds before a request is given up")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the random choices of the pollers")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--baseline", help="compare with the JSON results "
+                                           "of an earlier run")
+    return parser.parse_args(argv)
+
+
+def create_sandbox(root, args):
+    """ Create the runfolders, the fake Sisyphus scripts and the app config
+        of the service under `root`, and return the path of the app config.
+    """
+    runfolder_root = os.path.join(root, "runfolders")
+    os.makedirs(runfolder_root)
+    for i in range(args.runfolders):
+        os.mkdir(os.path.join(runfolder_root, runfolder_name(i)))
+
+    with open("config/app.config") as f:
+        conf = yaml.safe_load(f)
+
+    conf["fake_sisyphus"] = dict({"runtime_seconds": args.job_seconds},
+                                 **args.fake_sisyphus)
+    conf.update(generate(os.path.join(root, "sisyphus"), conf))
+
+    conf.update({"runfolder_root": runfolder_root,
+                 "job_store_path": os.path.join(root, "jobs.db"),
+                 "job_log_root": os.path.join(root, "logs"),
+                 "max_concurrent_jobs": args.max_jobs,
+                 "max_concurrent_jobs_per_type": {},
+                 "result_cache_max_entries": 0,
+                 "job_dispatch": "local"})
+
+    path = os.path.join(root, "app.config")
+    with open(path, "w") as f:
+        yaml.safe_dump(conf, f, default_flow_style=False)
+    return path
+
+
+def runfolder_name(i):
+    return "160101_BENCH_{0:04d}_AAAAAAAXX".format(i)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(config_path, port, ready):
+    """ Run the service with the routes siswrap.app.start sets up, without
+        the command line and logger config of the AppService. Meant to be run
+        in a process of its own.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    config_svc = ConfigurationService(app_config_path=config_path)
+    app = tornado.web.Application(create_routes(config_svc))
+    app.listen(port, "127.0.0.1")
+    ready.set()
+    IOLoop.current().start()
+
+
+def percentile(ordered, fraction):
+    """ The nearest-rank percentile of an ordered list of values.
+    """
+    if not ordered:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(ordered))))
+    return ordered[rank - 1]
+
+
+class LatencyRecorder(object):
+    """ Keeps the latency of every request, per endpoint.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed):
+        result = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            to_ms = lambda seconds: round(seconds * 1000, 3)
+            result[endpoint] = {
+                "requests": len(ordered),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput": round(len(ordered) / elapsed, 2),
+                "p50_ms": to_ms(percentile(ordered, 0.50)),
+                "p95_ms": to_ms(percentile(ordered, 0.95)),
+                "p99_ms": to_ms(percentile(ordered, 0.99)),
+                "max_ms": to_ms(ordered[-1])}
+        return result
+
+
+class LoadGenerator(object):
+    """ Submits jobs and polls their status with concurrent clients, until
+        the time is up.
+
+        Args:
+            base_url: where the service listens
+            args: the parsed command line arguments
+    """
+
+    def __init__(self, base_url, args):
+        self.base_url = base_url
+        self.args = args
+        self.types = args.types.split(",")
+        self.recorder = LatencyRecorder()
+        self.submitted = []
+        self.submissions = itertools.count()
+        self.random = random.Random(args.seed)
+        self.client = AsyncHTTPClient()
+        self.deadline = None
+
+    @gen.coroutine
+    def request(self, endpoint, url, **kwargs):
+        start = time.time()
+        ok = True
+        try:
+            response = yield self.client.fetch(HTTPRequest(
+                self.base_url + url, request_timeout=self.args.timeout,
+                **kwargs))
+        except HTTPError, err:
+            response = err.response
+            ok = False
+        except socket.error:
+            response = None
+            ok = False
+        self.recorder.record(endpoint, time.time() - start, ok)
+        raise gen.Return(response if ok else None)
+
+    @gen.coroutine
+    def submitter(self):
+        while time.time() < self.deadline:
+            i = next(self.submissions)
+            if i >= self.args.jobs:
+                break
+
+            wrapper_type = self.types[i % len(self.types)]
+            # Every submission is for a runfolder and type that isn't in
+            # flight yet, as far as there are runfolders enough
+            runfolder = runfolder_name((i // len(self.types)) %
+                                       self.args.runfolders)
+            body = {"runfolder": runfolder}
+            if wrapper_type == Wrapper.QC_TYPE:
+                body["qc_config"] = QC_CONFIG
+
+            response = yield self.request(
+                "run", "{0}/{1}/run/{2}".format(API_URL, wrapper_type, runfolder),
+                method="POST", body=json.dumps(body))
+            if response is not None:
+                self.submitted.append((wrapper_type,
+                                       json.loads(response.body)["job_id"]))
+
+    @gen.coroutine
+    def poller(self):
+        while time.time() < self.deadline:
+            if not self.submitted:
+                yield gen.sleep(0.01)
+                continue
+
+            wrapper_type, job_id = self.random.choice(self.submitted)
+            if self.random.random() < self.args.list_ratio:
+                yield self.request("status_list", "{0}/{1}/status/".
+                                   format(API_URL, wrapper_type))
+            else:
+                yield self.request("status", "{0}/{1}/status/{2}".
+                                   format(API_URL, wrapper_type, job_id))
+
+    @gen.coroutine
+    def run(self):
+        start = time.time()
+        self.deadline = start + self.args.duration
+        yield ([self.submitter() for _ in range(self.args.submitters)] +
+               [self.poller() for _ in range(self.args.pollers)])
+        raise gen.Return(time.time() - start)
+
+
+def compare(results, baseline):
+    """ The lines telling how the results differ from the baseline, per
+        endpoint.
+    """
+    def change(new, old):
+        if not old or new is None:
+            return "n/a"
+        return "{0:+.1f}%".format((new - old) * 100.0 / old)
+
+    lines = ["Compared with {0}:".format(baseline.get("service_version"))]
+    for endpoint, stats in sorted(results["endpoints"].items()):
+        old = baseline.get("endpoints", {}).get(endpoint)
+        if old is None:
+            continue
+        lines.append("  {0:<12} throughput {1:>8}  p50 {2:>8}  p95 {3:>8}  "
+                     "p99 {4:>8}".format(
+                         endpoint,
+                         change(stats["throughput"], old["throughput"]),
+                         change(stats["p50_ms"], old["p50_ms"]),
+                         change(stats["p95_ms"], old["p95_ms"]),
+                         change(stats["p99_ms"], old["p99_ms"])))
+    return lines
+
+
+def report(results):
+    print "siswrap {0}, {1:.1f} s, {2} jobs submitted".format(
+        results["service_version"], results["elapsed_seconds"],
+        results["jobs_submitted"])
+    print "  {0:<12} {1:>8} {2:>7} {3:>10} {4:>9} {5:>9} {6:>9} {7:>9}".format(
+        "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms",
+        "p99 ms", "max ms")
+    for endpoint, stats in sorted(results["endpoints"].items()):
+        print "  {0:<12} {1[requests]:>8} {1[errors]:>7} {1[throughput]:>10} " \
+              "{1[p50_ms]:>9} {1[p95_ms]:>9} {1[p99_ms]:>9} " \
+              "{1[max_ms]:>9}".format(endpoint, stats)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    root = tempfile.mkdtemp(prefix="siswrap_benchmark_")
+    server = None
+
+    try:
+        config_path = create_sandbox(root, args)
+        port = free_port()
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve,
+                                         args=(config_path, port, ready))
+        server.start()
+        if not ready.wait(30):
+            raise RuntimeError("The service didn't start")
+
+        AsyncHTTPClient.configure(None, max_clients=args.submitters +
+                                  args.pollers)
+        generator = LoadGenerator("http://127.0.0.1:{0}".format(port), args)
+        elapsed = IOLoop.current().run_sync(generator.run)
+    finally:
+        if server is not None and server.is_alive():
+            server.terminate()
+            server.join()
+        shutil.rmtree(root, ignore_errors=True)
+
+    results = {"benchmark": "siswrap_load",
+               "service_version": __version__,
+               "python_version": platform.python_version(),
+               "started_at": time.time() - elapsed,
+               "settings": dict((name, value) for name, value
+                                in vars(args).items()
+                                if name not in ("output", "baseline")),
+               "elapsed_seconds": round(elapsed, 3),
+               "jobs_submitted": len(generator.submitted),
+               "endpoints": generator.recorder.summary(elapsed)}
+
+    report(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print "\n".join(compare(results, json.load(f)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
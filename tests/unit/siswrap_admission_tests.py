@@ -0,0 +1,84 @@
+from arteria.configuration import ConfigurationService
+from siswrap.admission import *
+from siswrap.usage import ProcessUsage
+from siswrap.wrapper_services import ProcessInfo
+
+# Some tests for siswrap/admission.py.
+
+
+class MyWrapper(object):
+    def __init__(self, wrapper_type, pid):
+        self.type_txt = wrapper_type
+        self.info = ProcessInfo(pid=pid)
+
+
+class TestResourceAdmission(object):
+
+    def admission(self, tmpdir, monkeypatch, **settings):
+        conf = ConfigurationService(app_config_path="./config/app.config")
+        app_config = dict(conf.get_app_config(), **settings)
+        monkeypatch.setattr(conf, "get_app_config", lambda: app_config)
+        monkeypatch.setattr("multiprocessing.cpu_count", lambda: 4)
+        return ResourceAdmission(conf, proc_root=str(tmpdir))
+
+    def meminfo(self, tmpdir, available_kb):
+        tmpdir.join("meminfo").write("MemTotal:       16000000 kB\n"
+                                     "MemFree:          100000 kB\n"
+                                     "MemAvailable:   {0} kB\n".format(available_kb))
+
+    def status(self, tmpdir, pid, rss_kb, hwm_kb):
+        tmpdir.ensure(str(pid), dir=True).join("status").write(
+            "Name:\tperl\nVmHWM:\t  {0} kB\nVmRSS:\t  {1} kB\n".format(hwm_kb, rss_kb))
+
+    def sample(self, tmpdir, admission, wrapper):
+        admission.sample(wrapper, ProcessUsage(str(tmpdir)).sample(wrapper.info.pid))
+
+    # No thresholds in the config should mean no admission control
+    def test_create(self):
+        conf = ConfigurationService(app_config_path="./config/app.config")
+        assert ResourceAdmission.create(conf) is None
+
+    # Jobs should be held while the load per CPU is too high, counting the
+    # jobs that were just started
+    def test_load(self, tmpdir, monkeypatch):
+        admission = self.admission(tmpdir, monkeypatch, admission_max_load_per_cpu=1.0)
+        assert admission.refusal("qc", []) is None
+
+        tmpdir.join("loadavg").write("3.50 2.00 1.00 2/300 4242\n")
+        assert admission.refusal("qc", []) is None
+
+        admission.started(MyWrapper("qc", 1))
+        assert "load" in admission.refusal("qc", [])
+
+        monkeypatch.setattr("time.time", lambda: admission._starts[0] + 61)
+        assert admission.refusal("qc", []) is None
+
+    # Jobs should be held if they would leave too little memory, given what
+    # has been learned about the memory use of their type
+    def test_memory(self, tmpdir, monkeypatch):
+        admission = self.admission(tmpdir, monkeypatch, admission_min_free_mb=1000,
+                                   admission_footprint_mb={"qc": 2000})
+        self.meminfo(tmpdir, 3900 * 1024)
+        assert admission.refusal("qc", []) is None
+        assert admission.refusal("report", []) is None
+
+        # A running qc job that hasn't grown to its footprint yet will need
+        # more of the memory that looks available
+        running = [MyWrapper("qc", 42)]
+        self.status(tmpdir, 42, 500 * 1024, 500 * 1024)
+        self.sample(tmpdir, admission, running[0])
+        assert "memory" in admission.refusal("qc", running)
+        assert admission.refusal("report", running) is None
+
+        # The footprint of qc jobs is learned from their peaks
+        self.status(tmpdir, 42, 100 * 1024, 3000 * 1024)
+        self.sample(tmpdir, admission, running[0])
+        admission.finished(running[0])
+        assert admission.footprints["qc"] == 3000 * 1024
+        assert "memory" in admission.refusal("qc", [])
+
+        self.status(tmpdir, 43, 1000 * 1024, 1000 * 1024)
+        smaller = MyWrapper("qc", 43)
+        self.sample(tmpdir, admission, smaller)
+        admission.finished(smaller)
+        assert admission.footprints["qc"] == int(3000 * 1024 * 0.7 + 1000 * 1024 * 0.3)
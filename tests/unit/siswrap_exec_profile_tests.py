@@ -0,0 +1,55 @@
+import pytest
+import subprocess
+from arteria.configuration import ConfigurationService
+from siswrap.exec_profile import *
+
+# Some tests for siswrap/exec_profile.py.
+
+
+class TestExecutionProfile(object):
+
+    # The profile should be applied in the child process only
+    def test_apply(self):
+        profile = ExecutionProfile({"nice": 5, "ionice_class": "idle",
+                                    "cpu_affinity": [0], "rlimit_nofile": 64,
+                                    "rlimit_as_mb": 2048})
+
+        out = subprocess.check_output(
+            ["/bin/sh", "-c", "nice; ulimit -n; ulimit -v; "
+                              "grep Cpus_allowed_list /proc/self/status; "
+                              "ionice -p $$"],
+            preexec_fn=profile.apply).splitlines()
+
+        assert out[0] == "5"
+        assert out[1] == "64"
+        assert out[2] == str(2048 * 1024)
+        assert out[3].split() == ["Cpus_allowed_list:", "0"]
+        assert out[4] == "idle"
+        assert os.nice(0) == 0
+
+        assert profile.as_dict() == {"nice": 5, "ionice_class": "idle",
+                                     "cpu_affinity": [0], "rlimit_nofile": 64,
+                                     "rlimit_as_mb": 2048}
+
+    # Level 0 is the highest best-effort level, not the default one
+    def test_apply_ionice_level_0(self):
+        profile = ExecutionProfile({"ionice_level": 0})
+        out = subprocess.check_output(["/bin/sh", "-c", "ionice -p $$"],
+                                      preexec_fn=profile.apply)
+        assert out.strip() == "best-effort: prio 0"
+        assert profile.as_dict() == {"ionice_level": 0}
+
+    # Invalid settings should be refused up front
+    def test_invalid(self):
+        for settings in [{"nice": 20}, {"nice": "low"}, {"ionice_class": "fast"},
+                         {"ionice_level": 8}, {"cpu_affinity": "0-3"},
+                         {"cpu_affinity": [-1]}, {"rlimit_as_mb": 0},
+                         {"niceness": 5}]:
+            with pytest.raises(RuntimeError):
+                ExecutionProfile(settings)
+
+    # The profile of a type should be looked up in the app config
+    def test_for_type(self):
+        conf = ConfigurationService(app_config_path="./config/app.config")
+        assert ExecutionProfile.for_type(conf, "qc").nice == 10
+        assert ExecutionProfile.for_type(conf, "report") is None
@@ -0,0 +1,118 @@
+import time
+import random
+import signal
+import subprocess
+import pytest
+from siswrap.fake_sisyphus import *
+
+# Some tests for siswrap/fake_sisyphus.py.
+
+
+class TestFakeScript(object):
+
+    # Settings that don't make sense should be refused up front
+    def test_invalid_settings(self):
+        for settings in [{"runtime": 10},
+                         {"runtime_seconds": -1},
+                         {"runtime_seconds": {"distribution": "poisson"}},
+                         {"runtime_seconds": {"distribution": "uniform",
+                                              "min": 5, "max": 1}},
+                         {"runtime_seconds": {"distribution": "normal",
+                                              "mean": 5}},
+                         {"stdout_bytes": "lots"},
+                         {"exit_codes": 256},
+                         {"exit_codes": {0: 0}},
+                         {"crash_probability": 1.5},
+                         {"crash_probability": 0.6, "hang_probability": 0.6}]:
+            with pytest.raises(RuntimeError):
+                FakeScript(settings)
+
+    # The runtimes should be drawn from the distribution that is set
+    def test_draw_runtime(self):
+        rng = random.Random(42)
+        assert FakeScript({"runtime_seconds": 3}).draw_runtime(rng) == 3
+
+        uniform = FakeScript({"runtime_seconds": {"distribution": "uniform",
+                                                  "min": 2, "max": 4}})
+        normal = FakeScript({"runtime_seconds": {"distribution": "normal",
+                                                 "mean": 1, "stddev": 5}})
+        lognormal = FakeScript({"runtime_seconds": {"distribution": "lognormal",
+                                                    "median": 10, "sigma": 0.5}})
+        for _ in range(100):
+            assert 2 <= uniform.draw_runtime(rng) <= 4
+            assert normal.draw_runtime(rng) >= 0
+        draws = sorted(lognormal.draw_runtime(rng) for _ in range(1001))
+        assert 7 < draws[500] < 13
+
+    # The outcomes should follow the weights and probabilities, and be the
+    # same for the same seed and arguments
+    def test_draw_outcome(self):
+        script = FakeScript({"exit_codes": {0: 3, 1: 1},
+                             "crash_probability": 0.1,
+                             "hang_probability": 0.1, "seed": 7})
+        rng = random.Random(42)
+        outcomes = [script.draw_outcome(rng) for _ in range(2000)]
+        assert 100 < outcomes.count(("crash", None)) < 300
+        assert 100 < outcomes.count(("hang", None)) < 300
+        assert 1000 < outcomes.count(("exit", 0)) < 1400
+        assert 300 < outcomes.count(("exit", 1)) < 500
+
+        draw = lambda argv: script.draw_outcome(script.random_for("qc", argv))
+        assert [draw(["-runfolder", str(i)]) for i in range(20)] == \
+            [draw(["-runfolder", str(i)]) for i in range(20)]
+
+    # The scripts of a type should get their own settings
+    def test_settings_for(self):
+        conf = {"fake_sisyphus": {"runtime_seconds": 5, "exit_codes": 0,
+                                  "scripts": {"checkIndices.pl":
+                                              {"exit_codes": 1}}}}
+        assert FakeScript.settings_for(conf, "checkIndices.pl") == \
+            {"runtime_seconds": 5, "exit_codes": 1}
+        assert FakeScript.settings_for(conf, "quickReport.pl") == \
+            {"runtime_seconds": 5, "exit_codes": 0}
+        assert FakeScript.settings_for({}, "quickReport.pl") == {}
+
+
+class TestGenerate(object):
+
+    # The generated scripts should behave as set, when run the way the
+    # wrappers run them
+    def test_generate(self, tmpdir):
+        conf = {"fake_sisyphus": {
+            "runtime_seconds": 0.2, "stdout_bytes": 10000, "stderr_bytes": 100,
+            "memory_mb": 1,
+            "scripts": {"checkIndices.pl": {"exit_codes": 3},
+                        "aeacus-stats.pl": {"crash_probability": 1},
+                        "aeacus-reports.pl": {"hang_probability": 1,
+                                              "runtime_seconds": 0.5}}}}
+        entries = generate(str(tmpdir), conf)
+
+        assert sorted(entries) == sorted(["perl"] + SCRIPTS.keys())
+        assert check_output_of(entries, "version_bin") == (0, VERSION + "\n")
+
+        returncode, out = check_output_of(entries, "report_bin")
+        assert returncode == 0
+        assert len(out) == 10000
+        assert check_output_of(entries, "checkindices")[0] == 3
+        assert check_output_of(entries, "aeacus_stats")[0] == -signal.SIGSEGV
+
+        hanging = subprocess.Popen([entries["perl"], entries["aeacus_reports"]],
+                                   stdout=subprocess.PIPE)
+        time.sleep(1)
+        assert hanging.poll() is None
+        hanging.kill()
+        hanging.wait()
+
+    # Settings that aren't valid should be found when the scripts are
+    # generated
+    def test_generate_invalid(self, tmpdir):
+        with pytest.raises(RuntimeError):
+            generate(str(tmpdir), {"fake_sisyphus": {
+                "scripts": {"qcValidateRun.pl": {"memory": 10}}}})
+
+
+def check_output_of(entries, script):
+    proc = subprocess.Popen([entries["perl"], entries[script], "-runfolder",
+                             "foo"], stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    return proc.returncode, out
@@ -1,6 +1,8 @@
 import pytest
+import time
 import tornado.web
 import jsonpickle
+from tornado.ioloop import IOLoop
 from arteria import *
 from arteria.configuration import ConfigurationService
 from siswrap.app import *
@@ -18,8 +20,10 @@ API_URL = "/api/1.0"
 def app():
     config_svc = ConfigurationService(app_config_path="./config/app.config")
     process_svc = ProcessService(config_svc)
+    version_svc = SisyphusVersionService(config_svc)
     #args = dict(process_svc=process_svc, config_svc=config_svc)
-    app = tornado.web.Application(routes(process_svc=process_svc, config_svc=config_svc), debug=True)
+    app = tornado.web.Application(routes(process_svc=process_svc, config_svc=config_svc,
+                                         version_svc=version_svc), debug=True)
     return app
 
 @pytest.fixture
@@ -34,7 +38,7 @@ def stub_sisyphus_version(monkeypatch):
     def my_sisyphus_version(self):
         return "15.3.2"
 
-    monkeypatch.setattr("siswrap.wrapper_services.Wrapper.sisyphus_version", my_sisyphus_version)
+    monkeypatch.setattr("siswrap.wrapper_services.SisyphusVersionService.get", my_sisyphus_version)
 
 def json(payload):
     return jsonpickle.encode(payload)
@@ -118,6 +122,170 @@ class TestRunHandler(object):
         except tornado.httpclient.HTTPError, err:
             assert "500" in str(err)
 
+    @pytest.mark.gen_test
+    def test_post_queued_job(self, http_client, http_server, base_url, stub_isdir,
+                             stub_sisyphus_version, monkeypatch):
+        def my_run(self, wrapper, idempotency_key=None, force=False):
+            wrapper.info.set_queued(3)
+            wrapper.info.job_id = 7
+            return wrapper
+
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.run", my_run)
+
+        payload = {"runfolder": "foo", "priority": "high"}
+        resp = yield http_client.fetch(base_url + API_URL + "/report/run/123",
+                                       method="POST", body=json(payload))
+
+        assert resp.code == 202
+        payload = jsonpickle.decode(resp.body)
+        assert payload["state"] == State.QUEUED
+        assert payload["queue_position"] == 3
+        assert payload["priority"] == "high"
+        assert payload["pid"] is None
+        assert payload["job_id"] == 7
+        assert payload["link"].endswith("/report/status/7")
+
+        payload = {"runfolder": "foo", "priority": "urgent"}
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL + "/report/run/123",
+                                    method="POST", body=json(payload))
+        assert err.value.code == 400
+
+    @pytest.mark.gen_test
+    def test_post_duplicate_job(self, http_client, http_server, base_url, stub_isdir,
+                                stub_sisyphus_version, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.dispatch",
+                            lambda self: None)
+
+        payload = json({"runfolder": "foo"})
+        first = yield http_client.fetch(base_url + API_URL + "/report/run/foo",
+                                        method="POST", body=payload)
+        second = yield http_client.fetch(base_url + API_URL + "/report/run/foo",
+                                         method="POST", body=payload)
+
+        first = jsonpickle.decode(first.body)
+        assert first["coalesced"] is False
+        assert second.code == 202
+        second = jsonpickle.decode(second.body)
+        assert second["coalesced"] is True
+        assert second["job_id"] == first["job_id"]
+        assert second["link"] == first["link"]
+
+        # An idempotency key reused for another runfolder is a conflict
+        yield http_client.fetch(base_url + API_URL + "/report/run/bar",
+                                method="POST", body=json({"runfolder": "bar"}),
+                                headers={"Idempotency-Key": "retry-1"})
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL + "/report/run/baz",
+                                    method="POST", body=json({"runfolder": "baz"}),
+                                    headers={"Idempotency-Key": "retry-1"})
+        assert err.value.code == 409
+
+class TestBatchRunHandler(object):
+
+    @pytest.mark.gen_test
+    def test_post_batch(self, http_client, http_server, base_url, stub_isdir,
+                        stub_sisyphus_version, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.dispatch",
+                            lambda self: None)
+
+        payload = {"jobs": [{"type": "report", "runfolder": "foo"},
+                            {"type": "qc", "runfolder": "foo",
+                             "qc_config": TestHelpers.QC_CONFIG},
+                            {"type": "report", "runfolder": "foo"}]}
+        resp = yield http_client.fetch(base_url + API_URL + "/batch/run",
+                                       method="POST", body=json(payload))
+
+        assert resp.code == 202
+        jobs = jsonpickle.decode(resp.body)["jobs"]
+        assert len(jobs) == 3
+        assert [job["state"] for job in jobs] == [State.QUEUED] * 3
+        assert jobs[1]["link"].endswith("/qc/status/{0}".format(jobs[1]["job_id"]))
+        assert jobs[0]["job_id"] != jobs[1]["job_id"]
+        # The same job twice in a batch is only queued once
+        assert jobs[2]["job_id"] == jobs[0]["job_id"]
+        assert jobs[2]["coalesced"] is True
+        assert len(ProcessService.wait_queue) == 2
+
+    @pytest.mark.gen_test
+    def test_post_invalid_batch(self, http_client, http_server, base_url,
+                                stub_sisyphus_version, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        checked = []
+
+        def my_isdir(path):
+            checked.append(path)
+            return not path.endswith("missing")
+
+        monkeypatch.setattr("os.path.isdir", my_isdir)
+
+        payload = {"jobs": [{"type": "report", "runfolder": "foo"},
+                            {"type": "checkindices", "runfolder": "foo"},
+                            {"type": "qc", "runfolder": "foo"},
+                            {"type": "bar", "runfolder": "foo"},
+                            {"type": "report", "runfolder": "missing"},
+                            {"type": "report", "runfolder": "foo",
+                             "priority": "urgent"}]}
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL + "/batch/run",
+                                    method="POST", body=json(payload))
+
+        assert err.value.code == 400
+        errors = jsonpickle.decode(err.value.response.body)["errors"]
+        assert [error["job"] for error in errors] == [2, 3, 4, 5]
+        assert "qc_config" in errors[0]["error"]
+        assert "priority" in errors[3]["error"]
+        # Every runfolder is looked up once, and nothing is queued
+        assert len(checked) == 2
+        assert len(ProcessService.wait_queue) == 0
+
+class TestPipelineHandlers(object):
+
+    @pytest.mark.gen_test
+    def test_post_pipeline(self, http_client, http_server, base_url, stub_isdir,
+                           stub_sisyphus_version, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.pipelines", {})
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.finished_pipelines", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.dispatch",
+                            lambda self: None)
+
+        payload = {"runfolder": "foo",
+                   "steps": ["checkindices", "aeacusstats",
+                             {"type": "report", "after": ["checkindices"]}]}
+        resp = yield http_client.fetch(base_url + API_URL + "/pipeline/run/foo",
+                                       method="POST", body=json(payload))
+
+        assert resp.code == 202
+        payload = jsonpickle.decode(resp.body)
+        assert payload["state"] == State.STARTED
+        assert payload["runfolder"] == "/vagrant/foo"
+        steps = payload["steps"]
+        assert [step["name"] for step in steps] == ["checkindices", "aeacusstats", "report"]
+        assert [step["state"] for step in steps] == [State.QUEUED, State.PENDING, State.PENDING]
+        assert steps[1]["depends_on"] == ["checkindices"]
+        assert steps[2]["depends_on"] == ["checkindices"]
+        assert steps[0]["link"].endswith("/checkindices/status/{0}".format(steps[0]["job_id"]))
+        assert steps[1]["link"] is None
+
+        resp = yield http_client.fetch(payload["link"])
+        assert jsonpickle.decode(resp.body)["steps"] == steps
+
+        # The default chain has a qc step, which needs a qc_config
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL + "/pipeline/run/foo",
+                                    method="POST", body=json({"runfolder": "foo"}))
+        assert err.value.code == 400
+
+        resp = yield http_client.fetch(base_url + API_URL + "/pipeline/status/4242")
+        assert jsonpickle.decode(resp.body)["state"] == State.NONE
+
 class TestStatusHandler(object):
 
     @pytest.mark.gen_test
@@ -153,13 +321,50 @@ class TestStatusHandler(object):
         assert payload["statuses"][0]["pid"] == 4242
         assert payload["statuses"][1]["pid"] == 3131
 
+    @pytest.mark.gen_test
+    def test_get_filtered_status(self, http_client, http_server,
+                                 base_url, monkeypatch):
+        calls = []
+
+        def my_list_jobs(self, wrapper_type, **kwargs):
+            calls.append(kwargs)
+            if kwargs["cursor"] == "bogus":
+                raise ValueError("Invalid cursor: bogus")
+            return {"statuses": [{"job_id": 3}], "next_cursor": "abc"}
+
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.list_jobs",
+                            my_list_jobs)
+
+        resp = yield http_client.fetch(base_url + API_URL + "/qc/status/" +
+                                       "?state=done,error&runfolder=foo" +
+                                       "&submitted_after=1000&limit=5000")
+        assert resp.code == 200
+        payload = jsonpickle.decode(resp.body)
+        assert payload == {"statuses": [{"job_id": 3}], "next_cursor": "abc"}
+        assert calls[0] == {"states": ["done", "error"], "runfolder": "foo",
+                            "submitted_after": 1000.0, "cursor": None,
+                            "limit": 1000}
+
+        yield http_client.fetch(base_url + API_URL + "/qc/status/?cursor=abc")
+        assert calls[1]["limit"] == 100
+        assert calls[1]["cursor"] == "abc"
+        assert calls[1]["states"] is None
+
+        for query in ["cursor=bogus", "limit=0", "submitted_after=yesterday"]:
+            with pytest.raises(tornado.httpclient.HTTPError) as err:
+                yield http_client.fetch(base_url + API_URL + "/qc/status/?" + query)
+            assert err.value.code == 400
+
     @pytest.mark.gen_test
     def test_get_existing_status(self, http_client, http_server,
                                  base_url, monkeypatch, stub_isdir):
         def my_get(self, pid, wrapper_type):
-            return ProcessInfo(runfolder="foo", host="bar",
+            info = ProcessInfo(runfolder="foo", host="bar",
                                state=State.STARTED,
                                proc=None, msg=None, pid=pid)
+            info.submitted_at = 1000.0
+            info.started_at = 1030.0
+            return info
 
         monkeypatch.setattr("siswrap.wrapper_services.ProcessService.get_status",
                             my_get)
@@ -171,6 +376,9 @@ class TestStatusHandler(object):
         print payload
         assert payload["pid"] == 123
         assert payload["state"] == State.STARTED
+        assert payload["started_at"] == 1030.0
+        assert payload["queue_seconds"] == 30.0
+        assert payload["run_seconds"] is None
 
         resp = yield http_client.fetch(base_url + API_URL + "/qc/status/321")
         assert resp.code == 200
@@ -223,5 +431,238 @@ class TestStatusHandler(object):
                                            "/report/status/123")
             assert resp.code == 500
 
+    @pytest.mark.gen_test
+    def test_get_status_long_poll(self, http_client, http_server,
+                                  base_url, monkeypatch):
+        class MyWrapper(object):
+            type_txt = "qc"
+            info = ProcessInfo(runfolder="foo", host="bar",
+                               state=State.STARTED, pid=5151)
+
+        wrapper = MyWrapper()
+        wrapper.info.job_id = 4242
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue",
+                            JobIndex([wrapper]))
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.state_waiters", {})
+
+        config_svc = ConfigurationService(app_config_path="./config/app.config")
+        process_svc = ProcessService(config_svc)
+
+        # Without a state change we should get the current state back when
+        # the wait is over
+        start = time.time()
+        resp = yield http_client.fetch(base_url + API_URL +
+                                       "/qc/status/4242?wait=0.2")
+        assert time.time() - start >= 0.2
+        assert jsonpickle.decode(resp.body)["state"] == State.STARTED
+
+        # We should be answered as soon as the process has exited
+        IOLoop.current().call_later(0.1, process_svc._finish, wrapper, 0)
+        start = time.time()
+        resp = yield http_client.fetch(base_url + API_URL +
+                                       "/qc/status/4242?wait=5")
+        assert time.time() - start < 5
+        assert jsonpickle.decode(resp.body)["state"] == State.DONE
+
+    @pytest.mark.gen_test
+    def test_get_status_long_poll_since_state(self, http_client, http_server,
+                                              base_url, monkeypatch):
+        def my_get(self, pid, wrapper_type):
+            return ProcessInfo(runfolder="foo", host="bar",
+                               state=State.DONE, pid=pid)
+
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.get_status",
+                            my_get)
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.current_state",
+                            lambda self, pid, wrapper_type: State.DONE)
+
+        # A process that has already left the state should be answered
+        # right away
+        start = time.time()
+        resp = yield http_client.fetch(base_url + API_URL +
+                                       "/qc/status/123?wait=5&since_state=started")
+        assert time.time() - start < 5
+        assert jsonpickle.decode(resp.body)["state"] == State.DONE
+
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL + "/qc/status/123?wait=soon")
+        assert err.value.code == 400
+
+class TestStopHandler(object):
+
+    @pytest.mark.gen_test
+    def test_stop_job(self, http_client, http_server, base_url, monkeypatch):
+        def my_cancel(self, job_id, wrapper_type):
+            if job_id == 1:
+                info = ProcessInfo(runfolder="/vagrant/foo", state=State.STARTED,
+                                   pid=4242, msg="Job is being cancelled")
+            elif job_id == 2:
+                info = ProcessInfo(runfolder="/vagrant/foo")
+                info.set_cancelled()
+            elif job_id == 3:
+                raise ConflictError("Job 3 has already finished")
+            else:
+                info = ProcessInfo.none_process(job_id)
+            info.job_id = job_id
+            return info
+
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.cancel", my_cancel)
+
+        resp = yield http_client.fetch(base_url + API_URL + "/qc/stop/1",
+                                       method="POST", body="")
+        assert resp.code == 202
+        payload = jsonpickle.decode(resp.body)
+        assert payload["state"] == State.STARTED
+        assert payload["link"].endswith("/qc/status/1")
+
+        resp = yield http_client.fetch(base_url + API_URL + "/qc/stop/2",
+                                       method="POST", body="")
+        assert resp.code == 200
+        assert jsonpickle.decode(resp.body)["state"] == State.CANCELLED
+
+        for job_id, code in [(3, 409), (4, 404)]:
+            with pytest.raises(tornado.httpclient.HTTPError) as err:
+                yield http_client.fetch(base_url + API_URL + "/qc/stop/{0}".
+                                        format(job_id), method="POST", body="")
+            assert err.value.code == code
+
+class TestLogsHandler(object):
+
+    # The output of a running process should be streamed as it is written,
+    # and the stream should end once the process is done
+    @pytest.mark.gen_test
+    def test_follow_log(self, http_client, http_server, base_url,
+                        monkeypatch, tmpdir):
+        from tornado.process import Subprocess
+        from siswrap.job_output import JobOutput
+
+        proc = Subprocess("echo first; sleep 0.2; echo second; sleep 0.2; echo -n last",
+                          shell=True, stdout=Subprocess.STREAM,
+                          stderr=Subprocess.STREAM)
+
+        class MyWrapper(object):
+            type_txt = "qc"
+            info = ProcessInfo(runfolder="foo", host="bar",
+                               state=State.STARTED, pid=proc.pid)
+
+        wrapper = MyWrapper()
+        wrapper.info.job_id = 1
+        wrapper.info.output = JobOutput(proc, str(tmpdir.join("qc_1")), 100)
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue",
+                            JobIndex([wrapper]))
+
+        chunks = []
+        resp = yield http_client.fetch(base_url + API_URL + "/qc/logs/1",
+                                       streaming_callback=chunks.append)
+        assert resp.code == 200
+        assert resp.headers["Content-Type"] == "text/event-stream"
+
+        events = "".join(chunks)
+        assert events.startswith("id: 6\ndata: first\ndata: \n\n")
+        assert "id: 13\ndata: second\ndata: \n\n" in events
+        assert "id: 17\ndata: last\n\n" in events
+        assert events.endswith("event: end\ndata: 17\n\n")
+
+    # A log of a process that isn't tracked anymore should be read from the
+    # log directory, starting at the requested offset
+    @pytest.mark.gen_test
+    def test_finished_log(self, http_client, http_server, base_url,
+                          monkeypatch, tmpdir):
+        def my_prefix(configuration_svc, wrapper_type, pid):
+            return str(tmpdir.join("{0}_{1}".format(wrapper_type, pid)))
+
+        monkeypatch.setattr("siswrap.wrapper_services.Wrapper.log_prefix_for",
+                            staticmethod(my_prefix))
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        tmpdir.join("report_77.stderr").write("one\ntwo\n")
+
+        resp = yield http_client.fetch(base_url + API_URL +
+                                       "/report/logs/77?stream=stderr&offset=4")
+        assert resp.body == "id: 8\ndata: two\ndata: \n\n" + \
+            "event: end\ndata: 8\n\n"
+
+        resp = yield http_client.fetch(base_url + API_URL +
+                                       "/report/logs/77?stream=stderr",
+                                       headers={"Last-Event-ID": "8"})
+        assert resp.body == "event: end\ndata: 8\n\n"
+
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL + "/report/logs/78")
+        assert err.value.code == 404
+
+        with pytest.raises(tornado.httpclient.HTTPError) as err:
+            yield http_client.fetch(base_url + API_URL +
+                                    "/report/logs/77?stream=stdin")
+        assert err.value.code == 400
+
+    # The log of a job that a worker runs should be followed until the job
+    # store has it finished, rather than end as soon as it's found
+    @pytest.mark.gen_test
+    def test_worker_log(self, http_client, http_server, base_url,
+                        monkeypatch, tmpdir):
+        from siswrap.job_output import WorkerJobOutput
+
+        log = tmpdir.join("qc_5.stdout")
+        log.write("first\n")
+        running = [True]
+
+        def my_get_log(self, job_id, wrapper_type, stream):
+            return str(log), WorkerJobOutput(str(log), lambda: running[0],
+                                             0.05)
+
+        def finish():
+            log.write("first\nlast\n")
+            running[0] = False
+
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.get_log",
+                            my_get_log)
+        IOLoop.current().call_later(0.3, finish)
+        resp = yield http_client.fetch(base_url + API_URL + "/qc/logs/5")
+        assert resp.body == "id: 6\ndata: first\ndata: \n\n" + \
+            "id: 11\ndata: last\ndata: \n\n" + "event: end\ndata: 11\n\n"
+
+class TestMetricsHandler(object):
+
+    @pytest.mark.gen_test
+    def test_get_metrics(self, http_client, http_server, base_url):
+        yield http_client.fetch(base_url + API_URL + "/qc/status/")
+        resp = yield http_client.fetch(base_url + "/metrics")
+
+        assert resp.code == 200
+        assert resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "# TYPE siswrap_jobs_started_total counter" in resp.body
+        assert "siswrap_request_duration_seconds_count{handler=\"StatusHandler\"} 1" \
+            in resp.body
+
+    # Long polls are held open on purpose, and shouldn't count as slow
+    # requests
+    @pytest.mark.gen_test
+    def test_long_poll_left_out(self, http_client, http_server, base_url,
+                                monkeypatch):
+        def my_get(self, pid, wrapper_type):
+            return ProcessInfo(runfolder="foo", host="bar",
+                               state=State.DONE, pid=pid)
+
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.get_status",
+                            my_get)
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.current_state",
+                            lambda self, pid, wrapper_type: State.DONE)
+        yield http_client.fetch(base_url + API_URL + "/qc/status/7?wait=1")
+        resp = yield http_client.fetch(base_url + "/metrics")
+
+        assert "handler=\"StatusHandler\"" not in resp.body
+
+class TestVersionHandler(object):
+
+    @pytest.mark.gen_test
+    def test_get_version(self, http_client, http_server, base_url,
+                         stub_sisyphus_version):
+        resp = yield http_client.fetch(base_url + API_URL + "/version")
+        assert resp.code == 200
+        payload = jsonpickle.decode(resp.body)
+        assert payload["sisyphus_version"] == "15.3.2"
+        from siswrap import __version__ as version
+        assert payload["service_version"] == version
+
 if __name__ == '__main__':
     pytest.main()
@@ -0,0 +1,91 @@
+import os
+import pytest
+from tornado.ioloop import IOLoop
+from tornado.process import Subprocess
+from siswrap.job_output import *
+
+# Some tests for siswrap/job_output.py.
+
+
+class TestTailBuffer(object):
+
+    # The buffer should only hold the end of what has been written to it
+    def test_append(self):
+        tail = TailBuffer(10)
+        tail.append("0123456789")
+        tail.append("abcdef")
+        assert tail.getvalue() == "6789abcdef"
+
+        for _ in range(1000):
+            tail.append("xyz")
+
+        assert tail.getvalue() == "zxyzxyzxyz"
+        assert sum(len(chunk) for chunk in tail._chunks) < 20
+
+    # An empty buffer should give back an empty string
+    def test_empty(self):
+        assert TailBuffer(10).getvalue() == ""
+
+
+class TestJobOutput(object):
+
+    # Both streams should be written to their own log file, and the tails
+    # should be available once the streams are closed
+    @pytest.mark.gen_test
+    def test_capture(self, tmpdir):
+        proc = Subprocess("seq 1 20000; echo oops 1>&2", shell=True,
+                          stdout=Subprocess.STREAM, stderr=Subprocess.STREAM)
+        prefix = str(tmpdir.join("logs", "qc_42"))
+        output = JobOutput(proc, prefix, 6)
+
+        assert output.closed is False
+        yield output.wait_for_close()
+        assert output.closed is True
+
+        assert output.tail("stdout") == "20000\n"
+        assert output.tail("stderr") == "oops\n"
+
+        assert output.paths["stdout"] == prefix + ".stdout"
+        with open(output.paths["stdout"]) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == "1"
+        assert len(lines) == 20000
+        assert os.path.getsize(output.paths["stderr"]) == 5
+
+    # Waiters should be woken up when output arrives, and time out otherwise
+    @pytest.mark.gen_test
+    def test_wait_for_data(self, tmpdir):
+        proc = Subprocess("sleep 0.2; echo hello", shell=True,
+                          stdout=Subprocess.STREAM, stderr=Subprocess.STREAM)
+        output = JobOutput(proc, str(tmpdir.join("qc_43")), 100)
+        started = output.last_data_at
+
+        assert (yield output.wait_for_data(0.05)) is False
+        assert output.last_data_at == started
+        assert (yield output.wait_for_data(5)) is True
+        assert output.last_data_at > started
+        with open(output.paths["stdout"]) as f:
+            assert f.read() == "hello\n"
+
+        yield output.wait_for_close()
+
+
+class TestWorkerJobOutput(object):
+
+    # A log written by a worker should be followed by polling it, until the
+    # job has finished
+    @pytest.mark.gen_test
+    def test_wait_for_data(self, tmpdir):
+        log = tmpdir.join("qc_44.stdout")
+        log.write("")
+        running = [True]
+        output = WorkerJobOutput(str(log), lambda: running[0], 0.01)
+
+        assert output.closed is False
+        assert (yield output.wait_for_data(0.05)) is False
+        IOLoop.current().call_later(0.05, log.write, "hello\n")
+        assert (yield output.wait_for_data(2)) is True
+
+        running[0] = False
+        assert output.closed is True
+        assert (yield output.wait_for_data(2)) is True
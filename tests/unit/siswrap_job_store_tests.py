@@ -0,0 +1,232 @@
+import pytest
+from arteria.configuration import ConfigurationService
+from siswrap.job_store import *
+from siswrap.wrapper_services import ProcessInfo, State
+
+# Some tests for siswrap/job_store.py.
+
+
+class MyWrapper(object):
+    def __init__(self, wrapper_type, runfolder):
+        self.type_txt = wrapper_type
+        self.params = {"runfolder": runfolder}
+        self.info = ProcessInfo(runfolder="/vagrant/" + runfolder,
+                                host="bar", state=State.QUEUED)
+
+
+class TestSQLiteJobStore(object):
+
+    # A job should get an id when it is first saved, and later saves should
+    # update the same record
+    def test_save(self):
+        store = SQLiteJobStore()
+        wrapper = MyWrapper("qc", "foo")
+
+        store.save(wrapper)
+        assert wrapper.info.job_id == 1
+        assert store.get("qc", 1)["state"] == State.QUEUED
+
+        wrapper.info.state = State.DONE
+        wrapper.info.pid = 4242
+        wrapper.info.stdout = "out"
+        wrapper.info.profile = {"nice": 10}
+        wrapper.info.usage = {"user_cpu_seconds": 1.5}
+        store.save(wrapper)
+        assert wrapper.info.job_id == 1
+
+        record = store.get("qc", 1)
+        assert record["id"] == 1
+        assert record["pid"] == 4242
+        assert record["state"] == State.DONE
+        assert record["runfolder"] == "/vagrant/foo"
+        assert record["params"] == {"runfolder": "foo"}
+        assert record["stdout"] == "out"
+        assert record["profile"] == {"nice": 10}
+        assert record["usage"] == {"user_cpu_seconds": 1.5}
+        assert record["submitted_at"] <= record["updated_at"]
+        assert store.get("report", 1) is None
+        assert store.get("qc", 2) is None
+
+    # Ids should never be handed out twice, even after the latest job has
+    # been deleted
+    def test_ids_not_reused(self):
+        store = SQLiteJobStore()
+        store.save(MyWrapper("qc", "old"))
+        store.db.execute("DELETE FROM jobs")
+
+        wrapper = MyWrapper("qc", "new")
+        store.save(wrapper)
+        assert wrapper.info.job_id == 2
+
+    # A batch of jobs should be saved in one go, or not at all
+    def test_save_many(self):
+        store = SQLiteJobStore()
+        saved = MyWrapper("qc", "old")
+        store.save(saved)
+
+        wrappers = [MyWrapper("qc", "a"), MyWrapper("report", "b")]
+        store.save_many(wrappers)
+        assert [w.info.job_id for w in wrappers] == [2, 3]
+
+        broken = MyWrapper("qc", "c")
+        broken.info.state = None
+        with pytest.raises(JobStoreError):
+            store.save_many([MyWrapper("qc", "d"), broken])
+        assert store.get("qc", 4) is None
+        assert len(store.find(State.QUEUED)) == 3
+
+    # Jobs should be found by state, oldest first, and be possible to mark
+    def test_find_and_mark(self):
+        store = SQLiteJobStore()
+        wrappers = [MyWrapper("qc", str(i)) for i in range(3)]
+        for wrapper in wrappers:
+            store.save(wrapper)
+
+        store.mark(wrappers[1].info.job_id, State.ERROR, "oops")
+
+        assert [r["runfolder"] for r in store.find(State.QUEUED)] == \
+            ["/vagrant/0", "/vagrant/2"]
+        error = store.find(State.ERROR)
+        assert len(error) == 1
+        assert error[0]["msg"] == "oops"
+        assert error[0]["finished_at"] >= error[0]["submitted_at"]
+
+    # Jobs should be listed newest first, filtered, and a page at a time
+    def test_query(self):
+        store = SQLiteJobStore()
+        for i in range(6):
+            wrapper = MyWrapper("qc" if i < 5 else "report", "rf{0}".format(i % 2))
+            wrapper.info.state = State.DONE if i % 3 else State.ERROR
+            store.save(wrapper)
+
+        ids = lambda records: [r["id"] for r in records]
+
+        assert ids(store.query("qc")) == [5, 4, 3, 2, 1]
+        assert ids(store.query("qc", limit=2)) == [5, 4]
+        assert ids(store.query("qc", before_id=4, limit=2)) == [3, 2]
+        assert ids(store.query("qc", states=[State.ERROR])) == [4, 1]
+        assert ids(store.query("qc", states=[State.ERROR, State.DONE])) == \
+            [5, 4, 3, 2, 1]
+        assert ids(store.query("qc", runfolder="/vagrant/rf1")) == [4, 2]
+        assert ids(store.query("report")) == [6]
+        assert "stdout" not in store.query("qc")[0]
+
+        store.db.execute("UPDATE jobs SET submitted_at = id")
+        assert ids(store.query("qc", submitted_after=3)) == [5, 4]
+
+    # The jobs should survive that the store is closed and opened again
+    def test_persistence(self, tmpdir):
+        path = str(tmpdir.join("jobs.db"))
+        store = SQLiteJobStore(path)
+        store.save(MyWrapper("report", "foo"))
+        store.close()
+
+        store = SQLiteJobStore(path)
+        assert store.db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert len(store.find(State.QUEUED)) == 1
+
+        store.save(MyWrapper("report", "bar"))
+        assert [r["id"] for r in store.find(State.QUEUED)] == [1, 2]
+
+    # Every queued job should be claimed by exactly one worker, even when
+    # several workers claim jobs at the same time
+    def test_claim(self, tmpdir):
+        import threading
+        path = str(tmpdir.join("jobs.db"))
+        store = SQLiteJobStore(path)
+        for i in range(40):
+            store.save(MyWrapper("qc" if i % 2 else "report", str(i)))
+
+        assert store.claim("w0", "host", types=[]) is None
+        record = store.claim("w0", "host", types=["qc"])
+        assert record["id"] == 2
+        assert record["state"] == State.STARTED
+        assert record["worker"] == "w0"
+        assert record["host"] == "host"
+
+        claimed = {}
+
+        def work(worker):
+            worker_store = SQLiteJobStore(path, logger=store.logger)
+            ids = claimed[worker] = []
+            while True:
+                record = worker_store.claim(worker, "host")
+                if record is None:
+                    break
+                ids.append(record["id"])
+
+        threads = [threading.Thread(target=work, args=("w{0}".format(i),))
+                   for i in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = sum(claimed.values(), [])
+        assert sorted(ids) == [i for i in range(1, 41) if i != 2]
+        for worker, worker_ids in claimed.items():
+            assert [r["id"] for r in store.find(State.STARTED, worker)] == \
+                sorted(worker_ids)
+        assert [r["id"] for r in store.get_many([3, 1, 99])] == [1, 3]
+
+    # With head starts, the job that is first in line by priority should be
+    # claimed, even if it was submitted later
+    def test_claim_by_priority(self):
+        store = SQLiteJobStore()
+        for runfolder, priority in [("a", "low"), ("b", "normal"),
+                                    ("c", "high"), ("d", "normal")]:
+            wrapper = MyWrapper("qc", runfolder)
+            wrapper.info.priority = priority
+            store.save(wrapper)
+        store.db.execute("UPDATE jobs SET submitted_at = 1000 + id")
+        store.db.execute("UPDATE jobs SET submitted_at = 700 WHERE id = 1")
+
+        head_starts = {"low": 0, "normal": 300, "high": 600}
+        claimed = []
+        while True:
+            record = store.claim("w1", "host", head_starts=head_starts)
+            if record is None:
+                break
+            claimed.append(record["runfolder"][-1])
+
+        assert claimed == ["c", "a", "b", "d"]
+        assert store.get("qc", 3)["priority"] == "high"
+
+    # Databases from before the worker column should get it
+    def test_add_worker_column(self, tmpdir):
+        import sqlite3
+        path = str(tmpdir.join("jobs.db"))
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "type TEXT NOT NULL, runfolder TEXT, params TEXT, "
+                   "state TEXT NOT NULL, pid INTEGER, host TEXT, msg TEXT, "
+                   "stdout TEXT, stderr TEXT, submitted_at REAL NOT NULL, "
+                   "updated_at REAL NOT NULL)")
+        db.close()
+
+        store = SQLiteJobStore(path)
+        store.save(MyWrapper("qc", "foo"))
+        assert store.claim("w1", "host")["worker"] == "w1"
+
+    # A database that can't be opened should give a JobStoreError
+    def test_open_error(self, tmpdir):
+        with pytest.raises(JobStoreError):
+            SQLiteJobStore(str(tmpdir.join("missing", "jobs.db")))
+
+
+class TestJobStore(object):
+
+    # The backend should be picked from the app config
+    def test_create(self, tmpdir, monkeypatch):
+        conf = ConfigurationService(app_config_path="./config/app.config")
+        app_config = dict(conf.get_app_config())
+        app_config["job_store_path"] = str(tmpdir.join("jobs.db"))
+        monkeypatch.setattr(conf, "get_app_config", lambda: app_config)
+
+        store = JobStore.create(conf)
+        assert isinstance(store, SQLiteJobStore)
+        assert store.path == app_config["job_store_path"]
+
+        app_config["job_store"] = "cassandra"
+        with pytest.raises(RuntimeError):
+            JobStore.create(conf)
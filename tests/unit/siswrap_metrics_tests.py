@@ -0,0 +1,68 @@
+from siswrap.metrics import *
+
+# Some tests for siswrap/metrics.py.
+
+
+class TestMetrics(object):
+
+    # Counters should be kept per combination of label values
+    def test_counter(self):
+        counter = Counter("jobs_total", "Jobs.", ["type", "state"])
+        counter.inc(("qc", "done"))
+        counter.inc(("qc", "done"))
+        counter.inc(("report", "error"), 3)
+
+        assert counter.value(("qc", "done")) == 2
+        assert counter.value(("qc", "error")) == 0
+        assert counter.exposition().split("\n") == [
+            "# HELP jobs_total Jobs.",
+            "# TYPE jobs_total counter",
+            "jobs_total{type=\"qc\",state=\"done\"} 2",
+            "jobs_total{type=\"report\",state=\"error\"} 3"]
+
+    # The buckets of a histogram should be cumulative, and a value on a
+    # bound should count in that bucket
+    def test_histogram(self):
+        histogram = Histogram("wait_seconds", "Wait.", [1, 5], ["type"])
+        for value in [0.5, 1, 3, 60]:
+            histogram.observe(value, ("qc",))
+
+        assert histogram.count(("qc",)) == 4
+        assert histogram.samples() == [
+            "wait_seconds_bucket{type=\"qc\",le=\"1\"} 2",
+            "wait_seconds_bucket{type=\"qc\",le=\"5\"} 3",
+            "wait_seconds_bucket{type=\"qc\",le=\"+Inf\"} 4",
+            "wait_seconds_sum{type=\"qc\"} 64.5",
+            "wait_seconds_count{type=\"qc\"} 4"]
+
+    # Gauges should be read when the metrics are collected, and label values
+    # should be escaped
+    def test_gauge(self):
+        values = {("a\"b",): 1}
+        gauge = Gauge("jobs", "Jobs.", lambda: values, ["type"])
+        values[("c",)] = 2
+
+        assert gauge.samples() == ["jobs{type=\"a\\\"b\"} 1",
+                                   "jobs{type=\"c\"} 2"]
+
+    # The job events should end up in the job metrics
+    def test_siswrap_metrics(self):
+        metrics = SiswrapMetrics(lambda: {("queued", "qc"): 2,
+                                          ("started", "report"): 1})
+        metrics.job_started("qc", 100.0, 130.0)
+        metrics.job_finished("qc", "timeout", 130.0, 200.0)
+        metrics.job_finished("report", "error", None, 200.0)
+        metrics.request_finished("RunHandler", 0.02)
+
+        text = metrics.exposition()
+        assert "siswrap_jobs_started_total{type=\"qc\"} 1\n" in text
+        assert "siswrap_jobs_failed_total{type=\"qc\"} 1\n" in text
+        assert "siswrap_jobs_failed_total{type=\"report\"} 1\n" in text
+        assert "siswrap_job_queue_wait_seconds_sum{type=\"qc\"} 30\n" in text
+        assert "siswrap_job_run_duration_seconds_count{type=\"qc\"} 1\n" in text
+        assert "siswrap_job_run_duration_seconds_count{type=\"report\"}" not in text
+        assert "siswrap_jobs_queued{type=\"qc\"} 2\n" in text
+        assert "siswrap_jobs_running{type=\"report\"} 1\n" in text
+        assert "siswrap_open_fds " in text
+        assert "siswrap_request_duration_seconds_bucket{handler=\"RunHandler\"," \
+               "le=\"0.025\"} 1\n" in text
@@ -0,0 +1,64 @@
+import pytest
+from arteria.configuration import ConfigurationService
+from siswrap.pipelines import *
+from siswrap.wrapper_services import *
+
+# Some tests for siswrap/pipelines.py.
+
+
+# Return true regardless whether or not the runfolder exists
+@pytest.fixture
+def stub_isdir(monkeypatch):
+    monkeypatch.setattr("os.path.isdir", lambda path: True)
+
+
+class TestPipeline(object):
+
+    conf = ConfigurationService(app_config_path="./config/app.config")
+
+    def step(self, wrapper_class, depends_on=()):
+        return PipelineStep(wrapper_class({"runfolder": "foo"}, self.conf),
+                            depends_on)
+
+    # Steps should become ready when their dependencies are done, and be
+    # cancelled when a dependency fails
+    def test_ready_steps(self, stub_isdir):
+        pipeline = Pipeline([self.step(CheckIndicesWrapper),
+                             self.step(AeacusStatsWrapper, ["checkindices"]),
+                             self.step(ReportWrapper, ["checkindices"]),
+                             self.step(AeacusReportsWrapper, ["aeacusstats"])])
+        steps = pipeline.steps
+
+        assert pipeline.state == State.PENDING
+        assert [s.name for s in pipeline.ready_steps()] == ["checkindices"]
+
+        steps["checkindices"].submitted = True
+        steps["checkindices"].wrapper.info.state = State.DONE
+        assert [s.name for s in pipeline.ready_steps()] == ["aeacusstats", "report"]
+        assert pipeline.state == State.STARTED
+
+        for name, state in [("aeacusstats", State.ERROR), ("report", State.DONE)]:
+            steps[name].submitted = True
+            steps[name].wrapper.info.state = state
+
+        pipeline.skip_blocked()
+        assert steps["aeacusreports"].state == State.CANCELLED
+        assert "aeacusstats" in steps["aeacusreports"].wrapper.info.msg
+        assert pipeline.ready_steps() == []
+        assert pipeline.finished
+        assert pipeline.state == State.ERROR
+
+    # A step can only depend on an earlier step, and only be there once
+    def test_invalid(self, stub_isdir):
+        with pytest.raises(RuntimeError):
+            Pipeline([self.step(ReportWrapper, ["qc"]), self.step(ReportWrapper)])
+        with pytest.raises(RuntimeError):
+            Pipeline([self.step(ReportWrapper), self.step(ReportWrapper)])
+        with pytest.raises(RuntimeError):
+            Pipeline([])
+
+    def test_chain(self, stub_isdir):
+        pipeline = Pipeline.chain([CheckIndicesWrapper({"runfolder": "foo"}, self.conf),
+                                   ReportWrapper({"runfolder": "foo"}, self.conf)])
+        assert pipeline.steps["checkindices"].depends_on == []
+        assert pipeline.steps["report"].depends_on == ["checkindices"]
@@ -0,0 +1,86 @@
+import os
+import signal
+import subprocess
+import pytest
+from tornado import gen
+from tornado.concurrent import Future
+from siswrap.reaper import *
+
+# Some tests for siswrap/reaper.py.
+
+
+class TestChildReaper(object):
+
+    def watch(self, process, usages=None):
+        future = Future()
+
+        def callback(returncode, usage):
+            if usages is not None:
+                usages.append(usage)
+            future.set_result(returncode)
+
+        ChildReaper.watch(process, callback)
+        return future
+
+    # The exit status of a watched process should be reported when it exits
+    @pytest.mark.gen_test
+    def test_exit_status(self):
+        proc = subprocess.Popen(["/bin/sh", "-c", "sleep 0.1; exit 3"])
+        returncode = yield self.watch(proc)
+        assert returncode == 3
+        assert proc.returncode == 3
+
+    # The resource usage of the process should be reported along with it
+    @pytest.mark.gen_test
+    def test_usage(self):
+        usages = []
+        proc = subprocess.Popen(["/bin/sh", "-c",
+                                 "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"])
+        returncode = yield self.watch(proc, usages)
+        assert returncode == 0
+        assert usages[0].ru_utime + usages[0].ru_stime > 0
+        assert usages[0].ru_maxrss > 0
+
+    # A process killed by a signal should get the negative signal number
+    @pytest.mark.gen_test
+    def test_killed(self):
+        proc = subprocess.Popen(["/bin/sleep", "10"])
+        future = self.watch(proc)
+        proc.send_signal(signal.SIGTERM)
+        returncode = yield future
+        assert returncode == -signal.SIGTERM
+
+    # A process that has exited before it's watched should still be reported
+    @pytest.mark.gen_test
+    def test_already_exited(self):
+        proc = subprocess.Popen(["/bin/true"])
+        yield gen.sleep(0.1)
+        returncode = yield self.watch(proc)
+        assert returncode == 0
+
+    # A process that somebody else has waited for should be reported with a
+    # lost exit status, not as a success
+    @pytest.mark.gen_test
+    def test_lost_exit_status(self):
+        proc = subprocess.Popen(["/bin/true"])
+        os.waitpid(proc.pid, 0)
+        returncode = yield self.watch(proc)
+        assert returncode is None
+        assert proc.returncode == ChildReaper.LOST_RETURNCODE
+
+    # A process whose IOLoop has been closed shouldn't stop the other
+    # processes from being reaped
+    @pytest.mark.gen_test
+    def test_closed_io_loop(self):
+        from tornado.ioloop import IOLoop
+
+        closed_loop = IOLoop()
+        closed_loop.close()
+        orphan = subprocess.Popen(["/bin/true"])
+        ChildReaper._watched[orphan.pid] = (orphan, lambda code, usage: None,
+                                            closed_loop)
+
+        proc = subprocess.Popen(["/bin/sh", "-c", "sleep 0.1; exit 2"])
+        returncode = yield self.watch(proc)
+        assert returncode == 2
+        assert orphan.pid not in ChildReaper._watched
@@ -0,0 +1,153 @@
+import time
+import pytest
+import threading
+from arteria.configuration import ConfigurationService
+from siswrap.result_cache import *
+from siswrap.wrapper_services import *
+from siswrap_test_helpers import *
+
+# Some tests for siswrap/result_cache.py.
+
+
+# Return true regardless whether or not the runfolder exists
+@pytest.fixture
+def stub_isdir(monkeypatch):
+    monkeypatch.setattr("os.path.isdir", lambda path: True)
+
+
+class StubVersionService(object):
+
+    def __init__(self, version="15.3.2"):
+        self.version = version
+
+    def get(self):
+        return self.version
+
+
+class TestResultCache(object):
+
+    conf = ConfigurationService(app_config_path="./config/app.config")
+
+    def wrapper(self, runfolder, params=None):
+        params = dict(params or {}, runfolder="foo")
+        wrapper = ReportWrapper(params, self.conf)
+        wrapper.info.runfolder = runfolder
+        return wrapper
+
+    # The fingerprint should change when an input file or the Sisyphus
+    # version changes, but not otherwise
+    def test_fingerprint(self, tmpdir, stub_isdir):
+        runfolder = str(tmpdir)
+        tmpdir.join("RunInfo.xml").write("<RunInfo/>")
+        tmpdir.mkdir("InterOp").join("QMetricsOut.bin").write("x")
+
+        version_svc = StubVersionService()
+        cache = ResultCache(self.conf, version_svc)
+        first = cache.fingerprint(self.wrapper(runfolder))
+        assert first == cache.fingerprint(self.wrapper(runfolder))
+        assert first != cache.fingerprint(self.wrapper(runfolder,
+                                                       {"sisyphus_config": "a: 1"}))
+
+        tmpdir.join("InterOp", "QMetricsOut.bin").write("xy")
+        second = cache.fingerprint(self.wrapper(runfolder))
+        assert second != first
+
+        tmpdir.join("SampleSheet.csv").write("[Data]")
+        assert cache.fingerprint(self.wrapper(runfolder)) != second
+
+        version_svc.version = None
+        assert cache.fingerprint(self.wrapper(runfolder)) is None
+
+    # The output of the steps before should count as input, to the steps
+    # that read it
+    def test_input_dirs(self, tmpdir, stub_isdir):
+        runfolder = str(tmpdir)
+        tmpdir.join("Unaligned", "Project_A", "Sample_1", "R1.fastq.gz").write(
+            "x", ensure=True)
+        tmpdir.join("Summary", "report.xml").write("<report/>", ensure=True)
+
+        cache = ResultCache(self.conf, StubVersionService())
+        stats = AeacusStatsWrapper({"runfolder": "foo"}, self.conf)
+        stats.info.runfolder = runfolder
+        report = self.wrapper(runfolder)
+        assert "Unaligned/Project_A/Sample_1/R1.fastq.gz" in \
+            [path for path, _ in cache.input_state(report)]
+
+        stats_first = cache.fingerprint(stats)
+        report_first = cache.fingerprint(report)
+        tmpdir.join("Summary", "report.xml").write("<report>1</report>")
+        assert cache.fingerprint(stats) == stats_first
+        assert cache.fingerprint(report) != report_first
+
+        tmpdir.join("Unaligned", "Project_A", "Sample_1", "R2.fastq.gz").write("y")
+        assert cache.fingerprint(stats) != stats_first
+
+        # A job with more input files than are looked at isn't cached
+        cache.max_input_entries = 2
+        assert cache.input_state(report) is None
+        assert cache.fingerprint(report) is None
+
+    # The input files should be looked at off the IOLoop, and only once for
+    # the jobs of a batch that have the same inputs
+    @pytest.mark.gen_test
+    def test_fingerprint_all(self, tmpdir, stub_isdir, monkeypatch):
+        runfolder = str(tmpdir)
+        tmpdir.join("RunInfo.xml").write("<RunInfo/>")
+        cache = ResultCache(self.conf, StubVersionService())
+
+        threads = []
+        input_state = cache.input_state
+
+        def my_input_state(wrapper):
+            threads.append(threading.current_thread())
+            return input_state(wrapper)
+
+        monkeypatch.setattr(cache, "input_state", my_input_state)
+        stats = AeacusStatsWrapper({"runfolder": "foo"}, self.conf)
+        stats.info.runfolder = runfolder
+        wrappers = [self.wrapper(runfolder), self.wrapper(runfolder), stats]
+
+        fingerprints = yield cache.fingerprint_all(wrappers)
+        assert len(threads) == 2
+        assert threading.current_thread() not in threads
+        assert fingerprints == [cache.fingerprint(wrapper)
+                                for wrapper in wrappers]
+
+        del threads[:]
+        cache.max_entries = 0
+        assert (yield cache.fingerprint_all(wrappers)) == [None, None, None]
+        assert threads == []
+        cache.version_svc.version = None
+        assert (yield cache.fingerprint_all(wrappers)) == [None, None, None]
+
+    # The least recently used entries should be evicted first
+    def test_lru(self):
+        cache = ResultCache(self.conf, StubVersionService())
+        cache.max_entries = 2
+
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+        cache.discard("c")
+        assert cache.get("c") is None
+
+    # Entries should expire after the TTL
+    def test_ttl(self, monkeypatch):
+        cache = ResultCache(self.conf, StubVersionService())
+        cache.ttl = 10
+
+        now = time.time()
+        monkeypatch.setattr("time.time", lambda: now)
+        cache.put("a", 1)
+        assert cache.get("a") == 1
+
+        monkeypatch.setattr("time.time", lambda: now + 11)
+        assert cache.get("a") is None
+        assert len(cache) == 0
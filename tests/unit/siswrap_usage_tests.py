@@ -0,0 +1,44 @@
+import os
+import resource
+from siswrap.usage import *
+
+# Some tests for siswrap/usage.py.
+
+
+class TestProcessUsage(object):
+
+    # The memory, context switches and I/O should be read from the proc file
+    # system, and whatever can't be read left out
+    def test_sample(self, tmpdir):
+        tmpdir.join("4242", "status").write(
+            "Name:\tperl\nVmHWM:\t  204800 kB\nVmRSS:\t  102400 kB\n"
+            "voluntary_ctxt_switches:\t17\n"
+            "nonvoluntary_ctxt_switches:\t3\n", ensure=True)
+        tmpdir.join("4242", "io").write(
+            "rchar: 100\nread_bytes: 4096\nwrite_bytes: 0\n")
+        tmpdir.join("3131", "status").write("VmRSS:\t  1024 kB\n", ensure=True)
+
+        usage = ProcessUsage(str(tmpdir))
+        assert usage.sample(4242) == {"max_rss_kb": 204800,
+                                      "rss_kb": 102400,
+                                      "voluntary_context_switches": 17,
+                                      "involuntary_context_switches": 3,
+                                      "read_bytes": 4096,
+                                      "write_bytes": 0}
+        assert usage.sample(3131) == {"rss_kb": 1024}
+        assert usage.sample(5353) == {}
+
+    # The process running the tests should be possible to sample
+    def test_sample_self(self):
+        usage = ProcessUsage().sample(os.getpid())
+        assert usage["rss_kb"] > 0
+        assert usage["max_rss_kb"] >= usage["rss_kb"]
+
+    # The usage from wait4 should have all the fields, with the CPU times
+    # rounded to milliseconds
+    def test_from_rusage(self):
+        usage = ProcessUsage.from_rusage(resource.getrusage(resource.RUSAGE_SELF))
+        assert sorted(usage) == sorted(name for name, _
+                                       in ProcessUsage.RUSAGE_FIELDS)
+        assert usage["user_cpu_seconds"] == round(usage["user_cpu_seconds"], 3)
+        assert usage["max_rss_kb"] > 0
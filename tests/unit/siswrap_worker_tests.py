@@ -0,0 +1,80 @@
+import pytest
+from collections import deque
+from tornado import gen
+from arteria.configuration import ConfigurationService
+from siswrap.job_store import SQLiteJobStore
+from siswrap.worker import *
+from siswrap.wrapper_services import *
+
+# Some tests for siswrap/worker.py.
+
+
+@pytest.fixture
+def stub_isdir(monkeypatch):
+    monkeypatch.setattr("os.path.isdir", lambda path: True)
+
+
+@pytest.fixture
+def job_queues(monkeypatch):
+    monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+    monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+
+class TestWorker(object):
+
+    conf = ConfigurationService(app_config_path="./config/app.config")
+
+    def submit(self, store, runfolder):
+        wrapper = ReportWrapper({"runfolder": runfolder}, self.conf)
+        wrapper.info.set_queued(None)
+        store.save(wrapper)
+        return wrapper.info.job_id
+
+    # The worker should claim as many jobs as it has slots for, run them and
+    # save how they went in the job store
+    @pytest.mark.gen_test(timeout=10)
+    def test_poll(self, tmpdir, stub_isdir, job_queues, monkeypatch):
+        class MockedExecString(object):
+            def __init__(self, wrapper, conf, runfolder):
+                self.text = ["/bin/bash", "-c", "echo uggla"]
+
+        app_config = dict(self.conf.get_app_config())
+        app_config["job_log_root"] = str(tmpdir.join("logs"))
+        monkeypatch.setattr(self.conf, "get_app_config", lambda: app_config)
+        monkeypatch.setattr("siswrap.wrapper_services.ExecStringWithEmailConfig",
+                            MockedExecString)
+
+        store = SQLiteJobStore(str(tmpdir.join("jobs.db")))
+        job_ids = [self.submit(store, name) for name in ["foo", "bar", "baz"]]
+
+        worker = Worker(self.conf, store, "worker-1")
+        # There are two slots for reports in the app config
+        assert worker.poll() == 2
+        assert worker.poll() == 0
+
+        while store.get("report", job_ids[1])["state"] != State.DONE:
+            yield gen.sleep(0.05)
+
+        assert worker.poll() == 1
+        while store.get("report", job_ids[2])["state"] != State.DONE:
+            yield gen.sleep(0.05)
+
+        for record in store.get_many(job_ids):
+            assert record["worker"] == "worker-1"
+            assert record["stdout"] == "uggla\n"
+            assert record["pid"] is not None
+
+        worker.poll()
+        assert len(ProcessService.proc_queue) == 0
+
+    # Only the jobs of this worker should be failed when it restarts
+    def test_recover(self, stub_isdir, job_queues):
+        store = SQLiteJobStore()
+        self.submit(store, "foo")
+        self.submit(store, "bar")
+        store.claim("worker-1", "host")
+        store.claim("worker-2", "host")
+
+        Worker(self.conf, store, "worker-1").recover()
+        assert store.get("report", 1)["state"] == State.ERROR
+        assert store.get("report", 2)["state"] == State.STARTED
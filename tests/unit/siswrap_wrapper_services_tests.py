@@ -1,4 +1,6 @@
 import pytest
+import logging
+from tornado import gen
 from arteria.configuration import ConfigurationService
 from arteria.web.state import State
 from siswrap.handlers import *
@@ -12,7 +14,10 @@ class TestProcessInfo(object):
 
     STATE_NONE = "none"
     STATE_STARTED = "started"
-    NR_ELEMENTS = 9  # runfolder, host, state, proc, msg, pid, link, stdout, stderr
+    # runfolder, host, state, proc, msg, pid, link, stdout, stderr,
+    # queue_position, output, job_id, profile, priority, queued_at,
+    # started_at, submitted_at, finished_at, collected_at, usage
+    NR_ELEMENTS = 21
 
     # A newly created object should be STATE_NONE, and
     # have the right number of properties
@@ -24,9 +29,10 @@ class TestProcessInfo(object):
     # A ProcessInfo without an existing process should
     # still contain some valid data
     def test_none_process(self):
-        pid = 4242
-        proc_info = ProcessInfo.none_process(pid)
-        assert proc_info.pid == pid
+        job_id = 4242
+        proc_info = ProcessInfo.none_process(job_id)
+        assert proc_info.job_id == job_id
+        assert proc_info.pid is None
         assert proc_info.state == self.STATE_NONE
         assert len(proc_info.msg) > 0
 
@@ -50,6 +56,51 @@ class TestProcessInfo(object):
         assert len(proc_info.msg) > 0
 
 
+    # A ProcessInfo for an exited process should get its state from the
+    # return code of the process
+    def test_exited(self):
+        proc_info = ProcessInfo()
+
+        # a negative return code means that the process was killed
+        proc_info.set_exited(-9, None, None)
+        assert proc_info.state == State.ERROR
+
+        proc_info.set_exited(0, "out", "err")
+        assert proc_info.state == State.DONE
+        assert proc_info.stdout == "out"
+        assert proc_info.stderr == "err"
+
+        proc_info.set_exited(1, "", "failed")
+        assert proc_info.state == State.ERROR
+        assert "1" in proc_info.msg
+        assert proc_info.finished_at is not None
+
+        # a lost exit status mustn't pass for a success
+        proc_info.set_exited(None, "", "")
+        assert proc_info.state == State.ERROR
+        assert "lost" in proc_info.msg
+
+    # The durations should be known as soon as both their times are, and
+    # never be negative
+    def test_timings(self):
+        proc_info = ProcessInfo()
+        proc_info.submitted_at = 1000.0
+        proc_info.started_at = 1012.5
+        assert proc_info.timings()["queue_seconds"] == 12.5
+        assert proc_info.timings()["run_seconds"] is None
+
+        proc_info.finished_at = 1100.0
+        proc_info.collected_at = 1099.0
+        assert proc_info.timings() == {"submitted_at": 1000.0,
+                                       "started_at": 1012.5,
+                                       "finished_at": 1100.0,
+                                       "collected_at": 1099.0,
+                                       "queue_seconds": 12.5,
+                                       "run_seconds": 87.5,
+                                       "turnaround_seconds": 100.0,
+                                       "collection_delay_seconds": 0.0}
+
+
 # Mini helper class for some of the tests
 class Helper(object):
     runfolder = "foo"
@@ -68,6 +119,25 @@ class Helper(object):
     proc_svc = ProcessService(conf)
 
 
+# Keep track of the processes the ProcessService wants to be told about
+# when they exit, instead of waiting for them for real
+@pytest.fixture
+def stub_reaper(monkeypatch):
+    watched = {}
+
+    def my_watch(process, callback):
+        watched[process.pid] = callback
+
+    monkeypatch.setattr("siswrap.wrapper_services.ChildReaper.watch",
+                        staticmethod(my_watch))
+    return watched
+
+
+class MyProc(object):
+    def __init__(self, pid):
+        self.pid = pid
+
+
 # Return true regardless whether or not the runfolder exists
 @pytest.fixture
 def stub_isdir(monkeypatch):
@@ -131,7 +201,8 @@ class TestWrapper(object):
 
     # Run method should setup a ExecString for the calling object in question
     # and spawn a subprocess with it, as well as update the process info's
-    # attributes.
+    # attributes. The output should end up in the job's log files.
+    @pytest.mark.gen_test
     def test_run(self, stub_isdir, monkeypatch):
         pass_mocked = True
 
@@ -144,17 +215,88 @@ class TestWrapper(object):
 
         monkeypatch.setattr("siswrap.wrapper_services.ExecStringWithEmailConfig", MockedExecString)
         w = Wrapper(Helper.params, Helper.conf)
+        w.type_txt = "wrapper_test"
         w.run()
 
         assert isinstance(w.info.proc, subprocess.Popen)
         assert w.info.state == "started"
-        out, err = w.info.proc.communicate()
-        assert out == "uggla\n"
+        assert w.info.profile is None
+        yield w.info.output.wait_for_close()
+        assert w.info.output.tail("stdout") == "uggla\n"
+        with open(w.info.output.paths["stdout"]) as f:
+            assert f.read() == "uggla\n"
 
         pass_mocked = False
         w.run()
-        with pytest.raises(Exception) as err:
-            out, err = w.info.proc.communicate()
+        assert w.info.state == State.ERROR
+
+    # A job whose log files can't be written shouldn't have its process
+    # started at all, since nobody would watch it
+    @pytest.mark.gen_test
+    def test_run_without_logs(self, stub_isdir, monkeypatch, tmpdir):
+        started = tmpdir.join("started")
+
+        class MockedExecString(object):
+            def __init__(self, wrapper, conf, runfolder):
+                self.text = ["/bin/bash", "-c", "touch {0}".format(started)]
+
+        monkeypatch.setattr("siswrap.wrapper_services.ExecStringWithEmailConfig", MockedExecString)
+        not_a_dir = tmpdir.join("not_a_dir")
+        not_a_dir.write("")
+        monkeypatch.setattr(Wrapper, "log_prefix",
+                            lambda self: str(not_a_dir.join("logs", "qc_1")))
+        w = Wrapper(Helper.params, Helper.conf)
+        w.type_txt = "wrapper_test"
+        w.run()
+
+        assert w.info.state == State.ERROR
+        assert "Not a directory" in w.info.msg
+        assert w.info.proc is None
+        yield gen.sleep(0.2)
+        assert not started.check()
+
+    # Stopping a job should stop the processes it has started as well
+    @pytest.mark.gen_test
+    def test_stop(self, stub_isdir, monkeypatch, tmpdir):
+        child_file = tmpdir.join("child")
+
+        class MockedExecString(object):
+            def __init__(self, wrapper, conf, runfolder):
+                self.text = ["/bin/bash", "-c", "sleep 60 & echo $! > {0}; wait".
+                             format(child_file)]
+
+        monkeypatch.setattr("siswrap.wrapper_services.ExecStringWithEmailConfig", MockedExecString)
+        w = Wrapper(Helper.params, Helper.conf)
+        w.type_txt = "wrapper_test"
+        assert w.stop() is False
+
+        w.run()
+        assert os.getpgid(w.info.pid) == w.info.pid
+        while not child_file.check() or not child_file.read().strip():
+            yield gen.sleep(0.01)
+
+        assert w.stop() is True
+        # The output is only closed once the child that shares it is gone
+        yield w.info.output.wait_for_close()
+        assert w.info.proc.wait() == -signal.SIGTERM
+
+    # Jobs of the same type, for the same runfolder and with the same
+    # configs should be duplicates
+    def test_duplicates(self, stub_isdir):
+        qc = QCWrapper(Helper.qcparams, Helper.conf)
+        same = QCWrapper(dict(Helper.qcparams), Helper.conf)
+        other_config = QCWrapper(dict(Helper.qcparams, qc_config=u"<xml/>"),
+                                 Helper.conf)
+        other_runfolder = QCWrapper(dict(Helper.qcparams, runfolder="bar"),
+                                    Helper.conf)
+        report = ReportWrapper(Helper.params, Helper.conf)
+
+        assert qc.config_digest() == same.config_digest()
+        assert qc.config_digest() != other_config.config_digest()
+        assert qc.duplicates(same)
+        assert not qc.duplicates(other_config)
+        assert not qc.duplicates(other_runfolder)
+        assert not qc.duplicates(report)
 
     # Helper method should return the correct wrapper object for
     # different text inputs
@@ -227,6 +369,26 @@ class TestQCWrapper(object):
         assert isinstance(qc.conf_svc, ConfigurationService) is True
 
 
+    # The configs should only be written to the runfolder when the job is
+    # started
+    def test_write_config_files(self, stub_isdir, monkeypatch):
+        written = {}
+
+        def my_new_conf(path, content):
+            written[path] = content
+
+        monkeypatch.setattr("siswrap.wrapper_services.Wrapper.write_new_config_file",
+                            staticmethod(my_new_conf))
+
+        params = dict(Helper.qcparams, sisyphus_config=TestHelpers.SISYPHUS_CONFIG)
+        qc = QCWrapper(params, Helper.conf)
+        assert written == {}
+
+        qc.write_config_files()
+        runpath = Helper.root + "/" + Helper.runfolder
+        assert written == {runpath + "/sisyphus_qc.xml": TestHelpers.QC_CONFIG,
+                           runpath + "/sisyphus.yml": TestHelpers.SISYPHUS_CONFIG}
+
     # QCWrapper should be able to get the attributes from ProcessInfo
     def test_info_attr(self, stub_isdir):
         qc = QCWrapper(Helper.params, Helper.conf)
@@ -263,6 +425,134 @@ class TestExecString(object):
         assert Helper.runfolder in retobj.text
 
 
+class TestSisyphusVersionService(object):
+
+    class MyConf(object):
+        def __init__(self, version_bin):
+            self.version_bin = version_bin
+
+        def get_app_config(self):
+            return {"perl": "/bin/sh", "version_bin": self.version_bin}
+
+    def write_version_script(self, path, version):
+        with open(path, "w") as f:
+            f.write("echo {0}\n".format(version))
+
+    # The version should be looked up once and then served from memory, until
+    # the version script changes, when it's refreshed in the background
+    @pytest.mark.gen_test
+    def test_cached_version(self, tmpdir, monkeypatch):
+        version_bin = str(tmpdir.join("version.pl"))
+        self.write_version_script(version_bin, "15.3.2")
+
+        version_svc = SisyphusVersionService(self.MyConf(version_bin))
+        assert version_svc.resolve() == "15.3.2"
+
+        def my_check_output(cmd):
+            raise AssertionError("The version should be cached")
+
+        monkeypatch.setattr("siswrap.wrapper_services.check_output", my_check_output)
+        assert version_svc.get() == "15.3.2"
+        assert version_svc.get() == "15.3.2"
+        monkeypatch.undo()
+
+        self.write_version_script(version_bin, "16.0.0")
+        stat = os.stat(version_bin)
+        os.utime(version_bin, (stat.st_atime, stat.st_mtime + 10))
+
+        # The old version is served until the refresh is done
+        assert version_svc.get() == "15.3.2"
+        for _ in range(100):
+            if version_svc.get() == "16.0.0":
+                break
+            yield gen.sleep(0.02)
+
+        assert version_svc.get() == "16.0.0"
+
+    # A lookup that failed should be retried, even though the version script
+    # hasn't changed since
+    @pytest.mark.gen_test
+    def test_retried_lookup(self, tmpdir, monkeypatch):
+        version_bin = str(tmpdir.join("version.pl"))
+        self.write_version_script(version_bin, "15.3.2")
+        version_svc = SisyphusVersionService(self.MyConf(version_bin))
+
+        def my_check_output(cmd):
+            raise OSError("Transient failure")
+
+        monkeypatch.setattr("siswrap.wrapper_services.check_output", my_check_output)
+        assert version_svc.resolve() is None
+        monkeypatch.undo()
+
+        # Not until the retry interval has passed
+        assert version_svc.get() is None
+        assert not version_svc._refreshing
+        version_svc._retry_at = 0
+
+        for _ in range(100):
+            if version_svc.get() == "15.3.2":
+                break
+            yield gen.sleep(0.02)
+
+        assert version_svc.get() == "15.3.2"
+
+    # A version script that can't be run shouldn't break the service
+    def test_failing_lookup(self, tmpdir):
+        version_svc = SisyphusVersionService(self.MyConf(str(tmpdir.join("nope.pl"))))
+        assert version_svc.resolve() is None
+
+
+class TestJobIndex(object):
+
+    class MyWrapper(object):
+        def __init__(self, job_id, wrapper_type, state):
+            self.info = ProcessInfo(state=state)
+            self.info.job_id = job_id
+            self.type_txt = wrapper_type
+
+    # Jobs should be found by id, by type and by state, and the state index
+    # should follow the state changes it is told about
+    def test_index(self):
+        qc = self.MyWrapper(1, "qc", State.STARTED)
+        report = self.MyWrapper(2, "report", State.STARTED)
+        queued = self.MyWrapper(3, "qc", State.QUEUED)
+        index = JobIndex([qc, report, queued])
+
+        assert len(index) == 3
+        assert index[2] is report
+        assert 3 in index
+        assert index.get(4) is None
+        assert sorted(w.info.job_id for w in index.of_type("qc")) == [1, 3]
+        assert sorted(w.info.job_id for w in index.in_state(State.STARTED)) == [1, 2]
+        assert index.of_type("aeacusstats") == []
+
+        qc.info.state = State.DONE
+        index.update_state(qc)
+        assert [w.info.job_id for w in index.in_state(State.DONE)] == [1]
+        assert [w.info.job_id for w in index.in_state(State.STARTED)] == [2]
+
+        assert index.remove(1) is qc
+        assert index.remove(1) is None
+        assert 1 not in index
+        assert [w.info.job_id for w in index.of_type("qc")] == [3]
+        assert index.in_state(State.DONE) == []
+
+        # A job that has been removed shouldn't come back on a state change
+        index.update_state(qc)
+        assert 1 not in index
+        assert index._by_state.keys().count(State.DONE) == 0
+
+    # The jobs of a type should be listed in the order of their ids, also
+    # when they were added out of order
+    def test_type_order(self):
+        index = JobIndex([self.MyWrapper(job_id, "qc", State.DONE)
+                          for job_id in [5, 2, 7]])
+        index.add(self.MyWrapper(9, "qc", State.DONE))
+        index.add(self.MyWrapper(1, "qc", State.DONE))
+        index.remove(7)
+        assert [w.info.job_id for w in index.of_type("qc")] == [1, 2, 5, 9]
+
+
 class TestProcessService(object):
 
     my_queue = {}
@@ -272,36 +562,41 @@ class TestProcessService(object):
     def test_creation(self):
         ps = ProcessService(Helper.proc_svc.conf_svc)
         assert isinstance(ps.conf_svc, ConfigurationService) is True
-        assert type(ps.proc_queue) is dict
+        assert isinstance(ps.proc_queue, JobIndex)
 
     # ProcessService should be able to run a specified wrapper object,
     # which should then end up in the process queue for later status polling
-    def test_run(self):
+    def test_run(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
         ps = ProcessService(Helper.proc_svc.conf_svc)
 
-        class MyInfo(object):
-            pid = 4242
-
         class MyWrapper(object):
-            info = MyInfo()
+            info = ProcessInfo()
+            type_txt = "report"
 
             def run(self):
+                self.info.set_started(MyProc(4242))
                 return "foo"
 
         my_obj = MyWrapper()
         res = ps.run(my_obj)
         assert res == my_obj
         assert res.info.pid == 4242
-        assert ps.proc_queue[res.info.pid] == res
+        assert res.info.job_id is not None
+        assert ps.proc_queue[res.info.job_id] == res
+        assert 4242 in stub_reaper
 
     def setup_queue(self):
-        class MyInfo(object):
+        class MyInfo(ProcessInfo):
             def __init__(self, pid):
+                super(MyInfo, self).__init__()
+                self.job_id = pid
                 self.pid = pid
                 self.runfolder = pid
                 self.host = pid
                 self.state = State.STARTED
                 self.proc = subprocess.Popen("/bin/bash")
+                self.priority = "normal"
                 print "self", self.pid
 
         class MyWrapper(object):
@@ -312,80 +607,72 @@ class TestProcessService(object):
             def run(self):
                 return "foo"
 
-        queue = {4242: MyWrapper(4242, "qc"), 3131:
-                 MyWrapper(3131, "report"), 5353: MyWrapper(5353)}
+        queue = JobIndex([MyWrapper(4242, "qc"), MyWrapper(3131, "report"),
+                          MyWrapper(5353)])
         return queue
 
-    def my_poll(self, pid):
-        # print "polling pid", pid
-        # wrapper_type = self.my_queue.get(pid).type_txt
-        # print "returning wrapper type", wrapper_type,
-        # "with state",self.my_queue.get(pid).info.state
-        return self.my_queue.get(pid).info
-
-    # Test that we can poll a specific process in the process queue correctly
-    def test_polling(self, monkeypatch):
+    # The state of a job should be updated when its process exits, without
+    # anybody polling the process
+    def test_exit(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
         ps = ProcessService(Helper.proc_svc.conf_svc)
-        poll_return = 0
-        # populate queue
-        self.my_queue = self.setup_queue()
-        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue",
-                            self.my_queue)
 
-        # mock syscall
-        def my_communicate(self):
-            return ("", "")
+        class MyWrapper(object):
+            def __init__(self, pid):
+                self.info = ProcessInfo()
+                self.type_txt = "qc"
+                self.pid = pid
+
+            def run(self):
+                self.info.set_started(MyProc(self.pid))
 
         def my_poll(self):
-            return poll_return
-        monkeypatch.setattr("subprocess.Popen.communicate", my_communicate)
+            raise AssertionError("The process shouldn't be polled")
+
         monkeypatch.setattr("subprocess.Popen.poll", my_poll)
-        # self.my_queue[4242].info.proc = MyProc
 
-        # check that we get none process info if we request invalid pid
-        res = ps.poll_process(7575)
-        assert res.pid == 7575
+        for pid, returncode, state in [(4242, -1, State.ERROR),
+                                       (3131, 0, State.DONE),
+                                       (5353, 1, State.ERROR)]:
+            wrapper = ps.run(MyWrapper(pid))
+            job_id = wrapper.info.job_id
+            assert ps.get_status(job_id, "qc").state == State.STARTED
+
+            stub_reaper[pid](returncode)
+            assert wrapper.info.state == state
+            assert ps.get_status(job_id, "qc").state == state
+
+            # The times should be saved with the job, including when its
+            # result was collected
+            record = ps.store.get("qc", job_id)
+            assert record["submitted_at"] <= record["started_at"] <= \
+                record["finished_at"] <= record["collected_at"]
+            assert record["collected_at"] == wrapper.info.collected_at
+
+        # check that we get none process info if we request invalid job id
+        res = ps.get_status(7575, "qc")
+        assert res.job_id == 7575
         assert res.state == State.NONE
 
-        # check that we get a state_error if the return value from poll
-        # is negative
-        poll_return = -1
-        res = ps.poll_process(4242)
-        assert res.pid == 4242
-        assert res.state == State.ERROR
-
-        # check that we get a state_done if the return value is 0.
-        poll_return = 0
-        res = ps.poll_process(3131)
-        assert res.pid == 3131
-        assert res.state == State.DONE
-
-        # check that we get a state_error when retcode > 0
-        poll_return = 1
-        res = ps.poll_process(5353)
-        assert res.pid == 5353
-        assert res.state == State.ERROR
-
-        # check that we get state_started when we don't have a return code
-        poll_return = None
-        res = ps.poll_process(4242)
-        assert res.pid == 4242
-        assert res.state == State.STARTED
-
-    def test_polling_get_stdout_stderr(self, monkeypatch):
+    @pytest.mark.gen_test
+    def test_exit_get_stdout_stderr(self, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
 
         class WrapperStub(Wrapper):
             def __init__(self, cmd):
                 self.info = ProcessInfo()
                 self.type_txt = "wrapper_stub"
                 self.cmd = cmd
+                self.conf_svc = Helper.conf
+                self.logger = logging.getLogger(__name__)
 
             def run(self):
-                this_proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
-                                             stderr=subprocess.PIPE, shell=True)
-                self.info.proc = this_proc
-                self.info.pid = this_proc.pid
+                this_proc = Subprocess(self.cmd, stdout=Subprocess.STREAM,
+                                       stderr=Subprocess.STREAM, shell=True)
+                self.info.set_started(this_proc.proc)
+                self.info.output = JobOutput(this_proc, self.log_prefix(), 1024)
 
+        @gen.coroutine
         def run_test_with_wrapper(wrapper):
 
             ps = ProcessService(Helper.proc_svc.conf_svc)
@@ -395,21 +682,30 @@ class TestProcessService(object):
             i = 0
             while True and i < 100:
                 i += 1
-                result = ps.get_status(wrapper.info.pid, "wrapper_stub")
+                result = ps.get_status(wrapper.info.job_id, "wrapper_stub")
                 if not result.state == State.STARTED:
                     break
+                yield gen.sleep(0.02)
 
-            return result
+            raise gen.Return(result)
 
         test_stderr_wrapper = WrapperStub(["ech", "Hello World"])
-        result_std_err = run_test_with_wrapper(test_stderr_wrapper)
-        assert result_std_err.stderr.strip() == "Hello World: 1: Hello World: ech: not found"
+        result_std_err = yield run_test_with_wrapper(test_stderr_wrapper)
+        assert result_std_err.stderr.strip().endswith("ech: not found")
 
         test_stdout_wrapper = WrapperStub("echo Hello World && echo Hello Human 1>&2 && false")
-        result_std_out = run_test_with_wrapper(test_stdout_wrapper)
+        result_std_out = yield run_test_with_wrapper(test_stdout_wrapper)
         assert result_std_out.stdout.strip() == "Hello World"
         assert result_std_out.stderr.strip() == "Hello Human"
 
+        # Only the tail of a chatty job should be kept in memory
+        test_chatty_wrapper = WrapperStub("head -c 1000000 /dev/zero")
+        result_chatty = yield run_test_with_wrapper(test_chatty_wrapper)
+        assert result_chatty.state == State.DONE
+        assert len(result_chatty.stdout) == 1024
+        assert os.path.getsize(result_chatty.output.paths["stdout"]) == 1000000
+        assert result_chatty.usage["max_rss_kb"] > 0
+
     # Test that we can check the status of a specific process in the
     # process queue
     def test_status(self, monkeypatch):
@@ -421,11 +717,8 @@ class TestProcessService(object):
                             self.my_queue)
 
         # Check that the type_txt describes the same wrapper_type as we request
-        # in the call to get_status; if so, poll the wrappers pid; else
+        # in the call to get_status; if so, return the wrappers info; else
         # return an empty ProcessInfo
-        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.poll_process",
-                            self.my_poll)
-
         res = ps.get_status(4242, "qc")
         assert res.pid == 4242
         assert res.state == State.STARTED
@@ -446,12 +739,777 @@ class TestProcessService(object):
         with pytest.raises(Exception) as err:
             self.my_queue[4242]
 
-        # Check that if we request a pid with wrong type we get none
+        # Check that if we request a job id with wrong type we get none
         # as response
         res = ps.get_status(3131, "qc")
-        assert res.pid == 3131
+        assert res.job_id == 3131
         assert res.state == State.NONE
 
+    # Jobs above the concurrency limits should wait in the queue, and be
+    # started by the dispatcher once a slot has been freed
+    def test_run_queues_when_no_free_slot(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+        class MyWrapper(object):
+            next_pid = 1000
+
+            def __init__(self, wrapper_type):
+                self.info = ProcessInfo(runfolder=wrapper_type)
+                self.type_txt = wrapper_type
+
+            def run(self):
+                MyWrapper.next_pid += 1
+                self.info.set_started(MyProc(MyWrapper.next_pid))
+
+            def duplicates(self, other):
+                return False
+
+        ps = ProcessService(Helper.conf)
+        ps.max_jobs = 2
+        ps.max_jobs_per_type = {"qc": 1}
+
+        first_qc = ps.run(MyWrapper("qc"))
+        second_qc = ps.run(MyWrapper("qc"))
+        report = ps.run(MyWrapper("report"))
+        second_report = ps.run(MyWrapper("report"))
+
+        # The second QC has to wait for a QC slot, but doesn't block the
+        # report; the second report is held back by the global cap
+        assert first_qc.info.state == State.STARTED
+        assert second_qc.info.state == State.QUEUED
+        assert report.info.state == State.STARTED
+        assert second_report.info.state == State.QUEUED
+        assert second_qc.info.queue_position == 1
+        assert second_report.info.queue_position == 2
+
+        queued = [p for p in ps.get_all("qc") if p["state"] == State.QUEUED]
+        assert queued[0].pop("effective_priority") >= 1
+        assert queued[0].pop("submitted_at") == second_qc.info.submitted_at
+        assert queued == [{"job_id": second_qc.info.job_id,
+                           "host": second_qc.info.host,
+                           "runfolder": "qc",
+                           "pid": None,
+                           "state": State.QUEUED,
+                           "priority": "normal",
+                           "usage": None,
+                           "queue_position": 1,
+                           "started_at": None,
+                           "finished_at": None,
+                           "collected_at": None,
+                           "queue_seconds": None,
+                           "run_seconds": None,
+                           "turnaround_seconds": None,
+                           "collection_delay_seconds": None}]
+
+        # The exit of the first QC should start the next one right away
+        stub_reaper[first_qc.info.pid](0)
+
+        assert second_qc.info.state == State.STARTED
+        assert second_report.info.state == State.QUEUED
+        assert second_report.info.queue_position == 1
+
+        assert ps.metrics.jobs_started.value(("qc",)) == 2
+        assert ps.metrics.jobs_finished.value(("qc", State.DONE)) == 1
+        assert ps.metrics.queue_wait.count(("qc",)) == 2
+        assert ps.metrics.run_duration.count(("qc",)) == 1
+        assert ps._job_counts() == {(State.STARTED, "qc"): 1,
+                                    (State.STARTED, "report"): 1,
+                                    (State.QUEUED, "report"): 1}
+
+    # Queued jobs should be started by priority, with the jobs that have
+    # waited long enough moving up a class
+    def test_dispatch_by_priority(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+        class MyWrapper(object):
+            next_pid = 2000
+
+            def __init__(self, priority=None, waited=0):
+                self.info = ProcessInfo(runfolder="rf")
+                self.info.priority = priority
+                if waited:
+                    self.info.queued_at = time.time() - waited
+                self.type_txt = "qc"
+
+            def run(self):
+                MyWrapper.next_pid += 1
+                self.info.set_started(MyProc(MyWrapper.next_pid))
+
+            def duplicates(self, other):
+                return False
+
+        ps = ProcessService(Helper.conf)
+        ps.max_jobs = 1
+        ps.default_priorities = {"qc": "low"}
+
+        running = ps.run(MyWrapper())
+        low = ps.run(MyWrapper())
+        normal = ps.run(MyWrapper("normal"))
+        high = ps.run(MyWrapper("high"))
+        # Has waited for more than two aging intervals
+        old_low = ps.run(MyWrapper("low", waited=2.5 * ps.aging_interval))
+
+        assert low.info.priority == "low"
+        assert [w.info.queue_position for w in [old_low, high, normal, low]] == \
+            [1, 2, 3, 4]
+        assert ps.effective_priority(high.info) >= 2
+        assert 2.5 <= ps.effective_priority(old_low.info) < 2.6
+        assert ps.effective_priority(running.info) is None
+        assert ps.store.get("qc", high.info.job_id)["priority"] == "high"
+
+        for wrapper in [old_low, high, normal, low]:
+            stub_reaper[running.info.pid](0)
+            assert wrapper.info.state == State.STARTED
+            running = wrapper
+
+        with pytest.raises(RuntimeError):
+            ProcessService.check_priority("urgent")
+
+    # A queued job should be taken out of the queue when it is cancelled, and
+    # a running one should be stopped, and killed if it doesn't stop
+    def test_cancel(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.cancelling", set())
+
+        class MyWrapper(object):
+            next_pid = 3000
+
+            def __init__(self):
+                self.info = ProcessInfo(runfolder="rf")
+                self.type_txt = "qc"
+                self.signals = []
+
+            def run(self):
+                MyWrapper.next_pid += 1
+                self.info.set_started(MyProc(MyWrapper.next_pid))
+
+            def stop(self, signum):
+                self.signals.append(signum)
+                return True
+
+            def duplicates(self, other):
+                return False
+
+        ps = ProcessService(Helper.conf)
+        ps.max_jobs = 1
+        running = ps.run(MyWrapper())
+        first = ps.run(MyWrapper())
+        second = ps.run(MyWrapper())
+
+        info = ps.cancel(first.info.job_id, "qc")
+        assert info.state == State.CANCELLED
+        assert list(ps.wait_queue) == [second]
+        assert second.info.queue_position == 1
+        assert ps.store.get("qc", first.info.job_id)["state"] == State.CANCELLED
+        with pytest.raises(ConflictError):
+            ps.cancel(first.info.job_id, "qc")
+        assert ps.cancel(4711, "qc").state == State.NONE
+        assert ps.cancel(running.info.job_id, "report").state == State.NONE
+
+        info = ps.cancel(running.info.job_id, "qc")
+        assert info.state == State.STARTED
+        assert running.signals == [signal.SIGTERM]
+        # Cancelling it again doesn't signal it again
+        ps.cancel(running.info.job_id, "qc")
+        assert running.signals == [signal.SIGTERM]
+
+        ps._kill(running)
+        assert running.signals == [signal.SIGTERM, signal.SIGKILL]
+        stub_reaper[running.info.pid](-signal.SIGKILL)
+        assert running.info.state == State.CANCELLED
+        assert "while running" in running.info.msg
+        assert ps.cancelling == set()
+        # The slot was freed for the next job
+        assert second.info.state == State.STARTED
+
+    # The watchdog should stop the jobs that run for too long, or that have
+    # stopped writing output, and mark them as timed out
+    def test_check_timeouts(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.timing_out", {})
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.kill_timeouts", {})
+
+        class MyOutput(object):
+            closed = False
+            last_data_at = None
+
+            def tail(self, name):
+                return ""
+
+        class MyWrapper(object):
+            next_pid = 4000
+
+            def __init__(self, wrapper_type):
+                self.info = ProcessInfo(runfolder=wrapper_type)
+                self.type_txt = wrapper_type
+                self.signals = []
+
+            def run(self):
+                MyWrapper.next_pid += 1
+                self.info.set_started(MyProc(MyWrapper.next_pid))
+                self.info.output = MyOutput()
+                self.info.output.last_data_at = self.info.started_at
+
+            def stop(self, signum):
+                self.signals.append(signum)
+                return True
+
+            def duplicates(self, other):
+                return False
+
+        ps = ProcessService(Helper.conf)
+        ps.job_timeout_per_type = {"qc": 60}
+        ps.output_idle_timeout = 30
+        monkeypatch.setattr(ps, "_kill", lambda wrapper: None)
+
+        long_qc = ps.run(MyWrapper("qc"))
+        silent = ps.run(MyWrapper("report"))
+        busy = ps.run(MyWrapper("report"))
+        finishing = ps.run(MyWrapper("qc"))
+
+        now = time.time() + 45
+        busy.info.output.last_data_at = now - 1
+        finishing.info.started_at = now - 61
+        long_qc.info.started_at = now - 61
+        ps.check_timeouts(now)
+
+        assert long_qc.signals == [signal.SIGTERM]
+        assert silent.signals == [signal.SIGTERM]
+        assert busy.signals == []
+        assert "no output for 30 seconds" in silent.info.msg
+        # A job that is already being stopped isn't stopped again
+        ps.check_timeouts(now)
+        assert long_qc.signals == [signal.SIGTERM]
+
+        long_qc.info.output.closed = True
+        stub_reaper[long_qc.info.pid](-signal.SIGTERM)
+        assert long_qc.info.state == State.TIMEOUT
+        assert "longer than 60 seconds" in long_qc.info.msg
+        # A job that finishes successfully while it is stopped keeps its result
+        assert finishing.signals == [signal.SIGTERM]
+        finishing.info.output.closed = True
+        stub_reaper[finishing.info.pid](0)
+        assert finishing.info.state == State.DONE
+        assert ps.timing_out.keys() == [silent.info.job_id]
+        # The jobs that have stopped won't be killed after the grace period
+        assert ps.kill_timeouts.keys() == [silent.info.job_id]
+
+        # The jobs run by workers can't be stopped from here
+        front_end = ProcessService(Helper.conf, local_dispatch=False)
+        front_end.output_idle_timeout = 30
+        front_end._watch_timeouts()
+        assert front_end._timeout_checks is None
+
+    # The usage of a running job should be sampled, and completed with what
+    # wait4 reported when it has exited
+    def test_usage(self, monkeypatch, stub_reaper, tmpdir):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+        class MyWrapper(object):
+            def __init__(self):
+                self.info = ProcessInfo(runfolder="foo")
+                self.type_txt = "qc"
+
+            def run(self):
+                self.info.set_started(MyProc(4242))
+
+            def duplicates(self, other):
+                return False
+
+        class MyRusage(object):
+            ru_utime = 12.34567
+            ru_stime = 1.5
+            ru_maxrss = 2048
+            ru_inblock = 10
+            ru_oublock = 20
+            ru_nvcsw = 30
+            ru_nivcsw = 40
+
+        tmpdir.join("4242", "status").write("VmHWM:\t 1024 kB\nVmRSS:\t 512 kB\n",
+                                            ensure=True)
+        tmpdir.join("4242", "io").write("read_bytes: 4096\nwrite_bytes: 8192\n")
+
+        class MyAdmission(object):
+            samples = []
+
+            def refusal(self, wrapper_type, running):
+                return None
+
+            def started(self, wrapper):
+                pass
+
+            def sample(self, wrapper, usage):
+                self.samples.append(usage)
+
+            def finished(self, wrapper):
+                pass
+
+        ps = ProcessService(Helper.conf)
+        ps.usage = ProcessUsage(str(tmpdir))
+        ps.admission = MyAdmission()
+        ps._usage_samples = True
+        wrapper = ps.run(MyWrapper())
+
+        ps.sample_usage(1000)
+        assert wrapper.info.usage == {"max_rss_kb": 1024, "rss_kb": 512,
+                                      "read_bytes": 4096, "write_bytes": 8192}
+        assert ps.store.get("qc", wrapper.info.job_id)["usage"]["rss_kb"] == 512
+        # The admission control gets the same samples
+        assert ps.admission.samples[0]["rss_kb"] == 512
+
+        # The usage is only saved every usage_sample_interval seconds, however
+        # often the admission control has the jobs sampled
+        tmpdir.join("4242", "status").write("VmHWM:\t 1024 kB\nVmRSS:\t 768 kB\n")
+        ps.sample_usage(1005)
+        assert wrapper.info.usage["rss_kb"] == 768
+        assert ps.admission.samples[1]["rss_kb"] == 768
+        assert ps.store.get("qc", wrapper.info.job_id)["usage"]["rss_kb"] == 512
+        ps.sample_usage(1030)
+        assert ps.store.get("qc", wrapper.info.job_id)["usage"]["rss_kb"] == 768
+
+        stub_reaper[4242](0, MyRusage())
+        assert wrapper.info.state == State.DONE
+        assert wrapper.info.usage == {"user_cpu_seconds": 12.346,
+                                      "system_cpu_seconds": 1.5,
+                                      "max_rss_kb": 2048,
+                                      "block_input_ops": 10,
+                                      "block_output_ops": 20,
+                                      "voluntary_context_switches": 30,
+                                      "involuntary_context_switches": 40,
+                                      "read_bytes": 4096, "write_bytes": 8192}
+        listed = ps.list_jobs("qc")["statuses"][0]
+        assert listed["usage"]["user_cpu_seconds"] == 12.346
+
+    # Jobs run by workers should only be possible to cancel until a worker
+    # has claimed them
+    def test_cancel_worker_job(self, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        ps = ProcessService(Helper.conf, local_dispatch=False)
+
+        class MyWrapper(object):
+            def __init__(self):
+                self.info = ProcessInfo(runfolder="rf")
+                self.type_txt = "qc"
+
+            def duplicates(self, other):
+                return False
+
+        claimed = ps.run(MyWrapper())
+        queued = ps.run(MyWrapper())
+        assert ps.store.claim("worker-1", "host")["id"] == claimed.info.job_id
+
+        # The claim hasn't been picked up by refresh yet
+        assert claimed.info.state == State.QUEUED
+        with pytest.raises(ConflictError):
+            ps.cancel(claimed.info.job_id, "qc")
+        assert claimed.info.state == State.QUEUED
+
+        assert ps.cancel(queued.info.job_id, "qc").state == State.CANCELLED
+        assert ps.store.get("qc", queued.info.job_id)["state"] == State.CANCELLED
+
+    # A queued job that fails to start shouldn't end up in the process queue
+    def test_dispatch_failed_start(self, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+        class MyWrapper(object):
+            info = ProcessInfo()
+            type_txt = "qc"
+
+            def run(self):
+                self.info.state = State.ERROR
+
+        ps = ProcessService(Helper.conf)
+        res = ps.run(MyWrapper())
+        assert res.info.state == State.ERROR
+        assert len(ps.proc_queue) == 0
+        assert len(ps.wait_queue) == 0
+
+    # A finished job should still be found in the job store after its status
+    # has been read and it has been removed from memory
+    def test_status_from_store(self, monkeypatch, stub_reaper):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+        class MyWrapper(object):
+            type_txt = "qc"
+            params = {"runfolder": "foo"}
+            info = ProcessInfo(runfolder="/vagrant/foo")
+
+            def run(self):
+                self.info.set_started(MyProc(5151))
+
+        ps = ProcessService(Helper.conf)
+        wrapper = ps.run(MyWrapper())
+        job_id = wrapper.info.job_id
+        assert ps.store.get("qc", job_id)["state"] == State.STARTED
+        assert ps.store.get("qc", job_id)["pid"] == 5151
+
+        stub_reaper[5151](3)
+        assert ps.store.get("qc", job_id)["state"] == State.ERROR
+
+        assert ps.get_status(job_id, "qc").state == State.ERROR
+        assert job_id not in ps.proc_queue
+
+        res = ps.get_status(job_id, "qc")
+        assert res.state == State.ERROR
+        assert res.runfolder == "/vagrant/foo"
+        assert res.pid == 5151
+        assert ps.current_state(job_id, "qc") == State.ERROR
+        assert ps.get_status(job_id, "report").state == State.NONE
+
+    # After a restart, jobs that were running should be marked as failed and
+    # queued jobs should be put back in the queue
+    def test_recover(self, monkeypatch, stub_isdir):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+
+        store = SQLiteJobStore()
+
+        running = ReportWrapper({"runfolder": "running"}, Helper.conf)
+        running.info.set_started(MyProc(6161))
+        store.save(running)
+        running_id = running.info.job_id
+
+        queued = []
+        for runfolder in ["first", "second"]:
+            wrapper = ReportWrapper({"runfolder": runfolder}, Helper.conf)
+            wrapper.info.set_queued(1)
+            store.save(wrapper)
+            queued.append(wrapper.info.job_id)
+
+        ps = ProcessService(Helper.conf, job_store=store)
+        monkeypatch.setattr(ps, "dispatch", lambda: None)
+        ps.recover()
+
+        assert store.get("report", running_id)["state"] == State.ERROR
+        assert [w.info.job_id for w in ps.wait_queue] == queued
+        assert all(ps.proc_queue[job_id].info.job_id == job_id
+                   for job_id in queued)
+        assert [w.info.runfolder for w in ps.wait_queue] == ["/vagrant/first",
+                                                             "/vagrant/second"]
+        assert [w.info.queue_position for w in ps.wait_queue] == [1, 2]
+        assert len(store.find(State.QUEUED)) == 2
+
+    # The job history should be listed a page at a time, following the
+    # cursors, and include the queue position of queued jobs
+    def test_list_jobs(self, monkeypatch):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        ps = ProcessService(Helper.conf)
+
+        class MyWrapper(object):
+            def __init__(self, runfolder, state):
+                self.type_txt = "report"
+                self.info = ProcessInfo(runfolder="/vagrant/" + runfolder,
+                                        state=state)
+
+        for i in range(5):
+            ps.store.save(MyWrapper("rf{0}".format(i), State.DONE))
+        queued = MyWrapper("rf5", State.QUEUED)
+        queued.info.queue_position = 2
+        ps.store.save(queued)
+        ps.proc_queue.add(queued)
+
+        page = ps.list_jobs("report", limit=4)
+        assert [j["job_id"] for j in page["statuses"]] == [6, 5, 4, 3]
+        assert page["statuses"][0]["queue_position"] == 2
+        assert "queue_position" not in page["statuses"][1]
+
+        page = ps.list_jobs("report", cursor=page["next_cursor"], limit=4)
+        assert [j["job_id"] for j in page["statuses"]] == [2, 1]
+        assert page["next_cursor"] is None
+
+        page = ps.list_jobs("report", states=[State.DONE], runfolder="rf3")
+        assert [j["job_id"] for j in page["statuses"]] == [4]
+        assert page["statuses"][0]["runfolder"] == "/vagrant/rf3"
+
+        with pytest.raises(ValueError):
+            ps.list_jobs("report", cursor="bogus")
+
+    # A job identical to one that is queued or running shouldn't be started;
+    # the existing job should be returned instead
+    def test_run_coalesces_duplicates(self, monkeypatch, stub_isdir):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        ps = ProcessService(Helper.conf)
+        monkeypatch.setattr(ps, "dispatch", lambda: None)
+
+        first = ps.run(ReportWrapper(Helper.params, Helper.conf))
+        second = ps.run(ReportWrapper(Helper.params, Helper.conf))
+        assert second is first
+        assert len(ps.wait_queue) == 1
+
+        other = ps.run(ReportWrapper({"runfolder": "foo",
+                                      "sisyphus_config": "a: 1"}, Helper.conf))
+        assert other is not first
+
+        # Once the job has finished, a new one can be started
+        first.info.state = State.DONE
+        ps.proc_queue.update_state(first)
+        third = ps.run(ReportWrapper(Helper.params, Helper.conf))
+        assert third is not first
+
+        # With an idempotency key, the key decides which job is matched
+        keyed = ps.run(ReportWrapper({"runfolder": "bar"}, Helper.conf), "abc")
+        assert keyed is not third
+        assert ps.run(ReportWrapper({"runfolder": "bar"}, Helper.conf),
+                      "abc") is keyed
+        with pytest.raises(ConflictError):
+            ps.run(ReportWrapper({"runfolder": "baz"}, Helper.conf), "abc")
+
+        # A keyed request for a job that is already in flight without a key
+        # gets that job, which its retries then find by the key
+        assert ps.run(ReportWrapper(Helper.params, Helper.conf),
+                      "def") is third
+        assert third.idempotency_key == "def"
+        assert len(ps.wait_queue) == 4
+
+    # A batch should be queued in order, without duplicates, and dispatched once
+    def test_run_batch(self, monkeypatch, stub_isdir):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        ps = ProcessService(Helper.conf)
+        dispatched = []
+        monkeypatch.setattr(ps, "dispatch", lambda: dispatched.append(True))
+
+        running = ps.run(ReportWrapper({"runfolder": "bar"}, Helper.conf))
+        batch = [ReportWrapper(Helper.params, Helper.conf),
+                 QCWrapper(Helper.qcparams, Helper.conf),
+                 ReportWrapper({"runfolder": "bar"}, Helper.conf),
+                 ReportWrapper(Helper.params, Helper.conf)]
+        results = ps.run_batch(batch)
+
+        assert results[0] is batch[0]
+        assert results[1] is batch[1]
+        assert results[2] is running
+        assert results[3] is batch[0]
+        assert list(ps.wait_queue) == [running, batch[0], batch[1]]
+        assert [w.info.queue_position for w in batch[:2]] == [2, 3]
+        assert ps.store.get("qc", batch[1].info.job_id)["state"] == State.QUEUED
+        assert len(dispatched) == 2
+
+        # Nothing is queued if the batch can't be saved
+        def my_save_many(wrappers):
+            raise JobStoreError("disk full")
+
+        monkeypatch.setattr(ps.store, "save_many", my_save_many)
+        with pytest.raises(RuntimeError):
+            ps.run_batch([ReportWrapper({"runfolder": "baz"}, Helper.conf)])
+        assert len(ps.wait_queue) == 3
+
+    # The steps of a pipeline should be submitted as soon as the steps they
+    # depend on are done
+    @pytest.mark.gen_test
+    def test_run_pipeline(self, monkeypatch, stub_isdir):
+        from siswrap.pipelines import Pipeline
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.pipelines", {})
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.pipeline_steps", {})
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.finished_pipelines", deque())
+        ps = ProcessService(Helper.conf)
+        monkeypatch.setattr(ps, "dispatch", lambda: None)
+
+        pipeline = yield ps.run_pipeline(Pipeline.chain([
+            AeacusStatsWrapper(Helper.params, Helper.conf),
+            QCWrapper(Helper.qcparams, Helper.conf),
+            ReportWrapper(Helper.params, Helper.conf)]))
+        steps = pipeline.steps
+
+        assert ps.get_pipeline(pipeline.pipeline_id) is pipeline
+        assert steps["aeacusstats"].state == State.QUEUED
+        assert steps["qc"].state == State.PENDING
+        assert steps["qc"].wrapper.info.job_id is None
+
+        first = steps["aeacusstats"].wrapper
+        first.info.state = State.DONE
+        ps._state_changed(first)
+        yield gen.moment
+        assert steps["qc"].state == State.QUEUED
+        assert steps["report"].state == State.PENDING
+
+        second = steps["qc"].wrapper
+        second.info.state = State.ERROR
+        ps._state_changed(second)
+        yield gen.moment
+        assert steps["report"].state == State.CANCELLED
+        assert ps.get_pipeline(pipeline.pipeline_id).state == State.ERROR
+
+        # A finished pipeline can be read again, until it expires
+        assert ps.get_pipeline(pipeline.pipeline_id) is pipeline
+        assert ps.pipeline_steps == {}
+        assert pipeline.finished_at is not None
+        ps._expire_pipelines(pipeline.finished_at + ps.pipeline_ttl - 1)
+        assert ps.get_pipeline(pipeline.pipeline_id) is pipeline
+        ps._expire_pipelines(pipeline.finished_at + ps.pipeline_ttl)
+        assert ps.get_pipeline(pipeline.pipeline_id) is None
+        assert len(ps.finished_pipelines) == 0
+
+    # When the jobs are run by workers, they should only be followed, with
+    # the states the workers save in the job store
+    def test_worker_dispatch(self, monkeypatch, stub_isdir):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        ps = ProcessService(Helper.conf, local_dispatch=False)
+
+        wrapper = ps.run(ReportWrapper(Helper.params, Helper.conf))
+        job_id = wrapper.info.job_id
+        assert wrapper.info.state == State.QUEUED
+        assert wrapper.info.queue_position is None
+        assert len(ps.wait_queue) == 0
+        assert ps.proc_queue[job_id] is wrapper
+
+        record = ps.store.claim("worker-1", "host")
+        assert record["id"] == job_id
+        ps.refresh()
+        assert wrapper.info.state == State.STARTED
+        assert wrapper.info.host == "host"
+        assert ps.proc_queue.in_state(State.STARTED) == [wrapper]
+
+        # The usage and profile that the worker saves while the job runs
+        # are followed too
+        worker_side = ReportWrapper(Helper.params, Helper.conf)
+        worker_side.info = ProcessInfo.from_record(record)
+        worker_side.info.usage = {"rss_kb": 1024}
+        worker_side.info.profile = {"nice": 10}
+        worker_side.info.started_at = time.time()
+        ps.store.save(worker_side)
+        ps.refresh()
+        assert wrapper.info.state == State.STARTED
+        assert wrapper.info.usage == {"rss_kb": 1024}
+        assert wrapper.info.profile == {"nice": 10}
+
+        ps.store.mark(job_id, State.DONE, "Process was completed")
+        ps.refresh()
+        assert ps.get_status(job_id, "report").state == State.DONE
+        # The jobs the workers have run are counted here too
+        assert ps.metrics.jobs_started.value(("report",)) == 1
+        assert ps.metrics.jobs_finished.value(("report", State.DONE)) == 1
+
+        # Jobs that are still run by workers are followed after a restart
+        other = ps.run(ReportWrapper({"runfolder": "bar"}, Helper.conf))
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        ProcessService(Helper.conf, job_store=ps.store, local_dispatch=False).recover()
+        assert ps.store.get("report", other.info.job_id)["state"] == State.QUEUED
+        assert [w.info.job_id for w in ps.proc_queue.values()] == [other.info.job_id]
+
+    # The logs of the jobs that workers run should be followed for as long
+    # as the job store has them queued or running
+    def test_worker_get_log(self, monkeypatch, stub_isdir):
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        ps = ProcessService(Helper.conf, local_dispatch=False)
+
+        wrapper = ps.run(ReportWrapper(Helper.params, Helper.conf))
+        job_id = wrapper.info.job_id
+        ps.store.claim("worker-1", "host")
+        ps.refresh()
+
+        path, output = ps.get_log(job_id, "report", "stdout")
+        assert path.endswith("report_{0}.stdout".format(job_id))
+        assert output.closed is False
+
+        # Also when the job isn't in memory anymore
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        assert ps.get_log(job_id, "report", "stdout")[1].closed is False
+        ps.store.mark(job_id, State.DONE, "Process was completed")
+        assert output.closed is True
+        assert ps.get_log(job_id, "report", "stdout") == (path, None)
+
+    # Jobs should be held in the queue while the admission control refuses
+    # their type, without holding back other types
+    def test_dispatch_admission(self, monkeypatch, stub_reaper):
+        class MyAdmission(object):
+            interval = 5
+            started_jobs = []
+
+            def refusal(self, wrapper_type, running):
+                return "the node is busy" if wrapper_type == "qc" else None
+
+            def started(self, wrapper):
+                self.started_jobs.append(wrapper)
+
+        class MyWrapper(object):
+            def __init__(self, job_id, wrapper_type):
+                self.type_txt = wrapper_type
+                self.info = ProcessInfo(job_id)
+                self.info.job_id = job_id
+                self.info.set_queued(job_id)
+
+            def run(self):
+                self.info.set_started(MyProc(self.info.job_id))
+
+        qc = MyWrapper(1, "qc")
+        report = MyWrapper(2, "report")
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue",
+                            JobIndex([qc, report]))
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue",
+                            deque([qc, report]))
+        ps = ProcessService(Helper.conf)
+        monkeypatch.setattr(ps, "_save", lambda wrapper: None)
+        ps.admission = MyAdmission()
+        ps._usage_samples = True
+
+        ps.dispatch()
+        assert report.info.state == State.STARTED
+        assert qc.info.state == State.QUEUED
+        assert "the node is busy" in qc.info.msg
+        assert list(ps.wait_queue) == [qc]
+        assert ps.admission.started_jobs == [report]
+        assert "qc" not in ps.free_types()
+
+    # A job whose inputs haven't changed should get the result of an earlier
+    # successful job, unless it is forced to run
+    @pytest.mark.gen_test
+    def test_run_uses_result_cache(self, monkeypatch, stub_isdir):
+        class MyVersionService(object):
+            def get(self):
+                return "15.3.2"
+
+        from siswrap.result_cache import ResultCache
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue", JobIndex())
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.wait_queue", deque())
+        cache = ResultCache(Helper.conf, MyVersionService())
+        ps = ProcessService(Helper.conf, result_cache=cache)
+        monkeypatch.setattr(ps, "dispatch", lambda: None)
+
+        @gen.coroutine
+        def run(wrapper, force=False):
+            yield ps.take_fingerprints([wrapper])
+            raise gen.Return(ps.run(wrapper, force=force))
+
+        first = yield run(ReportWrapper(Helper.params, Helper.conf))
+        ps.wait_queue.clear()
+        ps._finish(first, 0)
+        assert first.info.state == State.DONE
+        assert len(cache) == 1
+        ps.get_status(first.info.job_id, "report")
+
+        cached = yield run(ReportWrapper(Helper.params, Helper.conf))
+        assert cached.cached is True
+        assert cached.info.job_id == first.info.job_id
+        assert cached.info.state == State.DONE
+        assert len(ps.wait_queue) == 0
+
+        forced = yield run(ReportWrapper(Helper.params, Helper.conf), force=True)
+        assert forced.cached is False
+        assert forced.info.job_id != first.info.job_id
+        assert forced.info.state == State.QUEUED
+
+        # A job that is no longer marked as done isn't handed out
+        ps.wait_queue.clear()
+        ps.proc_queue.remove(forced.info.job_id)
+        ps.store.mark(first.info.job_id, State.ERROR, "gone")
+        again = yield run(ReportWrapper(Helper.params, Helper.conf))
+        assert again.cached is False
+        assert len(cache) == 0
+
     # Test that we can fetch the status of all the current processes
     # in the queue
     def test_status_all(self, monkeypatch):
@@ -460,10 +1518,6 @@ class TestProcessService(object):
         monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue",
                             self.my_queue)
 
-        # mock poll_process
-        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.poll_process",
-                            self.my_poll)
-
         # self.my_queue[4242].type_txt = "qc"
         # self.my_queue[3131].type_txt = "report"
         # print "my_queue", my_queue
@@ -488,5 +1542,27 @@ class TestProcessService(object):
         res = ps.get_all("foo")
         assert len(res) == 0
 
+    # The listed status of a finished job should only be built once, and the
+    # jobs should be listed in the order of their ids
+    def test_status_all_finished(self, monkeypatch):
+        queue = self.setup_queue()
+        monkeypatch.setattr("siswrap.wrapper_services.ProcessService.proc_queue",
+                            queue)
+        ps = ProcessService(Helper.conf)
+
+        done = queue[4242]
+        done.info.state = State.DONE
+        queue.update_state(done)
+        queued = queue[3131]
+        queued.type_txt = "qc"
+        queued.info.state = State.QUEUED
+        queue.add(queued)
+
+        first = ps.get_all("qc")
+        assert [p["job_id"] for p in first] == [3131, 4242]
+        assert "effective_priority" in first[0]
+        assert ps.get_all("qc")[1] is first[1]
+        assert ps.get_all("qc")[0] is not first[0]
+
 if __name__ == '__main__':
     pytest.main()